@@ -0,0 +1,167 @@
+"""
+Buffered, append-only activity log
+
+Handlers call `activity_log.record(...)`, which only appends to an
+in-memory buffer. A background task writes the buffer to the storage
+(storage.insert_activity: the `activity_logs` collection, or the table of
+the same name in SQLite mode) every ACTIVITY_LOG_FLUSH_SECONDS, or sooner
+once ACTIVITY_LOG_BATCH_SIZE records are waiting, so request handlers never
+wait on audit writes. While the storage is unavailable records stay
+buffered up to ACTIVITY_LOG_MAX_BUFFER; beyond that the oldest are dropped
+and counted in `dropped`.
+
+Retention is ACTIVITY_LOG_RETENTION_DAYS (a TTL index in MongoDB, pruned on
+write in SQLite). Queries page by keyset on (timestamp, id), newest first.
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, List, Optional, Tuple
+
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(log: dict) -> str:
+    return f"{(log['timestamp'] - EPOCH) // timedelta(milliseconds=1)}_{log['id']}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Parse a keyset cursor; raises ValueError if malformed"""
+    millis, _, log_id = cursor.partition("_")
+    try:
+        if not ObjectId.is_valid(log_id):
+            raise ValueError(log_id)
+        return EPOCH + timedelta(milliseconds=int(millis)), log_id
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+class ActivityLogger:
+    def __init__(
+        self,
+        get_storage: Callable[[], Any],
+        flush_interval: float,
+        batch_size: int,
+        max_buffer: int,
+    ):
+        self._get_storage = get_storage
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer: deque = deque(maxlen=max_buffer)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+
+    def record(
+        self,
+        action: str,
+        type: str,
+        user_id: Optional[str] = None,
+        user_name: Optional[str] = None,
+        details: Optional[str] = None,
+        entity_id: Optional[str] = None,
+        **meta,
+    ):
+        """Queue one activity record; never blocks"""
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        now = datetime.utcnow()
+        self._buffer.append({
+            "id": str(ObjectId()),
+            # Mongo stores milliseconds; truncate so keyset cursors compare exactly
+            "timestamp": now.replace(microsecond=now.microsecond // 1000 * 1000),
+            "action": action,
+            "type": type,
+            "user_id": user_id,
+            "user_name": user_name,
+            "details": details,
+            "entity_id": entity_id,
+            "meta": meta or None,
+        })
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    async def flush(self):
+        """Write buffered records in batches; records stay queued if the write fails"""
+        storage = self._get_storage()
+        if storage is None:
+            return
+        while self._buffer:
+            batch: List[dict] = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            try:
+                retry = await storage.insert_activity(batch)
+                error = "some records were rejected"
+            except Exception as e:
+                retry, error = batch, e
+            self.written += len(batch) - len(retry)
+            if retry:
+                logger.warning(f"Activity log flush failed, will retry {len(retry)} records: {error}")
+                self._requeue(retry)
+                return
+
+    def _requeue(self, records: List[dict]):
+        """
+        Put records that failed to write back at the front of the buffer.
+        They are older than anything recorded since, so if the buffer filled
+        up meanwhile the oldest of them are the ones dropped.
+        """
+        room = self._buffer.maxlen - len(self._buffer)
+        if len(records) > room:
+            self.dropped += len(records) - room
+            records = records[len(records) - room:] if room else []
+        self._buffer.extendleft(reversed(records))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flusher and write what is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def query(
+        self,
+        user_id: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        before: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """Newest-first page of logs and the cursor for the next page (None at the end)"""
+        logs = await self._get_storage().query_activity(
+            user_id=user_id,
+            action=action,
+            since=since,
+            until=until,
+            before=decode_cursor(before) if before else None,
+            limit=limit + 1,
+        )
+        next_cursor = encode_cursor(logs[limit - 1]) if len(logs) > limit else None
+        return logs[:limit], next_cursor
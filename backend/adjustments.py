@@ -0,0 +1,190 @@
+"""
+Posting verified stock adjustments back to the ERP
+
+A stock-take is posted as one adjustment per item: the counted quantity
+is summed over every non-rejected entry of the item in the stock-take
+(all sessions, racks and locations, as in the reconciliation) and the
+difference to the item's system stock becomes one row in the ERP
+adjustments table (settings.ADJUSTMENTS_TABLE). Items that still have
+entries awaiting verification are left for a later run. Rows are posted
+in chunks: each chunk is one parameterized executemany on one connection,
+committed as a single transaction, so a posting costs one round-trip per
+chunk instead of one per item.
+
+Posting is idempotent at two levels:
+
+- the `adjustment_ledger` collection holds one document per posted
+  (stock-take, item), keyed "<stock_take_id>:<item_id>"; items already in
+  the ledger are skipped
+- every SQL row carries the same key as SourceRef and is only inserted
+  WHERE NOT EXISTS a row with that SourceRef, checked under an update
+  range lock so concurrent inserts cannot both pass; this covers a crash
+  between the SQL commit and the ledger write
+
+Only one posting job runs at a time (see main.py). An item is posted once
+per stock-take; counts changed after posting are not re-posted.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from pymongo.errors import BulkWriteError
+
+from config import settings
+from database import execute_many
+from models import EntryStatus
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+def insert_statement(table: str) -> str:
+    return (
+        f"INSERT INTO {table} (SourceRef, ItemID, AdjustmentQty, StockTakeID, PostingID, CreatedAt) "
+        f"SELECT %s, %s, %s, %s, %s, %s "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {table} WITH (UPDLOCK, HOLDLOCK) WHERE SourceRef = %s)"
+    )
+
+
+def ledger_key(stock_take_id: str, item_id: str) -> str:
+    return f"{stock_take_id}:{item_id}"
+
+
+async def item_adjustments(db, stock_take_id: str) -> dict:
+    """
+    Per-item totals for a stock-take: {"items": [...], "pending": n}.
+    Each item is {"item_id", "item_code", "counted_qty", "system_stock",
+    "adjustment_qty", "entries"}, sorted by item_id, with items that match
+    the system stock left out. `pending` counts items skipped because some
+    of their entries are not verified yet.
+    """
+    sessions = await db.sessions.find({"stock_take_id": stock_take_id}, {"_id": 1}).to_list(None)
+    groups = await db.entries.aggregate([
+        {"$match": {
+            "session_id": {"$in": [str(s["_id"]) for s in sessions]},
+            "status": {"$ne": EntryStatus.REJECTED.value},
+        }},
+        # The system stock as it was when the item was first counted
+        {"$sort": {"created_at": 1}},
+        {"$group": {
+            "_id": "$item_id",
+            "item_code": {"$first": "$item_code"},
+            "system_stock": {"$first": "$system_stock"},
+            "counted_qty": {"$sum": "$counted_qty"},
+            "entries": {"$sum": 1},
+            "unverified": {"$sum": {"$cond": [{"$eq": ["$status", EntryStatus.VERIFIED.value]}, 0, 1]}},
+        }},
+        {"$sort": {"_id": 1}},
+    ], allowDiskUse=True).to_list(None)
+
+    items = []
+    pending = 0
+    for g in groups:
+        if g["unverified"]:
+            pending += 1
+            continue
+        adjustment = (g["counted_qty"] or 0) - (g["system_stock"] or 0)
+        if adjustment:
+            items.append({
+                "item_id": g["_id"],
+                "item_code": g["item_code"],
+                "counted_qty": g["counted_qty"] or 0,
+                "system_stock": g["system_stock"] or 0,
+                "adjustment_qty": adjustment,
+                "entries": g["entries"],
+            })
+    return {"items": items, "pending": pending}
+
+
+async def _unposted(db, stock_take_id: str, items: List[dict]) -> List[dict]:
+    keys = [ledger_key(stock_take_id, i["item_id"]) for i in items]
+    posted = await db.adjustment_ledger.find({"_id": {"$in": keys}}, {"_id": 1}).to_list(None)
+    posted = {p["_id"] for p in posted}
+    return [i for i, key in zip(items, keys) if key not in posted]
+
+
+async def _record_ledger(db, docs: List[dict]):
+    try:
+        await db.adjustment_ledger.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # Items posted concurrently by another run are already in the ledger
+        if any(err["code"] != DUPLICATE_KEY for err in e.details["writeErrors"]):
+            raise
+
+
+async def post_adjustments(
+    db,
+    posting_id: str,
+    stock_take_id: str,
+    chunk_size: Optional[int] = None,
+    ctx=None,
+) -> dict:
+    """
+    Post unposted per-item adjustments of a stock-take in chunks; returns
+    totals and per-chunk timings. A failing chunk is rolled back and aborts
+    the run; chunks committed before it stay posted, so re-running resumes
+    where it stopped.
+    """
+    chunk_size = chunk_size or settings.ADJUSTMENT_CHUNK_SIZE
+    statement = insert_statement(settings.ADJUSTMENTS_TABLE)
+    started = time.perf_counter()
+    adjustments = await item_adjustments(db, stock_take_id)
+    items = adjustments["items"]
+    aggregate_ms = (time.perf_counter() - started) * 1000
+    chunks = []
+    skipped = posted = 0
+
+    for start in range(0, len(items), chunk_size):
+        batch = items[start:start + chunk_size]
+        lookup_started = time.perf_counter()
+        pending = await _unposted(db, stock_take_id, batch)
+        skipped += len(batch) - len(pending)
+        lookup_ms = (time.perf_counter() - lookup_started) * 1000
+        if pending:
+            now = datetime.utcnow()
+            rows = []
+            for i in pending:
+                key = ledger_key(stock_take_id, i["item_id"])
+                rows.append((key, i["item_id"], i["adjustment_qty"], stock_take_id, posting_id, now, key))
+
+            sql_started = time.perf_counter()
+            await asyncio.to_thread(execute_many, statement, rows)
+            sql_ms = (time.perf_counter() - sql_started) * 1000
+
+            ledger_started = time.perf_counter()
+            await _record_ledger(db, [{
+                "_id": ledger_key(stock_take_id, i["item_id"]),
+                **i,
+                "stock_take_id": stock_take_id,
+                "posting_id": posting_id,
+                "chunk": len(chunks),
+                "posted_at": now,
+            } for i in pending])
+            ledger_ms = (time.perf_counter() - ledger_started) * 1000
+
+            posted += len(pending)
+            chunks.append({
+                "chunk": len(chunks),
+                "rows": len(pending),
+                "lookup_ms": round(lookup_ms, 1),
+                "sql_ms": round(sql_ms, 1),
+                "ledger_ms": round(ledger_ms, 1),
+            })
+            logger.info(f"Posted adjustment chunk {len(chunks) - 1}: {len(pending)} rows, SQL {sql_ms:.0f}ms")
+        if ctx is not None:
+            await ctx.report(start + len(batch), len(items))
+
+    return {
+        "posting_id": posting_id,
+        "stock_take_id": stock_take_id,
+        "items": len(items),
+        "posted": posted,
+        "already_posted": skipped,
+        "pending_verification": adjustments["pending"],
+        "aggregate_ms": round(aggregate_ms, 1),
+        "chunks": chunks,
+        "sql_ms": round(sum(c["sql_ms"] for c in chunks), 1),
+    }
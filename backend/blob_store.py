@@ -0,0 +1,169 @@
+"""
+Content-addressed photo storage on local disk
+
+Photos are stored once per SHA-256 of their content under
+PHOTO_STORAGE_DIR/ab/cd/<sha256>, so the same image uploaded from several
+entries or devices takes space once. Entries only hold references of the
+form "photo:<sha256>"; the bytes are streamed through /api/photos.
+
+Base64 images that clients still send inline in entry or damage photo lists
+are moved into the store on ingest and replaced by their reference.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+from typing import AsyncIterator, List, Optional, Tuple
+
+PHOTO_REF_PREFIX = "photo:"
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+_DATA_URI_RE = re.compile(r"^data:(?P<type>[\w/+.-]+);base64,", re.IGNORECASE)
+# Bare base64 blobs are far longer than any URI or reference a device would send
+_INLINE_MIN_LENGTH = 1024
+
+
+class BlobTooLarge(Exception):
+    """Upload exceeded the configured maximum size"""
+
+
+def sniff_content_type(head: bytes) -> str:
+    """Guess an image content type from its first bytes"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/heic"
+    return "application/octet-stream"
+
+
+def photo_ref(sha256: str) -> str:
+    return f"{PHOTO_REF_PREFIX}{sha256}"
+
+
+def parse_photo_ref(value: str) -> Optional[str]:
+    """Return the sha256 of a photo reference (or bare hash), else None"""
+    if value.startswith(PHOTO_REF_PREFIX):
+        value = value[len(PHOTO_REF_PREFIX):]
+    value = value.lower()
+    return value if _SHA256_RE.match(value) else None
+
+
+class LocalBlobStore:
+    def __init__(self, root: str):
+        self.root = root
+        self._tmp = os.path.join(root, "tmp")
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path_for(sha256))
+
+    def read_head(self, sha256: str, size: int = 16) -> Optional[bytes]:
+        """First bytes of a stored blob (blocking), or None if it is not stored"""
+        try:
+            with open(self.path_for(sha256), "rb") as f:
+                return f.read(size)
+        except FileNotFoundError:
+            return None
+
+    def _commit(self, tmp_path: str, sha256: str) -> bool:
+        """Move a finished temp file into place; returns True if it was already stored"""
+        final = self.path_for(sha256)
+        if os.path.exists(final):
+            os.remove(tmp_path)
+            return True
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        os.replace(tmp_path, final)
+        return False
+
+    def _new_temp(self):
+        os.makedirs(self._tmp, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self._tmp, delete=False)
+
+    async def save_stream(self, chunks: AsyncIterator[bytes], max_bytes: int) -> Tuple[str, int, bool]:
+        """Store a streamed upload; returns (sha256, size, deduplicated)"""
+        digest = hashlib.sha256()
+        size = 0
+        buffer = bytearray()
+        tmp = await asyncio.to_thread(self._new_temp)
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise BlobTooLarge(f"Upload exceeds {max_bytes} bytes")
+                digest.update(chunk)
+                buffer += chunk
+                if len(buffer) >= WRITE_BUFFER_BYTES:
+                    await asyncio.to_thread(tmp.write, bytes(buffer))
+                    buffer.clear()
+            await asyncio.to_thread(tmp.write, bytes(buffer))
+            await asyncio.to_thread(tmp.close)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+        sha256 = digest.hexdigest()
+        deduplicated = await asyncio.to_thread(self._commit, tmp.name, sha256)
+        return sha256, size, deduplicated
+
+    def save_bytes(self, data: bytes) -> str:
+        """Store a complete blob (blocking); returns its sha256"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        if self.exists(sha256):
+            return sha256
+        tmp = self._new_temp()
+        with tmp:
+            tmp.write(data)
+        self._commit(tmp.name, sha256)
+        return sha256
+
+    # ---- inline photo migration ----
+
+    def _externalize(self, value):
+        if not isinstance(value, str):
+            return value
+        match = _DATA_URI_RE.match(value)
+        if match:
+            payload = value[match.end():]
+        elif len(value) >= _INLINE_MIN_LENGTH and parse_photo_ref(value) is None:
+            payload = value
+        else:
+            return value
+        try:
+            data = base64.b64decode(payload, validate=True)
+        except (binascii.Error, ValueError):
+            return value
+        return photo_ref(self.save_bytes(data))
+
+    def externalize_photos(self, entries: List[dict]) -> int:
+        """
+        Replace inline base64 photos in entry dicts (and their damage entries)
+        with blob references. Blocking; run it in a worker thread.
+        Returns the number of photos moved.
+        """
+        moved = 0
+
+        def convert(photos):
+            nonlocal moved
+            if not isinstance(photos, list):
+                return photos
+            converted = [self._externalize(p) for p in photos]
+            moved += sum(1 for old, new in zip(photos, converted) if old is not new)
+            return converted
+
+        for entry in entries:
+            if entry.get("photos"):
+                entry["photos"] = convert(entry["photos"])
+            for damage in entry.get("damage_entries") or []:
+                if isinstance(damage, dict) and damage.get("photos"):
+                    damage["photos"] = convert(damage["photos"])
+        return moved
@@ -0,0 +1,420 @@
+"""
+Shared memory-mapped ERP catalog snapshot
+
+When the API runs with several uvicorn workers, one worker (elected with a
+file lock: fcntl on POSIX, msvcrt on Windows) refreshes the catalog from SQL
+Server and writes it to a snapshot file. Every worker maps that file
+read-only and looks items up in place, so the catalog is held once in the
+page cache no matter how many workers run.
+
+File layout (little-endian, every section 8-byte aligned):
+
+    header      magic, generation, created_at, item count, section offsets
+    id table    keyed table: item id  -> row number
+    barcode     keyed table: barcode  -> row number
+    stock       keyed table: item id  -> stock quantity
+    rows        u64 offsets[n + 1] followed by JSON-encoded item rows
+    search      u64 offsets[n + 1] followed by lowercased "name\\x1fbarcode\\x1e"
+    category    u32 codes[n] into the category list that follows (u64 offsets
+                + lowercased names, code 0 = no category)
+
+A keyed table is: u64 count, u64 hashes[count] (sorted), i64 values[count],
+u64 key offsets[count + 1], key bytes. Lookups hash the key, bisect the hash
+array directly in the mapping and confirm the key bytes, so nothing is
+copied except the one row that is returned.
+
+Every version is written to its own file, "<path>.<generation>" (through a
+temporary file and a rename to the new name, so it appears atomically), and
+readers remap when a higher generation shows up. A published file is never
+replaced in place: on Windows a file that another worker has mapped can be
+neither replaced nor deleted. Older versions are removed once superseded;
+removal of a version still mapped somewhere is retried on the next publish.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_left
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SVCAT002"
+# magic, generation, created_at, n_items, id, barcode, stock, rows, search, category
+HEADER = struct.Struct("<8sQdQQQQQQQ")
+U64 = struct.Struct("<Q")
+RECORD_SEP = b"\x1e"
+FIELD_SEP = b"\x1f"
+
+
+def _key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _pad(buf: bytearray):
+    buf.extend(b"\0" * (-len(buf) % 8))
+
+
+def _build_keyed_table(pairs: List[Tuple[str, int]]) -> bytes:
+    entries = sorted(((_key_hash(k), k.encode("utf-8"), v) for k, v in pairs), key=lambda e: e[0])
+    buf = bytearray(U64.pack(len(entries)))
+    buf += struct.pack(f"<{len(entries)}Q", *(e[0] for e in entries))
+    buf += struct.pack(f"<{len(entries)}q", *(e[2] for e in entries))
+    offsets = [0]
+    for e in entries:
+        offsets.append(offsets[-1] + len(e[1]))
+    buf += struct.pack(f"<{len(offsets)}Q", *offsets)
+    buf += b"".join(e[1] for e in entries)
+    _pad(buf)
+    return bytes(buf)
+
+
+def _build_blob_section(blobs: List[bytes]) -> bytes:
+    offsets = [0]
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+    buf = bytearray(struct.pack(f"<{len(offsets)}Q", *offsets))
+    buf += b"".join(blobs)
+    _pad(buf)
+    return bytes(buf)
+
+
+def _build_category_section(items: List[dict]) -> bytes:
+    names = [""]
+    codes_by_name = {"": 0}
+    codes = []
+    for item in items:
+        name = (item.get("category") or "").lower()
+        code = codes_by_name.get(name)
+        if code is None:
+            code = codes_by_name[name] = len(names)
+            names.append(name)
+        codes.append(code)
+    buf = bytearray(struct.pack(f"<{len(codes)}I", *codes))
+    _pad(buf)
+    buf += U64.pack(len(names))
+    buf += _build_blob_section([n.encode("utf-8") for n in names])
+    return bytes(buf)
+
+
+def write_snapshot(path: str, items: List[dict], stock: Dict[str, Any], generation: int) -> int:
+    """Serialize a catalog to a new file at `path` (which must not be mapped by anyone)"""
+    ids = [(str(item.get("id")), row) for row, item in enumerate(items)]
+    barcodes = [(item["barcode"], row) for row, item in enumerate(items) if item.get("barcode")]
+    stock_pairs = [(str(k), int(v or 0)) for k, v in stock.items()]
+    rows = [json.dumps(item, default=_json_default, separators=(",", ":")).encode("utf-8") for item in items]
+    search = [
+        (item.get("name") or "").lower().encode("utf-8") + FIELD_SEP
+        + (item.get("barcode") or "").encode("utf-8") + RECORD_SEP
+        for item in items
+    ]
+
+    sections = [
+        _build_keyed_table(ids),
+        _build_keyed_table(barcodes),
+        _build_keyed_table(stock_pairs),
+        _build_blob_section(rows),
+        _build_blob_section(search),
+        _build_category_section(items),
+    ]
+    offsets = []
+    position = HEADER.size + (-HEADER.size % 8)
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            header = HEADER.pack(MAGIC, generation, time.time(), len(items), *offsets)
+            f.write(header + b"\0" * (-len(header) % 8))
+            for section in sections:
+                f.write(section)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return position
+
+
+class _KeyedTable:
+    """Zero-copy view over a keyed table section"""
+
+    def __init__(self, view: memoryview, offset: int):
+        (count,) = U64.unpack_from(view, offset)
+        self.count = count
+        pos = offset + 8
+        self.hashes = view[pos:pos + 8 * count].cast("Q")
+        pos += 8 * count
+        self.values = view[pos:pos + 8 * count].cast("q")
+        pos += 8 * count
+        self.key_offsets = view[pos:pos + 8 * (count + 1)].cast("Q")
+        pos += 8 * (count + 1)
+        self.keys = view[pos:pos + (self.key_offsets[count] if count else 0)]
+
+    def key_at(self, i: int) -> bytes:
+        return self.keys[self.key_offsets[i]:self.key_offsets[i + 1]].tobytes()
+
+    def get(self, key: str) -> Optional[int]:
+        h = _key_hash(key)
+        encoded = key.encode("utf-8")
+        i = bisect_left(self.hashes, h)
+        while i < self.count and self.hashes[i] == h:
+            if self.keys[self.key_offsets[i]:self.key_offsets[i + 1]] == encoded:
+                return self.values[i]
+            i += 1
+        return None
+
+    def items(self):
+        for i in range(self.count):
+            yield self.key_at(i).decode("utf-8"), self.values[i]
+
+
+class MappedCatalog:
+    """Read-only catalog snapshot backed by a memory-mapped snapshot file"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        view = memoryview(self._mmap)
+        (magic, self.generation, self.created_at, n_items,
+         id_off, bc_off, stock_off, rows_off, search_off, category_off) = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Not a catalog snapshot: {path}")
+        self.source = "erp"
+        self.loaded_at = datetime.utcfromtimestamp(self.created_at)
+        self._count = n_items
+        self._ids = _KeyedTable(view, id_off)
+        self._barcodes = _KeyedTable(view, bc_off)
+        self._stock = _KeyedTable(view, stock_off)
+        self._row_offsets = view[rows_off:rows_off + 8 * (n_items + 1)].cast("Q")
+        self._rows_base = rows_off + 8 * (n_items + 1)
+        self._search_offsets = view[search_off:search_off + 8 * (n_items + 1)].cast("Q")
+        self._search_base = search_off + 8 * (n_items + 1)
+        self._category_codes = view[category_off:category_off + 4 * n_items].cast("I")
+        names_off = category_off + 4 * n_items + (-4 * n_items % 8)
+        (n_categories,) = U64.unpack_from(view, names_off)
+        name_offsets = view[names_off + 8:names_off + 8 * (n_categories + 2)].cast("Q")
+        names_base = names_off + 8 * (n_categories + 2)
+        self._category_codes_by_name = {
+            view[names_base + name_offsets[i]:names_base + name_offsets[i + 1]].tobytes().decode("utf-8"): i
+            for i in range(n_categories)
+        }
+        self._view = view
+        self._columnar = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def age_seconds(self) -> float:
+        return max(0.0, time.time() - self.created_at)
+
+    def row(self, i: int) -> dict:
+        start = self._rows_base + self._row_offsets[i]
+        end = self._rows_base + self._row_offsets[i + 1]
+        return json.loads(self._view[start:end].tobytes())
+
+    def get_by_id(self, item_id: str) -> Optional[dict]:
+        row = self._ids.get(str(item_id))
+        return self.row(row) if row is not None else None
+
+    def get_by_barcode(self, barcode: str) -> Optional[dict]:
+        row = self._barcodes.get(barcode)
+        return self.row(row) if row is not None else None
+
+    def _search_rows(self, needle: str):
+        """Yield row numbers whose name or barcode contains `needle`, in row order"""
+        encoded = needle.lower().encode("utf-8")
+        end = self._search_base + self._search_offsets[self._count]
+        pos = self._mmap.find(encoded, self._search_base, end)
+        while pos != -1:
+            row = bisect_left(self._search_offsets, pos - self._search_base + 1) - 1
+            yield row
+            # Skip the rest of this record so a row is reported once
+            pos = self._mmap.find(encoded, self._search_base + self._search_offsets[row + 1], end)
+
+    def search(
+        self,
+        search: Optional[str] = None,
+        category: Optional[str] = None,
+        limit: int = 100,
+        offset: int = 0,
+    ) -> List[dict]:
+        # Name/barcode matching and the category filter read only the search
+        # and category sections; just the returned rows are decoded
+        rows = self._search_rows(search) if search else range(self._count)
+        if category:
+            code = self._category_codes_by_name.get(category.lower())
+            if code is None:
+                return []
+            codes = self._category_codes
+            rows = (row for row in rows if codes[row] == code)
+        selected = []
+        for row in rows:
+            if offset:
+                offset -= 1
+                continue
+            selected.append(row)
+            if len(selected) >= limit:
+                break
+        return [self.row(row) for row in selected]
+
+    def stock_and_prices(self, item_ids: List[str]) -> Dict[str, dict]:
+        """Current system stock, MRP and sale price for many items"""
+        result = {}
+        for item_id in dict.fromkeys(str(i) for i in item_ids):
+            item = self.get_by_id(item_id)
+            if item is None:
+                continue
+            stock = self._stock.get(item_id)
+            result[item_id] = {
+                "system_stock": int(stock if stock is not None else item.get("system_stock") or 0),
+                "mrp": float(item.get("mrp") or 0),
+                "sale_price": float(item.get("sale_price") or 0),
+            }
+        return result
+
+    def to_columnar(self):
+        """Decode the whole snapshot into a ColumnarCatalog for full-catalog scans (cached)"""
+        if self._columnar is None:
+            from catalog_store import ColumnarCatalog
+            items = [self.row(i) for i in range(self._count)]
+            self._columnar = ColumnarCatalog(items, self.get_stock(), self.source)
+        return self._columnar
+
+    def get_stock(self, item_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        if item_ids is None:
+            return dict(self._stock.items())
+        result = {}
+        for item_id in item_ids:
+            value = self._stock.get(str(item_id))
+            if value is not None:
+                result[str(item_id)] = value
+        return result
+
+
+def _lock_exclusive(lock_file) -> bool:
+    """Take a non-blocking exclusive lock on an open file; False if another process holds it"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+class SharedSnapshotFile:
+    """Coordinates the snapshot files between the refreshing worker and readers"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock_file = None
+        self._leading = False
+        self._current: Optional[MappedCatalog] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leading
+
+    def try_lead(self) -> bool:
+        """Try to become the refreshing worker; keeps the lock for the process lifetime"""
+        if self._leading:
+            return True
+        if fcntl is None and msvcrt is None:
+            # No file locking on this platform: run single-worker
+            self._leading = True
+            return True
+        lock_file = open(f"{self.path}.lock", "a+")
+        if not _lock_exclusive(lock_file):
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self._leading = True
+        logger.info(f"This worker (pid {os.getpid()}) now refreshes the shared catalog snapshot")
+        return True
+
+    def release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self._leading = False
+
+    def version_path(self, generation: int) -> str:
+        return f"{self.path}.{generation}"
+
+    def _versions(self) -> List[int]:
+        """Generations with a published snapshot file, ascending"""
+        directory = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + "."
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(n[len(prefix):]) for n in names if n.startswith(prefix) and n[len(prefix):].isdigit())
+
+    def publish(self, items: List[dict], stock: Dict[str, Any]) -> MappedCatalog:
+        """
+        Write a new snapshot version and map it. Raises OSError or ValueError
+        if the new version cannot be written or mapped; readers then keep
+        the previous version.
+        """
+        versions = self._versions()
+        current = self._current.generation if self._current else 0
+        generation = max(versions[-1] if versions else 0, current) + 1
+        path = self.version_path(generation)
+        size = write_snapshot(path, items, stock, generation)
+        self._current = MappedCatalog(path)
+        logger.info(f"Published catalog snapshot v{generation} ({len(items)} items, {size} bytes)")
+        self._remove_old_versions(generation)
+        return self._current
+
+    def _remove_old_versions(self, generation: int):
+        # Keep the previous version for readers that have not remapped yet
+        for old in self._versions():
+            if old >= generation - 1:
+                break
+            try:
+                os.remove(self.version_path(old))
+            except OSError as e:
+                # Still mapped by a worker on Windows; retried on the next publish
+                logger.debug(f"Catalog snapshot v{old} not removed yet: {e}")
+
+    def load(self) -> Optional[MappedCatalog]:
+        """Map the newest snapshot version, remapping only if a newer one was published"""
+        versions = self._versions()
+        if not versions or (self._current is not None and self._current.generation >= versions[-1]):
+            return self._current
+        try:
+            self._current = MappedCatalog(self.version_path(versions[-1]))
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f"Failed to map catalog snapshot v{versions[-1]}: {e}")
+        return self._current
@@ -0,0 +1,348 @@
+"""
+Compact columnar ERP catalog store
+
+Items are kept column by column instead of as one dict per SKU:
+
+- numeric fields (mrp, sale_price, system_stock) in typed NumPy arrays
+- unique strings (id, item_code, name, barcode) packed into one UTF-8 buffer
+  per column with an offsets array
+- low-cardinality strings (category, brand, uom, ...) dictionary-encoded
+  as small integer codes into a shared value list
+- id and barcode lookups through sorted hash arrays (searchsorted)
+
+A 1M-SKU catalog takes a few hundred MB as dicts and well under 300 bytes
+per SKU here. ItemRow views decode a single row on demand and serialize to
+the same shape as the `Item` model.
+"""
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from models import Item
+
+NUMERIC_FIELDS = {"mrp": np.float64, "sale_price": np.float64, "system_stock": np.int64}
+BOOL_FIELDS = ("is_serialized", "is_bundle_enabled")
+TEXT_FIELDS = ("id", "item_code", "name", "barcode")
+CODED_FIELDS = ("category", "sub_category", "brand", "uom", "tax_classification", "hsn_code")
+
+FIELD_SEP = b"\x1f"
+RECORD_SEP = b"\x1e"
+
+
+def _number(value) -> float:
+    if value is None:
+        return 0
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _hash_key(key: str) -> int:
+    # Per-process hash is fine: the store is never shared across processes
+    return hash(key) & 0xFFFFFFFFFFFFFFFF
+
+
+class StringColumn:
+    """UTF-8 strings packed into one buffer, addressed by an offsets array"""
+
+    def __init__(self, values: List[Optional[str]]):
+        encoded = [(v if v is not None else "").encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        self.offsets = offsets
+        self.buffer = b"".join(encoded)
+
+    def __getitem__(self, row: int) -> str:
+        return self.buffer[self.offsets[row]:self.offsets[row + 1]].decode("utf-8")
+
+    def nbytes(self) -> int:
+        return len(self.buffer) + self.offsets.nbytes
+
+
+class CodedColumn:
+    """Dictionary-encoded strings; code 0 is None"""
+
+    def __init__(self, values: List[Optional[str]]):
+        self.values: List[Optional[str]] = [None]
+        lookup: Dict[str, int] = {}
+        codes = np.zeros(len(values), dtype=np.uint32)
+        for row, value in enumerate(values):
+            if value is None:
+                continue
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(self.values)
+                self.values.append(value)
+            codes[row] = code
+        self.codes = codes
+
+    def __getitem__(self, row: int) -> Optional[str]:
+        return self.values[self.codes[row]]
+
+    def mask_equal_ci(self, value: str) -> np.ndarray:
+        """Boolean row mask for a case-insensitive equality match"""
+        wanted = [code for code, v in enumerate(self.values) if v is not None and v.lower() == value.lower()]
+        return np.isin(self.codes, wanted)
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+
+class HashIndex:
+    """Sorted hash -> row index over a StringColumn"""
+
+    def __init__(self, column: StringColumn, values: List[Optional[str]]):
+        rows = [row for row, v in enumerate(values) if v]
+        hashes = np.fromiter((_hash_key(values[r]) for r in rows), dtype=np.uint64, count=len(rows))
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.rows = np.asarray(rows, dtype=np.int64)[order]
+        self._column = column
+
+    def get(self, key: str) -> Optional[int]:
+        h = np.uint64(_hash_key(key))
+        i = int(np.searchsorted(self.hashes, h))
+        while i < len(self.hashes) and self.hashes[i] == h:
+            row = int(self.rows[i])
+            if self._column[row] == key:
+                return row
+            i += 1
+        return None
+
+    def get_many(self, keys: List[str]) -> np.ndarray:
+        """Vectorized lookup; returns the row for each key, or -1 where it is missing"""
+        if not len(self.hashes) or not keys:
+            return np.full(len(keys), -1, dtype=np.int64)
+        hashes = np.fromiter((_hash_key(k) for k in keys), dtype=np.uint64, count=len(keys))
+        pos = np.searchsorted(self.hashes, hashes).clip(max=len(self.hashes) - 1)
+        rows = np.where(self.hashes[pos] == hashes, self.rows[pos], -1)
+        # Confirm the keys (hash collisions); fall back to a full probe on mismatch
+        column = self._column
+        checked = [
+            row if row < 0 or column[row] == key else self._probe(key)
+            for key, row in zip(keys, rows.tolist())
+        ]
+        return np.asarray(checked, dtype=np.int64)
+
+    def _probe(self, key: str) -> int:
+        row = self.get(key)
+        return row if row is not None else -1
+
+    def nbytes(self) -> int:
+        return self.hashes.nbytes + self.rows.nbytes
+
+
+class ItemRow:
+    """Lightweight view of one catalog row"""
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store: "ColumnarCatalog", row: int):
+        self._store = store
+        self._row = row
+
+    def __getitem__(self, field: str):
+        return self._store.value(self._row, field)
+
+    def to_dict(self) -> dict:
+        return self._store.row_dict(self._row)
+
+    def to_item(self) -> Item:
+        return Item(**self.to_dict())
+
+
+class ColumnarCatalog:
+    """In-memory catalog snapshot stored column by column"""
+
+    def __init__(self, items: List[dict], stock: Dict[str, Any], source: str):
+        self.source = source
+        self.loaded_at = datetime.utcnow()
+        self._loaded_monotonic = time.monotonic()
+        self._count = len(items)
+
+        self.numeric = {
+            name: np.fromiter((_number(i.get(name)) for i in items), dtype=dtype, count=len(items))
+            for name, dtype in NUMERIC_FIELDS.items()
+        }
+        self.flags = {
+            name: np.fromiter((bool(i.get(name)) for i in items), dtype=np.bool_, count=len(items))
+            for name in BOOL_FIELDS
+        }
+        self.text = {}
+        for name in TEXT_FIELDS:
+            values = [str(i[name]) if i.get(name) is not None else None for i in items]
+            self.text[name] = StringColumn(values)
+            if name == "id":
+                self._id_index = HashIndex(self.text[name], values)
+            elif name == "barcode":
+                self._barcode_index = HashIndex(self.text[name], values)
+        self.coded = {name: CodedColumn([i.get(name) for i in items]) for name in CODED_FIELDS}
+        # Variants are rare; keep them sparse
+        self._variants = {row: i["variants"] for row, i in enumerate(items) if i.get("variants")}
+
+        search = [
+            (i.get("name") or "").lower().encode("utf-8") + FIELD_SEP + str(i.get("barcode") or "").encode("utf-8") + RECORD_SEP
+            for i in items
+        ]
+        self._search_offsets = np.zeros(len(search) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in search], out=self._search_offsets[1:])
+        self._search_buffer = b"".join(search)
+
+        # ERP stock table, aligned to catalog rows where possible
+        self.erp_stock = np.zeros(self._count, dtype=np.int64)
+        self.has_erp_stock = np.zeros(self._count, dtype=np.bool_)
+        self._extra_stock: Dict[str, Any] = {}
+        stock_keys = [str(k) for k in stock]
+        stock_rows = self._id_index.get_many(stock_keys)
+        stock_values = np.fromiter((int(v or 0) for v in stock.values()), dtype=np.int64, count=len(stock))
+        found = stock_rows >= 0
+        self.erp_stock[stock_rows[found]] = stock_values[found]
+        self.has_erp_stock[stock_rows[found]] = True
+        for i in np.flatnonzero(~found):
+            self._extra_stock[stock_keys[i]] = int(stock_values[i])
+
+    @classmethod
+    def from_items(cls, items: List[dict], stock: Optional[Dict[str, Any]] = None, source: str = "erp") -> "ColumnarCatalog":
+        if stock is None:
+            stock = {str(i["id"]): i.get("system_stock") or 0 for i in items}
+        return cls(items, stock, source)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def age_seconds(self) -> float:
+        return time.monotonic() - self._loaded_monotonic
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the columns and indexes"""
+        total = sum(a.nbytes for a in self.numeric.values()) + sum(a.nbytes for a in self.flags.values())
+        total += sum(c.nbytes() for c in self.text.values()) + sum(c.nbytes() for c in self.coded.values())
+        total += self._id_index.nbytes() + self._barcode_index.nbytes()
+        total += len(self._search_buffer) + self._search_offsets.nbytes
+        total += self.erp_stock.nbytes + self.has_erp_stock.nbytes
+        return total
+
+    # ---- row access ----
+
+    def value(self, row: int, field: str):
+        if field in self.numeric:
+            return self.numeric[field][row].item()
+        if field in self.flags:
+            return bool(self.flags[field][row])
+        if field in self.text:
+            return self.text[field][row] or None
+        if field in self.coded:
+            return self.coded[field][row]
+        if field == "variants":
+            return self._variants.get(row)
+        raise KeyError(field)
+
+    def row_dict(self, row: int) -> dict:
+        item = {name: (self.text[name][row] or None) for name in TEXT_FIELDS}
+        for name in self.coded:
+            item[name] = self.coded[name][row]
+        for name in self.numeric:
+            item[name] = self.numeric[name][row].item()
+        for name in self.flags:
+            item[name] = bool(self.flags[name][row])
+        item["variants"] = self._variants.get(row)
+        return item
+
+    def row(self, row: int) -> ItemRow:
+        return ItemRow(self, row)
+
+    def rows(self) -> Iterator[ItemRow]:
+        for row in range(self._count):
+            yield ItemRow(self, row)
+
+    def row_of(self, item_id: str) -> Optional[int]:
+        return self._id_index.get(str(item_id))
+
+    def rows_of(self, item_ids: List[str]) -> np.ndarray:
+        """Rows for many item ids at once (-1 where the id is not in the catalog)"""
+        return self._id_index.get_many([str(i) for i in item_ids])
+
+    # ---- catalog snapshot interface ----
+
+    def get_by_id(self, item_id: str) -> Optional[dict]:
+        row = self._id_index.get(str(item_id))
+        return self.row_dict(row) if row is not None else None
+
+    def get_by_barcode(self, barcode: str) -> Optional[dict]:
+        row = self._barcode_index.get(barcode)
+        return self.row_dict(row) if row is not None else None
+
+    def _search_rows(self, needle: str) -> Iterator[int]:
+        """Yield rows whose name or barcode contains `needle`, in row order"""
+        encoded = needle.lower().encode("utf-8")
+        buffer = self._search_buffer
+        pos = buffer.find(encoded)
+        while pos != -1:
+            row = int(np.searchsorted(self._search_offsets, pos, side="right")) - 1
+            yield row
+            pos = buffer.find(encoded, int(self._search_offsets[row + 1]))
+
+    def search(
+        self,
+        search: Optional[str] = None,
+        category: Optional[str] = None,
+        limit: int = 100,
+        offset: int = 0,
+    ) -> List[dict]:
+        mask = self.coded["category"].mask_equal_ci(category) if category else None
+        if not search:
+            rows = np.flatnonzero(mask) if mask is not None else np.arange(self._count)
+            return [self.row_dict(int(r)) for r in rows[offset:offset + limit]]
+
+        results = []
+        skipped = 0
+        for row in self._search_rows(search):
+            if mask is not None and not mask[row]:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            results.append(self.row_dict(row))
+            if len(results) >= limit:
+                break
+        return results
+
+    def to_columnar(self) -> "ColumnarCatalog":
+        return self
+
+    def stock_and_prices(self, item_ids: List[str]) -> Dict[str, dict]:
+        """Current system stock, MRP and sale price for many items in one vectorized lookup"""
+        keys = [str(i) for i in item_ids]
+        rows = self.rows_of(keys)
+        found = np.flatnonzero(rows >= 0)
+        hit_rows = rows[found]
+        stock = np.where(self.has_erp_stock[hit_rows], self.erp_stock[hit_rows], self.numeric["system_stock"][hit_rows])
+        mrp = self.numeric["mrp"][hit_rows]
+        sale_price = self.numeric["sale_price"][hit_rows]
+        return {
+            keys[i]: {"system_stock": s, "mrp": m, "sale_price": p}
+            for i, s, m, p in zip(found.tolist(), stock.tolist(), mrp.tolist(), sale_price.tolist())
+        }
+
+    def stock_levels(self) -> np.ndarray:
+        """System stock per row: the ERP stock table where present, else the item's own stock"""
+        return np.where(self.has_erp_stock, self.erp_stock, self.numeric["system_stock"])
+
+    def get_stock(self, item_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        if item_ids is None:
+            ids = self.text["id"]
+            stock = {ids[int(r)]: int(self.erp_stock[r]) for r in np.flatnonzero(self.has_erp_stock)}
+            stock.update(self._extra_stock)
+            return stock
+        result = {}
+        for item_id in item_ids:
+            key = str(item_id)
+            row = self._id_index.get(key)
+            if row is not None and self.has_erp_stock[row]:
+                result[key] = int(self.erp_stock[row])
+            elif key in self._extra_stock:
+                result[key] = self._extra_stock[key]
+        return result
@@ -0,0 +1,266 @@
+"""
+Compressed transport for mobile clients
+
+ASGI middleware that
+
+- compresses JSON/NDJSON/CSV/text responses with brotli (if the `brotli`
+  package is installed and the client accepts it) or gzip, once the body is
+  larger than COMPRESSION_MIN_SIZE. Streaming responses are compressed
+  chunk by chunk with a sync flush so each NDJSON line still arrives
+  promptly.
+- accepts `Content-Encoding: gzip` request bodies on the sync and entry
+  endpoints, decompressing incrementally as the body is read. A body that
+  decompresses past REQUEST_MAX_DECOMPRESSED_BYTES is answered with 413.
+
+Byte counters are kept in `transport_stats` for the metrics endpoint.
+"""
+import asyncio
+import logging
+import zlib
+from typing import Dict, Iterable, Optional
+
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_TYPES = (
+    "application/json", "application/x-ndjson", "text/", "application/javascript", "application/xml",
+)
+# Bodies above this size are compressed in a worker thread to keep the event loop free
+THREAD_THRESHOLD = 256 * 1024
+
+
+class TransportStats:
+    """Counters for bytes saved by compression"""
+
+    def __init__(self):
+        self.responses_compressed = 0
+        self.responses_skipped = 0
+        self.response_bytes_in = 0
+        self.response_bytes_out = 0
+        self.requests_decompressed = 0
+        self.request_bytes_in = 0
+        self.request_bytes_out = 0
+        self.by_encoding: Dict[str, int] = {}
+
+    def snapshot(self) -> dict:
+        saved = self.response_bytes_in - self.response_bytes_out
+        return {
+            "responses_compressed": self.responses_compressed,
+            "responses_skipped": self.responses_skipped,
+            "response_bytes_uncompressed": self.response_bytes_in,
+            "response_bytes_sent": self.response_bytes_out,
+            "response_bytes_saved": saved,
+            "response_ratio": round(self.response_bytes_out / self.response_bytes_in, 3) if self.response_bytes_in else None,
+            "requests_decompressed": self.requests_decompressed,
+            "request_bytes_received": self.request_bytes_in,
+            "request_bytes_decompressed": self.request_bytes_out,
+            "by_encoding": dict(self.by_encoding),
+        }
+
+
+transport_stats = TransportStats()
+
+
+class RequestTooLarge(HTTPException):
+    """
+    Decompressed request body exceeded the configured limit
+
+    Raised from receive(); as an HTTPException it becomes a 413 wherever the
+    app reads the body, and the middleware answers 413 for anything that
+    lets it escape before the response started.
+    """
+
+    def __init__(self, max_bytes: int):
+        super().__init__(status_code=413, detail=f"Decompressed request body exceeds {max_bytes} bytes")
+
+
+class _Encoder:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        """Compress and flush so the client can decode what it has received so far"""
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.finish()
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+def _header(headers: Iterable, name: bytes) -> Optional[str]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app,
+        min_size: int = 1024,
+        gzip_level: int = 5,
+        brotli_quality: int = 4,
+        decompress_paths: Iterable[str] = (),
+        max_request_bytes: int = 512 * 1024 * 1024,
+    ):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.decompress_paths = tuple(decompress_paths)
+        self.max_request_bytes = max_request_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = scope.get("headers", [])
+        if (_header(headers, b"content-encoding") or "").lower() == "gzip" and scope["path"].startswith(self.decompress_paths):
+            scope, receive = self._decompressing(scope, receive)
+
+        encoding = self._choose_encoding(_header(headers, b"accept-encoding") or "")
+        response_started = False
+
+        async def tracking_send(message):
+            nonlocal response_started
+            response_started = True
+            await send(message)
+
+        inner_send = tracking_send if encoding is None else self._compressing_send(tracking_send, encoding)
+        try:
+            await self.app(scope, receive, inner_send)
+        except RequestTooLarge as e:
+            if response_started:
+                raise
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code)
+            await response(scope, receive, send)
+
+    def _choose_encoding(self, accept: str) -> Optional[str]:
+        accepted = {part.split(";")[0].strip().lower() for part in accept.split(",")}
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    # ---- request bodies ----
+
+    def _decompressing(self, scope, receive):
+        scope = dict(scope)
+        scope["headers"] = [
+            (k, v) for k, v in scope["headers"] if k.lower() not in (b"content-encoding", b"content-length")
+        ]
+        decompressor = zlib.decompressobj(47)  # gzip or zlib, auto-detected
+        produced = 0
+        max_bytes = self.max_request_bytes
+        transport_stats.requests_decompressed += 1
+
+        async def receive_decompressed():
+            nonlocal produced
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            body = message.get("body", b"")
+            data = decompressor.decompress(body, max_bytes - produced + 1)
+            if not message.get("more_body", False):
+                data += decompressor.flush()
+            produced += len(data)
+            if produced > max_bytes:
+                raise RequestTooLarge(max_bytes)
+            transport_stats.request_bytes_in += len(body)
+            transport_stats.request_bytes_out += len(data)
+            return {**message, "body": data}
+
+        return scope, receive_decompressed
+
+    # ---- response bodies ----
+
+    def _compressing_send(self, send, encoding: str):
+        start_message = None
+        encoder: Optional[_Encoder] = None
+        passthrough = False
+
+        async def compress(func, data: bytes) -> bytes:
+            if len(data) > THREAD_THRESHOLD:
+                return await asyncio.to_thread(func, data)
+            return func(data)
+
+        async def send_compressed(message):
+            nonlocal start_message, encoder, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                resp_headers = message.get("headers", [])
+                content_type = (_header(resp_headers, b"content-type") or "").lower()
+                passthrough = (
+                    _header(resp_headers, b"content-encoding") is not None
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                )
+                if passthrough:
+                    await send(message)
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if encoder is None:
+                if not more_body and len(body) < self.min_size:
+                    # Small complete body: not worth compressing
+                    transport_stats.responses_skipped += 1
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                encoder = _Encoder(encoding, self.gzip_level, self.brotli_quality)
+                headers = [
+                    (k, v) for k, v in start_message.get("headers", [])
+                    if k.lower() not in (b"content-length", b"content-encoding")
+                ]
+                headers.append((b"content-encoding", encoding.encode()))
+                headers.append((b"vary", b"Accept-Encoding"))
+                if more_body:
+                    await send({**start_message, "headers": headers})
+                else:
+                    data = await compress(encoder.finish, body)
+                    headers.append((b"content-length", str(len(data)).encode()))
+                    self._count(encoding, len(body), len(data))
+                    await send({**start_message, "headers": headers})
+                    await send({"type": "http.response.body", "body": data, "more_body": False})
+                    return
+
+            if more_body:
+                data = await compress(encoder.chunk, body)
+            else:
+                data = await compress(encoder.finish, body)
+                transport_stats.responses_compressed += 1
+                transport_stats.by_encoding[encoding] = transport_stats.by_encoding.get(encoding, 0) + 1
+            transport_stats.response_bytes_in += len(body)
+            transport_stats.response_bytes_out += len(data)
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        return send_compressed
+
+    def _count(self, encoding: str, size_in: int, size_out: int):
+        transport_stats.responses_compressed += 1
+        transport_stats.response_bytes_in += size_in
+        transport_stats.response_bytes_out += size_out
+        transport_stats.by_encoding[encoding] = transport_stats.by_encoding.get(encoding, 0) + 1
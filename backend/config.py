@@ -19,6 +19,61 @@ class Settings(BaseSettings):
     SQL_SERVER_USER: str = "sa"
     SQL_SERVER_PASSWORD: str = "YourPassword123"
     SQL_SERVER_DRIVER: str = "ODBC Driver 17 for SQL Server"
+    SQL_LOGIN_TIMEOUT: int = 5  # seconds
+    SQL_QUERY_TIMEOUT: int = 60  # seconds
+
+    # ERP resilience (circuit breaker + cached catalog snapshot)
+    ERP_BREAKER_FAILURE_THRESHOLD: int = 3
+    ERP_BREAKER_RESET_SECONDS: float = 30.0
+    ERP_REFRESH_INTERVAL_SECONDS: float = 300.0
+    ERP_STALE_AFTER_SECONDS: float = 900.0
+    # Shared catalog snapshot for multi-worker deployments (empty = per-worker cache)
+    CATALOG_SNAPSHOT_PATH: str = ""
+    CATALOG_SNAPSHOT_POLL_SECONDS: float = 5.0
+
+    # Reconciliation results kept in MongoDB for querying (newest N)
+    RECONCILIATION_MAX_RESULTS: int = 10
+    RECONCILIATION_MAX_UNCOUNTED_LINES: int = 1000  # per result, largest value at stake first
+
+    # Background jobs (reports, reconciliation, exports)
+    JOB_MAX_CONCURRENCY: int = 2
+    JOB_RESULT_TTL_SECONDS: int = 86400  # 24 hours
+    JOB_LEASE_SECONDS: int = 60  # a job is failed once its worker stops renewing this
+    EXPORT_DIR: str = "exports"
+
+    # Photo blob store (content-addressed, local disk)
+    PHOTO_STORAGE_DIR: str = "photos"
+    PHOTO_MAX_BYTES: int = 20 * 1024 * 1024
+
+    # Activity log (buffered in memory, flushed in bulk)
+    ACTIVITY_LOG_FLUSH_SECONDS: float = 2.0
+    ACTIVITY_LOG_BATCH_SIZE: int = 500
+    ACTIVITY_LOG_MAX_BUFFER: int = 50000
+    ACTIVITY_LOG_RETENTION_DAYS: int = 90
+
+    # Streaming NDJSON sync
+    SYNC_STREAM_CHUNK_SIZE: int = 500
+    SYNC_STREAM_MAX_LINE_BYTES: int = 8 * 1024 * 1024
+    SYNC_STREAM_MAX_CONCURRENT: int = 8
+    SYNC_STREAM_MAX_INFLIGHT_CHUNKS: int = 4
+
+    # Transport compression (brotli is used when the optional package is installed)
+    COMPRESSION_MIN_SIZE: int = 1024  # bytes
+    GZIP_LEVEL: int = 5
+    BROTLI_QUALITY: int = 4
+    REQUEST_MAX_DECOMPRESSED_BYTES: int = 512 * 1024 * 1024
+
+    # Request tracing
+    SLOW_OP_THRESHOLD_MS: float = 200.0  # SQL/Mongo/hashing spans slower than this are logged
+    SLOW_REQUEST_THRESHOLD_MS: float = 1000.0
+    TRACE_RECENT_REQUESTS: int = 500
+    # Token for /api/debug/slow-requests (sent as X-Debug-Token); empty = endpoint disabled
+    DEBUG_ENDPOINTS_TOKEN: str = ""
+
+    # Storage for sessions, entries and reports: "mongo", or "sqlite" for a
+    # single-store install without MongoDB (embedded file at SQLITE_PATH)
+    STORAGE_BACKEND: str = "mongo"
+    SQLITE_PATH: str = "data/stock_verify.db"
 
     # MongoDB Configuration (for sessions/counts)
     MONGODB_URI: str = "mongodb://localhost:27017"
@@ -28,10 +83,16 @@ class Settings(BaseSettings):
     SECRET_KEY: str = "your-secret-key-change-in-production"
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 480  # 8 hours
+    USER_CACHE_TTL_SECONDS: float = 300.0  # per-worker user cache
+    USER_CACHE_CHECK_SECONDS: float = 5.0  # how often each worker checks for user changes elsewhere
 
     # Table names in SQL Server (customize based on your ERP)
     ITEMS_TABLE: str = "Items"
     STOCK_TABLE: str = "Stock"
+    ADJUSTMENTS_TABLE: str = "StockAdjustments"
+
+    # Posting verified variances back to the ERP
+    ADJUSTMENT_CHUNK_SIZE: int = 500  # rows per SQL transaction
 
     class Config:
         env_file = ".env"
@@ -61,4 +122,6 @@ def get_pymssql_config() -> dict:
         "database": settings.SQL_SERVER_DATABASE,
         "user": settings.SQL_SERVER_USER,
         "password": settings.SQL_SERVER_PASSWORD,
+        "login_timeout": settings.SQL_LOGIN_TIMEOUT,
+        "timeout": settings.SQL_QUERY_TIMEOUT,
     }
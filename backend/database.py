@@ -2,12 +2,18 @@
 Database connections for SQL Server and MongoDB
 """
 import pymssql
+from bson import ObjectId
+from bson.errors import InvalidId
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne
 from typing import Optional, List, Dict, Any
 from contextlib import contextmanager
 import logging
+import threading
+import time
 
 from config import settings, get_pymssql_config
+from tracing import TracedDatabase, span, sql_shape
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +25,105 @@ mongo_db = None
 sql_connected = False
 
 
+class CircuitOpenError(Exception):
+    """Raised when the SQL Server circuit breaker is rejecting calls"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the ERP (SQL Server) access layer.
+
+    closed    - calls pass through; consecutive failures are counted
+    open      - calls fail fast with CircuitOpenError until reset_timeout elapses
+    half_open - a single probe call is let through; success closes the
+                breaker, failure opens it again
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._reset_elapsed():
+                return self.HALF_OPEN
+            return self._state
+
+    def _reset_elapsed(self) -> bool:
+        return time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker will allow a probe (0 if calls are allowed)"""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def before_call(self):
+        """Reserve a call slot or raise CircuitOpenError"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN and self._reset_elapsed():
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            raise CircuitOpenError("SQL Server circuit breaker is open")
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("SQL Server circuit breaker closed")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """End a call that neither proved nor disproved the server is reachable"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(
+                        f"SQL Server circuit breaker opened after {self._failures} failure(s)"
+                    )
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "retry_after_seconds": round(self.retry_after(), 1),
+        }
+
+
+# Connection loss or timeouts; other errors (bad SQL, constraint violations)
+# come from a reachable server and do not count against the breaker
+SQL_TRANSPORT_ERRORS = (pymssql.OperationalError, pymssql.InterfaceError)
+
+sql_breaker = CircuitBreaker(
+    failure_threshold=settings.ERP_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.ERP_BREAKER_RESET_SECONDS,
+)
+
+
 async def connect_mongodb():
     """Connect to MongoDB"""
     global mongo_client, mongo_db
@@ -28,10 +133,108 @@ async def connect_mongodb():
         # Test connection
         await mongo_client.admin.command('ping')
         logger.info("MongoDB connected successfully")
-        return True
     except Exception as e:
         logger.error(f"MongoDB connection failed: {e}")
+        if mongo_client:
+            mongo_client.close()
+        mongo_client = mongo_db = None
         return False
+    # The connection is usable even if an index cannot be created
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.error(f"Creating MongoDB indexes failed: {e}")
+    return True
+
+
+async def _migrate_serial_scope():
+    """Serial claims used to be unique per stock_take_id, with one shared bucket for sessions without one"""
+    if "serial_key" in await mongo_db.serials.index_information():
+        await mongo_db.serials.drop_index("serial_key")
+    updates = [
+        UpdateOne({"_id": c["_id"]}, {"$set": {"scope": c.get("stock_take_id") or f"session:{c['session_id']}"}})
+        async for c in mongo_db.serials.find({"scope": {"$exists": False}}, {"stock_take_id": 1, "session_id": 1})
+    ]
+    if updates:
+        await mongo_db.serials.bulk_write(updates, ordered=False)
+        logger.info(f"Scoped {len(updates)} serial claims")
+
+
+async def _ensure_ttl_index(collection, field: str, name: str, seconds: int):
+    """Create a TTL index, or change its expiry in place (create_index refuses to)"""
+    existing = (await collection.index_information()).get(name)
+    if existing is None:
+        await collection.create_index(field, name=name, expireAfterSeconds=seconds)
+    elif existing.get("expireAfterSeconds") != seconds:
+        await mongo_db.command("collMod", collection.name, index={"name": name, "expireAfterSeconds": seconds})
+        logger.info(f"Changed {collection.name}.{name} expiry to {seconds}s")
+
+
+async def ensure_indexes():
+    """Create the MongoDB indexes the API relies on"""
+    await mongo_db.entries.create_index(
+        [("session_id", ASCENDING), ("item_id", ASCENDING), ("location_in_rack", ASCENDING)],
+        name="aggregate_entry_key",
+        unique=True,
+        partialFilterExpression={"aggregate": True},
+    )
+    await _migrate_serial_scope()
+    await mongo_db.serials.create_index(
+        [("serial", ASCENDING), ("scope", ASCENDING), ("item_id", ASCENDING)],
+        name="serial_scope_key",
+        unique=True,
+    )
+    await mongo_db.serials.create_index("entry_id", name="serial_by_holder")
+    await mongo_db.serials.create_index("duplicates.entry_id", name="serial_by_duplicate")
+    await _ensure_ttl_index(mongo_db.activity_logs, "timestamp", "activity_ttl", settings.ACTIVITY_LOG_RETENTION_DAYS * 86400)
+    for field in (None, "user_id", "action"):
+        keys = [(field, ASCENDING)] if field else []
+        await mongo_db.activity_logs.create_index(
+            keys + [("timestamp", DESCENDING), ("_id", DESCENDING)],
+            name=f"activity_by_{field or 'time'}",
+        )
+    await mongo_db.locations.create_index([("parent_id", ASCENDING), ("name", ASCENDING)], name="location_children")
+    await mongo_db.locations.create_index(
+        [("ancestors", ASCENDING), ("level", ASCENDING), ("sessions_done", ASCENDING)], name="location_progress",
+    )
+    await mongo_db.locations.create_index(
+        [("level", ASCENDING), ("location_type", ASCENDING), ("_id", ASCENDING)], name="location_level",
+    )
+    await mongo_db.entry_rollups.create_index(
+        [("granularity", ASCENDING), ("bucket", ASCENDING)], name="rollup_bucket",
+    )
+    await mongo_db.users.create_index("username", name="username_unique", unique=True)
+    await mongo_db.adjustment_ledger.create_index(
+        [("posting_id", ASCENDING), ("chunk", ASCENDING)], name="ledger_by_posting",
+    )
+    await mongo_db.adjustment_ledger.create_index(
+        [("stock_take_id", ASCENDING), ("item_id", ASCENDING)], name="ledger_by_stock_take",
+    )
+    await mongo_db.reconciliations.create_index("created_at", name="reconciliation_by_time")
+    await mongo_db.reconciliation_lines.create_index(
+        [("result_id", ASCENDING), ("kind", ASCENDING), ("rank", ASCENDING)], name="reconciliation_line_rank",
+    )
+    await mongo_db.reconciliation_lines.create_index(
+        [("result_id", ASCENDING), ("kind", ASCENDING), ("category_key", ASCENDING), ("rank", ASCENDING)],
+        name="reconciliation_line_category",
+    )
+    await mongo_db.reconciliation_lines.create_index(
+        [("result_id", ASCENDING), ("item_id", ASCENDING)], name="reconciliation_line_item",
+    )
+    await mongo_db.jobs.create_index("expires_at", name="job_ttl", expireAfterSeconds=0)
+    await mongo_db.jobs.create_index(
+        [("type", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)], name="job_lookup",
+    )
+
+
+def as_object_id(value):
+    """Convert a string id to ObjectId where possible (offline-created ids stay strings)"""
+    if isinstance(value, ObjectId):
+        return value
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return value
 
 
 async def close_mongodb():
@@ -42,28 +245,52 @@ async def close_mongodb():
         logger.info("MongoDB connection closed")
 
 
+_traced_db = None
+
+
 def get_mongodb():
-    """Get MongoDB database instance"""
-    return mongo_db
+    """Get MongoDB database instance (operations are timed as trace spans)"""
+    global _traced_db
+    if mongo_db is None:
+        return None
+    if _traced_db is None or _traced_db.unwrapped is not mongo_db:
+        _traced_db = TracedDatabase(mongo_db)
+    return _traced_db
 
 
 @contextmanager
 def get_sql_connection():
-    """Get SQL Server connection using context manager"""
+    """
+    Get SQL Server connection using context manager.
+
+    All ERP access goes through the circuit breaker: while it is open this
+    raises CircuitOpenError immediately instead of waiting on a connect timeout.
+    """
     global sql_connected
-    conn = None
+    sql_breaker.before_call()
     try:
         config = get_pymssql_config()
         conn = pymssql.connect(**config)
-        sql_connected = True
-        yield conn
     except Exception as e:
         sql_connected = False
+        sql_breaker.record_failure()
         logger.error(f"SQL Server connection failed: {e}")
         raise
+    try:
+        yield conn
+    except SQL_TRANSPORT_ERRORS as e:
+        sql_connected = False
+        sql_breaker.record_failure()
+        logger.error(f"SQL Server connection lost: {e}")
+        raise
+    except BaseException:
+        sql_breaker.release_probe()
+        raise
+    else:
+        sql_connected = True
+        sql_breaker.record_success()
     finally:
-        if conn:
-            conn.close()
+        conn.close()
 
 
 def test_sql_connection() -> bool:
@@ -77,6 +304,8 @@ def test_sql_connection() -> bool:
             sql_connected = True
             logger.info("SQL Server connected successfully")
             return True
+    except CircuitOpenError:
+        return False
     except Exception as e:
         sql_connected = False
         logger.error(f"SQL Server connection test failed: {e}")
@@ -86,7 +315,7 @@ def test_sql_connection() -> bool:
 def execute_query(query: str, params: tuple = None) -> List[Dict[str, Any]]:
     """Execute SQL query and return results as list of dicts"""
     try:
-        with get_sql_connection() as conn:
+        with span("sql", "execute_query", lambda: sql_shape(query)), get_sql_connection() as conn:
             cursor = conn.cursor(as_dict=True)
             if params:
                 cursor.execute(query, params)
@@ -94,6 +323,8 @@ def execute_query(query: str, params: tuple = None) -> List[Dict[str, Any]]:
                 cursor.execute(query)
             results = cursor.fetchall()
             return results
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"Query execution failed: {e}")
         raise
@@ -102,7 +333,7 @@ def execute_query(query: str, params: tuple = None) -> List[Dict[str, Any]]:
 def execute_non_query(query: str, params: tuple = None) -> int:
     """Execute SQL query without returning results (INSERT, UPDATE, DELETE)"""
     try:
-        with get_sql_connection() as conn:
+        with span("sql", "execute_non_query", lambda: sql_shape(query)), get_sql_connection() as conn:
             cursor = conn.cursor()
             if params:
                 cursor.execute(query, params)
@@ -110,16 +341,47 @@ def execute_non_query(query: str, params: tuple = None) -> int:
                 cursor.execute(query)
             conn.commit()
             return cursor.rowcount
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"Non-query execution failed: {e}")
         raise
 
 
+def execute_many(query: str, rows: List[tuple]) -> int:
+    """
+    Execute a parameterized statement for many rows on one connection and
+    commit them as a single transaction (rolled back on any failure)
+    """
+    if not rows:
+        return 0
+    try:
+        with span("sql", "execute_many", lambda: f"{len(rows)} rows: {sql_shape(query)}"), get_sql_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(query, rows)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return cursor.rowcount
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f"Batch execution failed: {e}")
+        raise
+
+
 def is_sql_connected() -> bool:
     """Check if SQL Server is connected"""
     return sql_connected
 
 
+def get_sql_breaker_status() -> Dict[str, Any]:
+    """Get SQL Server circuit breaker state"""
+    return sql_breaker.snapshot()
+
+
 def is_mongo_connected() -> bool:
     """Check if MongoDB is connected"""
     return mongo_client is not None and mongo_db is not None
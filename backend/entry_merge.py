@@ -0,0 +1,152 @@
+"""
+Aggregate counting mode: one entry per (session, item, location in rack)
+
+In sessions created with count_mode='aggregate', repeat scans of an item are
+merged into a single entry instead of inserting one document per scan.
+counted_qty is incremented atomically with an update pipeline, serial
+numbers are unioned, batches/photos/damage entries appended, and each scan
+is recorded in a short scan_log so the per-scan history is not lost.
+"""
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from models import EntryStatus
+
+logger = logging.getLogger(__name__)
+
+# Keep the most recent scans only; counted_qty always holds the full total
+SCAN_LOG_LIMIT = 200
+
+MERGE_KEY = ("session_id", "item_id", "location_in_rack")
+# Fields kept from the first scan
+FIRST_SCAN_FIELDS = (
+    "item_code", "item_name", "item_barcode", "condition", "issue_details", "mrp", "edited_mrp",
+    "mfg_date_type", "mfg_date", "expiry_date_type", "expiry_date", "remark", "is_multi_location",
+)
+# Fields refreshed from the server's latest ERP lookup on every scan
+LATEST_FIELDS = (
+    "system_stock", "variance_source", "variance_price",
+    "device_system_stock", "device_variance", "device_variance_value",
+)
+
+
+def _if_null(field: str, default: Any) -> Dict[str, Any]:
+    return {"$ifNull": [f"${field}", {"$literal": default}]}
+
+
+def _append(field: str, values: List[Any]) -> Dict[str, Any]:
+    return {"$concatArrays": [_if_null(field, []), {"$literal": values}]}
+
+
+def build_merge_pipeline(entry: dict, scanned_at: datetime) -> List[dict]:
+    """Update pipeline that folds one scan into the aggregate entry"""
+    qty = entry.get("counted_qty") or 0
+    serials = entry.get("serial_numbers") or []
+    scan = {
+        "qty": qty,
+        "at": scanned_at,
+        "serial_numbers": serials,
+        "damage_qty": entry.get("damage_qty") or 0,
+    }
+
+    merged = {field: _if_null(field, entry.get(field)) for field in FIRST_SCAN_FIELDS}
+    merged.update({field: {"$literal": entry.get(field)} for field in LATEST_FIELDS})
+    merged.update({
+        "aggregate": True,
+        "counted_qty": {"$add": [_if_null("counted_qty", 0), qty]},
+        "damage_qty": {"$add": [_if_null("damage_qty", 0), entry.get("damage_qty") or 0]},
+        "serial_numbers": {"$setUnion": [_if_null("serial_numbers", []), {"$literal": serials}]},
+        "batches": _append("batches", entry.get("batches") or []),
+        "photos": _append("photos", entry.get("photos") or []),
+        "damage_entries": _append("damage_entries", entry.get("damage_entries") or []),
+        "scan_count": {"$add": [_if_null("scan_count", 0), 1]},
+        "scan_log": {"$slice": [_append("scan_log", [scan]), -SCAN_LOG_LIMIT]},
+        "created_at": _if_null("created_at", scanned_at),
+        "updated_at": {"$literal": scanned_at},
+        "status": _if_null("status", EntryStatus.PENDING.value),
+        "is_synced": True,
+    })
+
+    price = entry.get("variance_price")
+    if price is None:
+        price = entry.get("mrp") or 0
+    variance = {"$subtract": ["$counted_qty", "$system_stock"]}
+    return [
+        {"$set": merged},
+        {"$set": {"variance": variance, "variance_value": {"$multiply": [variance, {"$literal": price}]}}},
+    ]
+
+
+def merge_scan(existing: Optional[dict], entry: dict, scanned_at: datetime) -> dict:
+    """
+    The fold of build_merge_pipeline applied in memory, for storage backends
+    without update pipelines. `existing` is the aggregate entry or None.
+    """
+    qty = entry.get("counted_qty") or 0
+    serials = entry.get("serial_numbers") or []
+    merged = dict(existing) if existing else {field: entry.get(field) for field in MERGE_KEY}
+
+    for field in FIRST_SCAN_FIELDS:
+        if merged.get(field) is None:
+            merged[field] = entry.get(field)
+    merged.update({field: entry.get(field) for field in LATEST_FIELDS})
+    merged.update({
+        "aggregate": True,
+        "counted_qty": (merged.get("counted_qty") or 0) + qty,
+        "damage_qty": (merged.get("damage_qty") or 0) + (entry.get("damage_qty") or 0),
+        "serial_numbers": list(dict.fromkeys((merged.get("serial_numbers") or []) + serials)),
+        "batches": (merged.get("batches") or []) + (entry.get("batches") or []),
+        "photos": (merged.get("photos") or []) + (entry.get("photos") or []),
+        "damage_entries": (merged.get("damage_entries") or []) + (entry.get("damage_entries") or []),
+        "scan_count": (merged.get("scan_count") or 0) + 1,
+        "scan_log": ((merged.get("scan_log") or []) + [{
+            "qty": qty,
+            "at": scanned_at,
+            "serial_numbers": serials,
+            "damage_qty": entry.get("damage_qty") or 0,
+        }])[-SCAN_LOG_LIMIT:],
+        "created_at": merged.get("created_at") or scanned_at,
+        "updated_at": scanned_at,
+        "status": merged.get("status") or EntryStatus.PENDING.value,
+        "is_synced": True,
+    })
+
+    price = entry.get("variance_price")
+    if price is None:
+        price = entry.get("mrp") or 0
+    if merged.get("system_stock") is None:
+        merged["variance"] = merged["variance_value"] = None
+    else:
+        merged["variance"] = merged["counted_qty"] - merged["system_stock"]
+        merged["variance_value"] = merged["variance"] * price
+    return merged
+
+
+def scan_variance_delta(merged: dict, qty: int) -> float:
+    """Change in the aggregate entry's variance_value caused by one scan of qty"""
+    if (merged.get("scan_count") or 1) <= 1:
+        return merged.get("variance_value") or 0
+    price = merged.get("variance_price")
+    if price is None:
+        price = merged.get("mrp") or 0
+    return qty * price
+
+
+async def merge_entry(db, entry: dict, scanned_at: datetime) -> dict:
+    """Upsert one scan into its aggregate entry and return the merged document"""
+    key = {field: entry.get(field) for field in MERGE_KEY}
+    key["aggregate"] = True
+    pipeline = build_merge_pipeline(entry, scanned_at)
+    try:
+        return await db.entries.find_one_and_update(
+            key, pipeline, upsert=True, return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race with a concurrent first scan; the document exists now
+        return await db.entries.find_one_and_update(
+            key, pipeline, return_document=ReturnDocument.AFTER,
+        )
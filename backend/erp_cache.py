@@ -0,0 +1,171 @@
+"""
+Cached ERP catalog and stock snapshot (stale-while-revalidate)
+
+Request handlers never talk to SQL Server directly. They read the last good
+snapshot held here, while a background task refreshes it through the SQL
+Server circuit breaker. When the ERP is slow or down the snapshot simply gets
+older; its age and source are reported so clients can tell.
+
+With CATALOG_SNAPSHOT_PATH set, the snapshot is shared between uvicorn
+workers through a memory-mapped file (see catalog_snapshot.py): only the
+worker holding the snapshot lock queries SQL Server, the others just remap
+the file when it is replaced.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from catalog_snapshot import MappedCatalog, SharedSnapshotFile
+from catalog_store import ColumnarCatalog
+from database import CircuitBreaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+SOURCE_ERP = "erp"
+SOURCE_STALE = "stale"
+SOURCE_MOCK = "mock"
+
+
+class ERPCache:
+    """Holds the current catalog snapshot and refreshes it in the background"""
+
+    def __init__(
+        self,
+        items_loader: Callable[[], List[dict]],
+        stock_loader: Callable[[], Dict[str, Any]],
+        breaker: CircuitBreaker,
+        fallback_items: List[dict],
+        refresh_interval: float,
+        stale_after: float,
+        shared: Optional[SharedSnapshotFile] = None,
+        poll_interval: float = 5.0,
+    ):
+        self._items_loader = items_loader
+        self._stock_loader = stock_loader
+        self._breaker = breaker
+        self.refresh_interval = refresh_interval
+        self.stale_after = stale_after
+        self._shared = shared
+        self.poll_interval = poll_interval
+        self._snapshot: Union[ColumnarCatalog, MappedCatalog] = ColumnarCatalog.from_items(fallback_items, source=SOURCE_MOCK)
+        self._last_error: Optional[str] = None
+        self._last_attempt: Optional[datetime] = None
+        self._refresh_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._warmed_up = False
+
+    @property
+    def snapshot(self) -> Union[ColumnarCatalog, MappedCatalog]:
+        return self._snapshot
+
+    @property
+    def warmed_up(self) -> bool:
+        """True once the first refresh attempt has finished (successfully or not)"""
+        return self._warmed_up
+
+    def source(self) -> str:
+        """Where the data currently being served comes from"""
+        snapshot = self._snapshot
+        if snapshot.source == SOURCE_MOCK:
+            return SOURCE_MOCK
+        if self._last_error or snapshot.age_seconds() > self.stale_after:
+            return SOURCE_STALE
+        return SOURCE_ERP
+
+    def _load(self):
+        items = self._items_loader()
+        stock = self._stock_loader()
+        return items, stock
+
+    def _follow_shared(self) -> bool:
+        """Pick up the snapshot published by the refreshing worker, if any"""
+        mapped = self._shared.load()
+        if mapped is None:
+            return False
+        self._snapshot = mapped
+        self._last_error = None
+        return True
+
+    async def refresh(self) -> bool:
+        """Load a fresh snapshot from SQL Server; keep the old one on failure"""
+        if self._shared:
+            if not self._shared.try_lead():
+                return self._follow_shared()
+            if self._snapshot.source == SOURCE_MOCK:
+                # Serve the last published snapshot (e.g. from before a restart) while we refresh
+                mapped = self._shared.load()
+                if mapped is not None:
+                    self._snapshot = mapped
+
+        async with self._refresh_lock:
+            self._last_attempt = datetime.utcnow()
+            try:
+                items, stock = await asyncio.to_thread(self._load)
+            except CircuitOpenError:
+                self._last_error = "SQL Server circuit breaker is open"
+                return False
+            except Exception as e:
+                self._last_error = str(e)
+                logger.warning(f"ERP snapshot refresh failed, serving last good snapshot: {e}")
+                return False
+
+            if self._shared:
+                try:
+                    self._snapshot = await asyncio.to_thread(self._shared.publish, items, stock)
+                except (OSError, ValueError) as e:
+                    # Other workers keep the previous version until a publish succeeds
+                    logger.error(f"Failed to publish shared catalog snapshot: {e}")
+                    self._snapshot = await asyncio.to_thread(ColumnarCatalog, items, stock, SOURCE_ERP)
+            else:
+                self._snapshot = await asyncio.to_thread(ColumnarCatalog, items, stock, SOURCE_ERP)
+            self._last_error = None
+            logger.info(f"ERP snapshot refreshed: {len(items)} items, {len(stock)} stock rows")
+            return True
+
+    def _next_delay(self) -> float:
+        if self._shared and not self._shared.is_leader:
+            return self.poll_interval
+        if self._last_error is None:
+            return self.refresh_interval
+        # Retry as soon as the breaker lets a half-open probe through
+        wait = self._breaker.retry_after() or self._breaker.reset_timeout
+        return max(1.0, min(self.refresh_interval, wait))
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            self._warmed_up = True
+            await asyncio.sleep(self._next_delay())
+
+    def start(self):
+        """Start the background refresh loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background refresh loop"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._shared:
+            self._shared.release()
+
+    def status(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            "source": self.source(),
+            "items": len(snapshot),
+            "shared_snapshot": self._shared.path if self._shared else None,
+            "refresher": self._shared.is_leader if self._shared else True,
+            "warmed_up": self._warmed_up,
+            "loaded_at": snapshot.loaded_at.isoformat(),
+            "age_seconds": round(snapshot.age_seconds(), 1),
+            "last_attempt": self._last_attempt.isoformat() if self._last_attempt else None,
+            "last_error": self._last_error,
+            "circuit": self._breaker.snapshot(),
+        }
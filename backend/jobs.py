@@ -0,0 +1,245 @@
+"""
+Background job queue for heavy reports and exports
+
+Jobs run as asyncio tasks in the worker that accepted them, with at most
+JOB_MAX_CONCURRENCY running at once (the rest wait on a semaphore). Job
+state and progress live in the `jobs` collection so any worker can answer
+a poll. Finished jobs get an `expires_at` and are removed by a TTL index.
+
+Cancellation: the owning worker cancels the task directly; a cancel request
+that lands on another worker sets `cancel_requested`, which the running job
+sees on its next progress report.
+
+Leases: every queued or running job carries `locked_until`, which its worker
+renews every JOB_LEASE_SECONDS / 3. If the worker dies the lease lapses, and
+the next maintenance pass of any worker (one runs right at startup) marks
+the job failed, so pollers see it finish and the TTL index removes it.
+Jobs are not re-run automatically: a handler may already have had side
+effects, so resubmitting is left to the caller.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+
+from models import JobStatus
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = (JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED)
+PROGRESS_WRITE_INTERVAL = 0.5  # seconds between progress writes
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when cancellation was requested from another worker"""
+
+
+class JobContext:
+    """Handed to job handlers for progress reporting"""
+
+    def __init__(self, db, job_id: str):
+        self._db = db
+        self.job_id = job_id
+        self._last_write = 0.0
+
+    async def report(self, done: int, total: Optional[int] = None, message: Optional[str] = None, force: bool = False):
+        """Record progress (throttled); raises JobCancelled if a cancel was requested"""
+        loop = asyncio.get_running_loop()
+        if not force and loop.time() - self._last_write < PROGRESS_WRITE_INTERVAL:
+            return
+        self._last_write = loop.time()
+        update = {"progress.done": done, "progress.updated_at": datetime.utcnow()}
+        if total is not None:
+            update["progress.total"] = total
+        if message is not None:
+            update["progress.message"] = message
+        job = await self._db.jobs.find_one_and_update(
+            {"_id": self.job_id}, {"$set": update},
+            projection={"cancel_requested": 1}, return_document=ReturnDocument.AFTER,
+        )
+        if job and job.get("cancel_requested"):
+            raise JobCancelled()
+
+
+JobHandler = Callable[..., Awaitable[Dict[str, Any]]]
+
+
+class JobManager:
+    """Runs registered job types with bounded concurrency"""
+
+    def __init__(self, get_db: Callable[[], Any], max_concurrency: int, result_ttl: float, lease_seconds: float):
+        self._get_db = get_db
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.result_ttl = result_ttl
+        self.lease_seconds = lease_seconds
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._maintenance: Optional[asyncio.Task] = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def register(self, job_type: str, handler: JobHandler):
+        """Register an async handler(ctx, **params) -> JSON-serializable result dict"""
+        self._handlers[job_type] = handler
+
+    @property
+    def job_types(self):
+        return list(self._handlers)
+
+    def _lease(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def start(self):
+        """Start renewing this worker's leases and failing jobs whose lease lapsed"""
+        if self._maintenance is None:
+            self._maintenance = asyncio.create_task(self._maintain())
+
+    async def _maintain(self):
+        while True:
+            try:
+                await self.fail_abandoned()
+                await self.renew_leases()
+            except Exception as e:
+                logger.warning(f"Job lease maintenance failed: {e}")
+            await asyncio.sleep(self.lease_seconds / 3)
+
+    async def renew_leases(self):
+        if self._tasks:
+            await self._get_db().jobs.update_many(
+                {"_id": {"$in": list(self._tasks)}, "status": {"$nin": [s.value for s in FINISHED_STATUSES]}},
+                {"$set": {"locked_until": self._lease()}},
+            )
+
+    async def fail_abandoned(self) -> int:
+        """Fail queued or running jobs whose worker stopped renewing their lease"""
+        now = datetime.utcnow()
+        result = await self._get_db().jobs.update_many(
+            {
+                "_id": {"$nin": list(self._tasks)},
+                "status": {"$in": [JobStatus.QUEUED.value, JobStatus.RUNNING.value]},
+                # Jobs from before leases existed have no locked_until
+                "$or": [{"locked_until": {"$lt": now}}, {"locked_until": None}],
+            },
+            {"$set": {
+                "status": JobStatus.FAILED.value,
+                "error": "Worker stopped before the job finished",
+                "finished_at": now,
+                "expires_at": now + timedelta(seconds=self.result_ttl),
+                "locked_until": None,
+            }},
+        )
+        if result.modified_count:
+            logger.warning(f"Failed {result.modified_count} job(s) abandoned by a stopped worker")
+        return result.modified_count
+
+    async def submit(self, job_type: str, params: Dict[str, Any], submitted_by: Optional[str] = None) -> dict:
+        """Persist a queued job and start it in the background; returns the job document"""
+        if job_type not in self._handlers:
+            raise ValueError(f"Unknown job type: {job_type}")
+        db = self._get_db()
+        job = {
+            "_id": uuid.uuid4().hex,
+            "type": job_type,
+            "status": JobStatus.QUEUED.value,
+            "params": params,
+            "submitted_by": submitted_by,
+            "worker": self.worker_id,
+            "progress": {"done": 0, "total": None, "message": None},
+            "result": None,
+            "error": None,
+            "cancel_requested": False,
+            "created_at": datetime.utcnow(),
+            "started_at": None,
+            "finished_at": None,
+            "expires_at": None,
+            "locked_until": self._lease(),
+        }
+        await db.jobs.insert_one(job)
+        self._tasks[job["_id"]] = asyncio.create_task(self._run(job["_id"], job_type, params))
+        return job
+
+    async def _finish(self, job_id: str, status: JobStatus, **fields):
+        now = datetime.utcnow()
+        fields.update({
+            "status": status.value,
+            "finished_at": now,
+            "expires_at": now + timedelta(seconds=self.result_ttl),
+            "locked_until": None,
+        })
+        await self._get_db().jobs.update_one({"_id": job_id}, {"$set": fields})
+
+    async def _run(self, job_id: str, job_type: str, params: Dict[str, Any]):
+        db = self._get_db()
+        try:
+            async with self._semaphore:
+                job = await db.jobs.find_one_and_update(
+                    {"_id": job_id, "cancel_requested": False},
+                    {"$set": {
+                        "status": JobStatus.RUNNING.value,
+                        "started_at": datetime.utcnow(),
+                        "locked_until": self._lease(),
+                    }},
+                )
+                if job is None:
+                    await self._finish(job_id, JobStatus.CANCELLED)
+                    return
+                ctx = JobContext(db, job_id)
+                result = await self._handlers[job_type](ctx, **params)
+                await self._finish(job_id, JobStatus.SUCCEEDED, result=result)
+                logger.info(f"Job {job_id} ({job_type}) succeeded")
+        except (asyncio.CancelledError, JobCancelled):
+            await asyncio.shield(self._finish(job_id, JobStatus.CANCELLED))
+            logger.info(f"Job {job_id} ({job_type}) cancelled")
+        except Exception as e:
+            logger.exception(f"Job {job_id} ({job_type}) failed")
+            await self._finish(job_id, JobStatus.FAILED, error=str(e))
+        finally:
+            self._tasks.pop(job_id, None)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await self._get_db().jobs.find_one({"_id": job_id})
+
+    async def active(self, job_type: str, exclude: Optional[str] = None, running_only: bool = False) -> Optional[dict]:
+        """A queued or running job of this type (other than `exclude`), if any"""
+        statuses = [JobStatus.RUNNING.value] if running_only else [JobStatus.QUEUED.value, JobStatus.RUNNING.value]
+        query: Dict[str, Any] = {"type": job_type, "status": {"$in": statuses}}
+        if exclude:
+            query["_id"] = {"$ne": exclude}
+        return await self._get_db().jobs.find_one(query, {"result": 0})
+
+    async def list(self, job_type: Optional[str] = None, status: Optional[str] = None, limit: int = 50):
+        query = {}
+        if job_type:
+            query["type"] = job_type
+        if status:
+            query["status"] = status
+        return await self._get_db().jobs.find(query, {"result": 0}).sort("created_at", -1).to_list(limit)
+
+    async def cancel(self, job_id: str) -> Optional[dict]:
+        """Cancel a queued or running job"""
+        db = self._get_db()
+        job = await db.jobs.find_one_and_update(
+            {"_id": job_id, "status": {"$nin": [s.value for s in FINISHED_STATUSES]}},
+            {"$set": {"cancel_requested": True}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is None:
+            return await self.get(job_id)
+        task = self._tasks.get(job_id)
+        if task:
+            task.cancel()
+        return job
+
+    async def shutdown(self):
+        """Cancel jobs still running in this worker"""
+        if self._maintenance:
+            self._maintenance.cancel()
+            self._maintenance = None
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
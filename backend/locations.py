@@ -0,0 +1,244 @@
+"""
+Persistent location hierarchy with counting-progress rollups
+
+Each level of location_type -> floor -> area -> rack is a document in the
+`locations` collection, keyed by its path ("showroom/floor=1/area=A/rack=R001";
+missing levels are skipped). Every node carries rollup counters that are
+updated with $inc on the node and all its ancestors as sessions and entries
+are written:
+
+- sessions_open / sessions_total / sessions_done (done = counted, awaiting
+  or past verification)
+- racks_total / racks_counted (racks with at least one done session)
+- items_scanned, counted_qty, variance_value (entry edits apply their
+  delta; a rejected entry counts for nothing)
+
+So the children of a node with their progress, or every rack under a node
+that is still left to count, is one indexed read.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+
+from models import EntryStatus, SessionStatus
+
+logger = logging.getLogger(__name__)
+
+LEVELS = ("location", "floor", "area", "rack")
+COUNTERS = (
+    "sessions_open", "sessions_total", "sessions_done", "racks_total", "racks_counted",
+    "items_scanned", "counted_qty", "variance_value",
+)
+ENTRY_COUNTERS = ("items_scanned", "counted_qty", "variance_value")
+OPEN_STATUSES = {SessionStatus.ACTIVE.value}
+DONE_STATUSES = {SessionStatus.PENDING_VERIFICATION.value, SessionStatus.COMPLETED.value, SessionStatus.VERIFIED.value}
+LOCATION_FIELDS = {"location_type": 1, "floor": 1, "area": 1, "rack_no": 1}
+
+
+def _value(v) -> Optional[str]:
+    v = getattr(v, "value", v)
+    return None if v is None or v == "" else str(v)
+
+
+def location_path(location_type, floor=None, area=None, rack_no=None) -> List[dict]:
+    """Node documents (without counters) from the top level down to the rack"""
+    fields = {
+        "location_type": _value(location_type), "floor": _value(floor),
+        "area": _value(area), "rack_no": _value(rack_no),
+    }
+    nodes: List[dict] = []
+    parts: List[str] = []
+    for level, value in zip(LEVELS, fields.values()):
+        if value is None:
+            continue
+        parts.append(value if level == "location" else f"{level}={value}")
+        nodes.append({
+            "_id": "/".join(parts),
+            "level": level,
+            "name": value,
+            "parent_id": nodes[-1]["_id"] if nodes else None,
+            "ancestors": [n["_id"] for n in nodes],
+            # Location fields down to this node's level
+            **dict(list(fields.items())[:LEVELS.index(level) + 1]),
+        })
+    return nodes
+
+
+def session_path(session: dict) -> List[dict]:
+    return location_path(session.get("location_type"), session.get("floor"), session.get("area"), session.get("rack_no"))
+
+
+def _upsert_update(node: dict, inc: Dict[str, float], now: datetime) -> dict:
+    inc = {k: v for k, v in inc.items() if v}
+    on_insert = {**node, **{c: 0 for c in COUNTERS if c not in inc}}
+    on_insert.pop("_id")
+    if node["level"] == "rack":
+        on_insert["racks_total"] = 1
+    update = {"$setOnInsert": on_insert, "$set": {"updated_at": now}}
+    if inc:
+        update["$inc"] = inc
+    return update
+
+
+def _upsert(node: dict, inc: Dict[str, float], now: datetime) -> UpdateOne:
+    return UpdateOne({"_id": node["_id"]}, _upsert_update(node, inc, now), upsert=True)
+
+
+async def _apply(db, nodes: List[dict], inc: Dict[str, float]) -> bool:
+    """
+    Apply counter deltas to a path; returns True if the rack node was created.
+    The rack (leaf) is updated first so that its creation and its
+    counted/uncounted transitions can be rolled up into the ancestors.
+    """
+    if not nodes:
+        return False
+    created = False
+    now = datetime.utcnow()
+    leaf, ancestors = nodes[-1], nodes[:-1]
+    inc = dict(inc)
+    if leaf["level"] == "rack":
+        before = await db.locations.find_one_and_update(
+            {"_id": leaf["_id"]}, _upsert_update(leaf, inc, now), upsert=True,
+            projection={"sessions_done": 1}, return_document=ReturnDocument.BEFORE,
+        )
+        done_before = before.get("sessions_done", 0) if before else 0
+        done_after = done_before + inc.get("sessions_done", 0)
+        created = before is None
+        inc["racks_total"] = int(created)
+        inc["racks_counted"] = int(done_after > 0) - int(done_before > 0)
+    else:
+        ancestors = nodes
+    ops = [_upsert(n, inc, now) for n in ancestors]
+    if inc.get("racks_counted") and leaf["level"] == "rack":
+        ops.append(UpdateOne({"_id": leaf["_id"]}, {"$inc": {"racks_counted": inc["racks_counted"]}}))
+    if ops:
+        await db.locations.bulk_write(ops, ordered=False)
+    return created
+
+
+async def record_session_status(db, session: dict, old_status=None, new_status=None, created: bool = False):
+    """Roll up a session being created or changing status"""
+    old_status, new_status = _value(old_status), _value(new_status)
+    inc = {
+        "sessions_total": int(created),
+        "sessions_open": int(new_status in OPEN_STATUSES) - int(old_status in OPEN_STATUSES),
+        "sessions_done": int(new_status in DONE_STATUSES) - int(old_status in DONE_STATUSES),
+    }
+    if created or any(inc.values()):
+        await _apply(db, session_path(session), inc)
+
+
+async def record_scans(db, scans: Iterable[Tuple[str, float, float]], sessions: Dict[str, dict]):
+    """
+    Roll up entry scans given as (session_id, counted_qty, variance_value delta)
+    in one bulk write. `sessions` maps session id -> session document with
+    the location fields.
+    """
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0, 0, 0.0])
+    for session_id, qty, value in scans:
+        t = totals[str(session_id)]
+        t[0] += 1
+        t[1] += qty or 0
+        t[2] += value or 0
+    now = datetime.utcnow()
+    node_inc: Dict[str, Dict[str, float]] = {}
+    nodes: Dict[str, dict] = {}
+    for session_id, (scanned, qty, value) in totals.items():
+        session = sessions.get(session_id)
+        if session is None:
+            continue
+        for node in session_path(session):
+            nodes[node["_id"]] = node
+            inc = node_inc.setdefault(node["_id"], {"items_scanned": 0, "counted_qty": 0, "variance_value": 0.0})
+            inc["items_scanned"] += scanned
+            inc["counted_qty"] += qty
+            inc["variance_value"] += value
+    if node_inc:
+        # Nodes already exist for sessions created through the API; upsert keeps
+        # entries for unknown racks from being lost
+        result = await db.locations.bulk_write([
+            _upsert(nodes[node_id], inc, now) for node_id, inc in node_inc.items()
+        ], ordered=False)
+        # A rack first seen here counts towards its ancestors' racks_total
+        new_racks = [nodes[i] for i in result.upserted_ids.values() if nodes[i]["level"] == "rack"]
+        ancestor_inc: Dict[str, int] = defaultdict(int)
+        for rack in new_racks:
+            for ancestor_id in rack["ancestors"]:
+                ancestor_inc[ancestor_id] += 1
+        if ancestor_inc:
+            await db.locations.bulk_write([
+                UpdateOne({"_id": node_id}, {"$inc": {"racks_total": count}}) for node_id, count in ancestor_inc.items()
+            ], ordered=False)
+
+
+def _entry_totals(entry: dict) -> Tuple[int, float, float]:
+    """What an entry adds to items_scanned, counted_qty and variance_value"""
+    if _value(entry.get("status")) == EntryStatus.REJECTED.value:
+        return 0, 0, 0.0
+    return entry.get("scan_count") or 1, entry.get("counted_qty") or 0, entry.get("variance_value") or 0
+
+
+async def record_edit(db, before: dict, after: dict, session: Optional[dict]):
+    """Roll up an entry edit (count change, re-valuation, rejection) on its rack and ancestors"""
+    if session is None:
+        return
+    deltas = zip(ENTRY_COUNTERS, _entry_totals(before), _entry_totals(after))
+    inc = {counter: new - old for counter, old, new in deltas if new != old}
+    nodes = session_path(session)
+    if inc and nodes:
+        await db.locations.bulk_write([UpdateOne({"_id": n["_id"]}, {"$inc": inc}) for n in nodes], ordered=False)
+
+
+async def register_racks(db, racks: List[dict]) -> int:
+    """Create rack nodes ahead of counting so untouched racks show as left to count"""
+    created = 0
+    for rack in racks:
+        nodes = location_path(rack.get("location_type"), rack.get("floor"), rack.get("area"), rack.get("rack_no"))
+        if nodes and nodes[-1]["level"] == "rack":
+            created += await _apply(db, nodes, {})
+    return created
+
+
+async def get_children(db, parent_id: Optional[str] = None) -> List[dict]:
+    """Direct children of a node (top-level locations when parent_id is None)"""
+    return await db.locations.find({"parent_id": parent_id}).sort("name", 1).to_list(None)
+
+
+async def get_remaining_racks(db, node_id: Optional[str] = None, limit: int = 500) -> List[dict]:
+    """Racks under a node (or anywhere) that have no counted session yet"""
+    query = {"level": "rack", "sessions_done": 0}
+    if node_id:
+        query["ancestors"] = node_id
+    return await db.locations.find(query).sort("_id", 1).to_list(limit)
+
+
+def racks_from_sessions(rows: Iterable[dict]) -> List[dict]:
+    """
+    Rack nodes built from session counts per rack and status (see
+    Storage.session_rack_counts), for when the locations collection is not
+    available. Only session counters are filled in.
+    """
+    racks: Dict[str, dict] = {}
+    for row in rows:
+        path = location_path(row.get("location_type"), row.get("floor"), row.get("area"), row.get("rack_no"))
+        if not path or path[-1]["level"] != "rack":
+            continue
+        rack = racks.setdefault(path[-1]["_id"], {**path[-1], "sessions_open": 0, "sessions_total": 0, "sessions_done": 0})
+        status = _value(row.get("status"))
+        rack["sessions_total"] += row["sessions"]
+        rack["sessions_open"] += row["sessions"] if status in OPEN_STATUSES else 0
+        rack["sessions_done"] += row["sessions"] if status in DONE_STATUSES else 0
+    for rack in racks.values():
+        rack["racks_total"] = 1
+        rack["racks_counted"] = int(rack["sessions_done"] > 0)
+    return [racks[k] for k in sorted(racks)]
+
+
+async def get_racks(db, location_type: Optional[str] = None) -> List[dict]:
+    query = {"level": "rack"}
+    if location_type:
+        query["location_type"] = location_type
+    return await db.locations.find(query).sort("_id", 1).to_list(None)
@@ -2,13 +2,19 @@
 Stock Verify Backend - FastAPI Server
 Connects to SQL Server for ERP data and MongoDB for session/count storage
 """
+import asyncio
+import csv
+import hmac
+import json
 import logging
+import os
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import List, Optional, Union
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import uvicorn
@@ -18,31 +24,70 @@ from database import (
     connect_mongodb,
     close_mongodb,
     get_mongodb,
-    test_sql_connection,
     execute_query,
     is_sql_connected,
     is_mongo_connected,
+    sql_breaker,
 )
+from erp_cache import ERPCache
+from catalog_store import ColumnarCatalog
+from catalog_snapshot import MappedCatalog, SharedSnapshotFile
 from models import (
-    User, UserCreate, UserLogin, Token,
+    User, UserCreate, UserUpdate, UserLogin, Token,
     Item, ItemVariant,
     Session, SessionCreate, SessionUpdate,
-    Entry, EntryCreate, EntryUpdate,
-    BatchSyncRequest, BatchSyncResponse, SyncResult, SyncStatus,
-    VarianceReport, Metrics,
-    SessionStatus, EntryStatus,
+    Entry, EntryCreate, EntryUpdate, EntryStatus,
+    BatchSyncRequest, BatchSyncResponse, SyncOperation, SyncResult, SyncStatus,
+    VarianceReport, Metrics, RollupPoint,
+    PriceBasis, ReconciliationKind, ReconciliationLine, ReconciliationSummary,
+    SessionSummary,
+    Job, JobStatus,
+    SerialRecord,
+    ActivityLog,
+    LocationNode, RackRegistration,
 )
+from reconciliation import ReconciliationStore, run_reconciliation
+from variance import VARIANCE_FIELDS, recompute_variances
+from entry_merge import scan_variance_delta
+from compression import CompressionMiddleware, RequestTooLarge, transport_stats
+from jobs import JobManager
+from serial_index import find_serial, register_serials, release_serials
+from adjustments import post_adjustments
+from activity_log import ActivityLogger
+from users import UserStore, UsernameTaken
+import locations
+import rollups
+from tracing import RequestIdFilter, TracingMiddleware, slowest_requests, span
+from blob_store import BlobTooLarge, LocalBlobStore, parse_photo_ref, photo_ref, sniff_content_type
+from sync_stream import InflightLimiter, LineTooLong, RequestBodyStreamingResponse, iter_operation_chunks
+from session_summary import is_summary_status
+from storage import SQLITE, is_aggregate_session, new_entry_doc, new_session_doc, open_storage
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(RequestIdFilter())
 logger = logging.getLogger(__name__)
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Startup state of the subsystems that warm up in the background (see /ready)
+readiness = {"storage": False, "users": False}
+
+
+def _hash_password(password: str) -> str:
+    with span("auth", "password.hash"):
+        return pwd_context.hash(password)
+
+
+def _verify_password(password: str, password_hash: str) -> bool:
+    with span("auth", "password.verify"):
+        return pwd_context.verify(password, password_hash)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -50,27 +95,48 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting Stock Verify Backend...")
 
-    # Connect to MongoDB
-    mongo_ok = await connect_mongodb()
-    if mongo_ok:
-        logger.info("MongoDB connected")
-    else:
-        logger.warning("MongoDB connection failed - sessions will not persist")
-
-    # Test SQL Server connection
-    sql_ok = test_sql_connection()
-    if sql_ok:
-        logger.info("SQL Server connected")
+    # Nothing below waits on a backend: the server accepts requests right away
+    # and /ready reports when storage and the catalog are warm.
+    # In-memory users first, so logins work before MongoDB is up
+    await user_store.seed(MOCK_USERS)
+
+    # The first catalog refresh doubles as the SQL Server connection check
+    erp_cache.start()
+    activity_log.start()
+    mongo_startup = None
+    if storage.name == SQLITE:
+        # Embedded single-store mode: no MongoDB, users stay in memory
+        await storage.open()
+        readiness["storage"] = readiness["users"] = True
     else:
-        logger.warning("SQL Server connection failed - using mock data")
+        mongo_startup = asyncio.create_task(connect_mongo_backends())
 
     yield
 
     # Shutdown
     logger.info("Shutting down...")
+    if mongo_startup:
+        mongo_startup.cancel()
+    await job_manager.shutdown()
+    await erp_cache.stop()
+    await activity_log.stop()
+    await storage.close()
     await close_mongodb()
 
 
+async def connect_mongo_backends():
+    """Connect to MongoDB (indexes included) and seed users, in the background"""
+    mongo_ok = await connect_mongodb()
+    if mongo_ok:
+        logger.info("MongoDB connected")
+        await user_store.seed(MOCK_USERS)
+        readiness["users"] = True
+        job_manager.start()
+    else:
+        logger.warning("MongoDB connection failed - sessions will not persist")
+    readiness["storage"] = mongo_ok
+
+
 # Create FastAPI app
 app = FastAPI(
     title="Stock Verify API",
@@ -88,6 +154,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip/brotli responses; gzip request bodies accepted on the sync and entry endpoints
+app.add_middleware(
+    CompressionMiddleware,
+    min_size=settings.COMPRESSION_MIN_SIZE,
+    gzip_level=settings.GZIP_LEVEL,
+    brotli_quality=settings.BROTLI_QUALITY,
+    decompress_paths=("/api/sync/", "/api/entries", "/api/sessions/"),
+    max_request_bytes=settings.REQUEST_MAX_DECOMPRESSED_BYTES,
+)
+
+# Request id + span timing; outermost so the trace covers the whole request
+app.add_middleware(TracingMiddleware)
+
 
 # ============== MOCK DATA (used when SQL Server not available) ==============
 MOCK_ITEMS = [
@@ -138,15 +217,27 @@ MOCK_ITEMS = [
     },
 ]
 
+# Seed users; bcrypt hashes are precomputed so importing this module stays fast
+# (passwords: staff1/1234, supervisor1/1234, admin/admin)
 MOCK_USERS = [
-    {"id": "1", "username": "staff1", "name": "Rahul Kumar", "role": "staff", "is_active": True, "password_hash": pwd_context.hash("1234")},
-    {"id": "2", "username": "supervisor1", "name": "Amit Patel", "role": "supervisor", "is_active": True, "password_hash": pwd_context.hash("1234")},
-    {"id": "3", "username": "admin", "name": "Admin User", "role": "admin", "is_active": True, "password_hash": pwd_context.hash("admin")},
+    {"id": "1", "username": "staff1", "name": "Rahul Kumar", "role": "staff", "is_active": True,
+     "password_hash": "$2b$12$xQeePtpY0riq2nqJuMeBOegSS3X5gR0b06BygeCaxGiRgNYtVVbhW"},
+    {"id": "2", "username": "supervisor1", "name": "Amit Patel", "role": "supervisor", "is_active": True,
+     "password_hash": "$2b$12$blUPlhmJxxv/FzJ5gl9m4u0LLFJUsy525bP7PV6a69XAWtTHvH6mS"},
+    {"id": "3", "username": "admin", "name": "Admin User", "role": "admin", "is_active": True,
+     "password_hash": "$2b$12$DCS7KXUnVnkk./hdJRrOzOMuakEW7dxkrEiSumTFhyhgYiZsRbqIy"},
 ]
 
 
 # ============== HELPER FUNCTIONS ==============
 
+user_store = UserStore(
+    get_db=get_mongodb,
+    ttl=settings.USER_CACHE_TTL_SECONDS,
+    check_interval=settings.USER_CACHE_CHECK_SECONDS,
+)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
     to_encode = data.copy()
@@ -155,8 +246,23 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
 
 
+async def get_current_user(authorization: Optional[str] = Header(None)) -> dict:
+    """Resolve the bearer token to a user record (served from the user cache)"""
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        username = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]).get("sub")
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token", headers={"WWW-Authenticate": "Bearer"})
+    user = await user_store.get_by_username(username) if username else None
+    if not user or not user.get("is_active", True):
+        raise HTTPException(status_code=401, detail="User not found or inactive")
+    return user
+
+
 def get_items_from_sql() -> List[dict]:
-    """Fetch items from SQL Server"""
+    """Fetch items from SQL Server (raises on failure so the cache keeps its last snapshot)"""
     try:
         # Customize this query based on your SQL Server schema
         query = f"""
@@ -181,22 +287,92 @@ def get_items_from_sql() -> List[dict]:
         return results
     except Exception as e:
         logger.error(f"Failed to fetch items from SQL Server: {e}")
-        return []
+        raise
 
 
-def get_stock_from_sql(item_ids: Optional[List[str]] = None) -> dict:
-    """Fetch stock levels from SQL Server"""
+def get_stock_from_sql() -> dict:
+    """Fetch stock levels from SQL Server (raises on failure so the cache keeps its last snapshot)"""
     try:
-        if item_ids:
-            ids_str = ",".join([f"'{id}'" for id in item_ids])
-            query = f"SELECT ItemID, Stock FROM {settings.STOCK_TABLE} WHERE ItemID IN ({ids_str})"
-        else:
-            query = f"SELECT ItemID, Stock FROM {settings.STOCK_TABLE}"
+        query = f"SELECT ItemID, Stock FROM {settings.STOCK_TABLE}"
         results = execute_query(query)
         return {str(r["ItemID"]): r["Stock"] for r in results}
     except Exception as e:
         logger.error(f"Failed to fetch stock from SQL Server: {e}")
+        raise
+
+
+erp_cache = ERPCache(
+    items_loader=get_items_from_sql,
+    stock_loader=get_stock_from_sql,
+    breaker=sql_breaker,
+    fallback_items=MOCK_ITEMS,
+    refresh_interval=settings.ERP_REFRESH_INTERVAL_SECONDS,
+    stale_after=settings.ERP_STALE_AFTER_SECONDS,
+    shared=SharedSnapshotFile(settings.CATALOG_SNAPSHOT_PATH) if settings.CATALOG_SNAPSHOT_PATH else None,
+    poll_interval=settings.CATALOG_SNAPSHOT_POLL_SECONDS,
+)
+
+
+def get_catalog(response: Optional[Response] = None) -> Union[ColumnarCatalog, MappedCatalog]:
+    """Get the current ERP snapshot, marking the response with its source and age"""
+    snapshot = erp_cache.snapshot
+    if response is not None:
+        response.headers["X-ERP-Source"] = erp_cache.source()
+        response.headers["X-ERP-Snapshot-Age"] = str(int(snapshot.age_seconds()))
+    return snapshot
+
+
+# Sessions, entries and reports (MongoDB or embedded SQLite, see storage.py)
+storage = open_storage(
+    settings.STORAGE_BACKEND,
+    get_db=get_mongodb,
+    path=settings.SQLITE_PATH,
+    activity_retention_days=settings.ACTIVITY_LOG_RETENTION_DAYS,
+)
+
+
+def get_storage():
+    """The configured storage, or None while it is not available"""
+    return storage if storage.available else None
+
+
+activity_log = ActivityLogger(
+    get_storage=get_storage,
+    flush_interval=settings.ACTIVITY_LOG_FLUSH_SECONDS,
+    batch_size=settings.ACTIVITY_LOG_BATCH_SIZE,
+    max_buffer=settings.ACTIVITY_LOG_MAX_BUFFER,
+)
+
+
+async def record_ingested_scans(scans: List[tuple], sessions: dict) -> dict:
+    """
+    Bookkeeping after a batch of scans was written: location progress,
+    analytics rollups and serial claims, each as one bulk write. These live
+    in MongoDB and are skipped without it.
+
+    scans are (stored entry with "id", scanned qty, scan time). Returns serial
+    conflicts by entry id.
+    """
+    db = get_mongodb()
+    if not db:
         return {}
+    await locations.record_scans(db, [
+        (entry["session_id"], qty, scan_variance_delta(entry, qty)) for entry, qty, _ in scans
+    ], sessions)
+    await rollups.record_scans(db, scans, sessions, erp_cache.snapshot)
+    return await register_serials(db, [entry for entry, _, _ in scans], sessions)
+
+
+async def invalidate_finished_summaries(store, session_ids, sessions: dict):
+    """Late entries (e.g. an offline device syncing) change the totals of an already finished session"""
+    for session_id in {str(s) for s in session_ids}:
+        if is_summary_status((sessions.get(session_id) or {}).get("status")):
+            await store.invalidate_session_summary(session_id)
+
+
+def apply_server_variances(entries: List[dict]) -> List[dict]:
+    """Recompute entry variances against current ERP stock and price (one batched lookup)"""
+    return recompute_variances(erp_cache.snapshot, entries, trust_catalog=erp_cache.source() != "mock")
 
 
 # ============== API ROUTES ==============
@@ -209,7 +385,34 @@ async def health_check():
         "timestamp": datetime.utcnow().isoformat(),
         "sql_connected": is_sql_connected(),
         "mongo_connected": is_mongo_connected(),
+        "erp_cache": erp_cache.status(),
+    }
+
+
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """
+    Readiness probe: 200 once storage is available (MongoDB connected or the
+    SQLite file open), users are seeded and the first catalog load has finished, 503 until then. The catalog counts as
+    ready even when the ERP is down and the fallback catalog is served;
+    `warm` tells whether it holds ERP data.
+    """
+    subsystems = {
+        "storage": {"ready": readiness["storage"] and get_storage() is not None, "backend": storage.name},
+        "mongo": {"ready": is_mongo_connected()},
+        "users": {"ready": readiness["users"]},
+        "catalog": {
+            "ready": erp_cache.warmed_up,
+            "warm": erp_cache.source() != "mock",
+            "source": erp_cache.source(),
+            "items": len(erp_cache.snapshot),
+        },
+        "sql": {"ready": is_sql_connected(), "circuit": sql_breaker.state},
     }
+    ready = all(subsystems[name]["ready"] for name in ("storage", "users", "catalog"))
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready, "subsystems": subsystems}
 
 
 @app.get("/api/health")
@@ -223,111 +426,81 @@ async def api_health_check():
 @app.post("/api/auth/login", response_model=Token)
 async def login(credentials: UserLogin):
     """User login"""
-    # Check mock users first
-    user_data = None
-    for u in MOCK_USERS:
-        if u["username"] == credentials.username:
-            if pwd_context.verify(credentials.password, u["password_hash"]):
-                user_data = u
-                break
+    user_data = await user_store.get_by_username(credentials.username)
+    if user_data:
+        # bcrypt is deliberately slow; keep it off the event loop
+        verified = await asyncio.to_thread(_verify_password, credentials.password, user_data["password_hash"])
+        if not verified:
+            user_data = None
 
     if not user_data:
+        activity_log.record("login_failed", "auth", details=f"Failed login for {credentials.username}")
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if not user_data.get("is_active", True):
+        activity_log.record("login_failed", "auth", user_id=user_data["id"], user_name=user_data["name"],
+                            details="Inactive user")
+        raise HTTPException(status_code=403, detail="User is inactive")
 
+    activity_log.record("login", "auth", user_id=user_data["id"], user_name=user_data["name"])
     access_token = create_access_token(data={"sub": user_data["username"]})
 
-    user = User(
-        id=user_data["id"],
-        username=user_data["username"],
-        name=user_data["name"],
-        role=user_data["role"],
-        is_active=user_data["is_active"],
-        created_at=datetime.utcnow(),
-    )
+    return Token(access_token=access_token, user=User(**user_data))
+
 
-    return Token(access_token=access_token, user=user)
+@app.get("/api/auth/me", response_model=User)
+async def get_me(user: dict = Depends(get_current_user)):
+    """Current user from the bearer token"""
+    return User(**user)
 
 
 # ------------ ERP ITEMS (SQL Server) ------------
 
 @app.get("/api/erp/items", response_model=List[Item])
 async def get_items(
+    response: Response,
     search: Optional[str] = None,
     category: Optional[str] = None,
     limit: int = Query(default=100, le=1000),
     offset: int = 0,
 ):
-    """Get items from ERP (SQL Server)"""
-    # Try SQL Server first
-    if is_sql_connected():
-        items = get_items_from_sql()
-    else:
-        items = MOCK_ITEMS
-
-    # Apply filters
-    if search:
-        search_lower = search.lower()
-        items = [i for i in items if search_lower in i.get("name", "").lower() or search_lower in i.get("barcode", "")]
-
-    if category:
-        items = [i for i in items if i.get("category", "").lower() == category.lower()]
-
-    # Apply pagination
-    items = items[offset:offset + limit]
-
-    return items
+    """Get items from ERP (SQL Server snapshot)"""
+    return get_catalog(response).search(search=search, category=category, limit=limit, offset=offset)
 
 
 @app.get("/api/erp/items/barcode/{barcode}", response_model=Item)
-async def get_item_by_barcode(barcode: str):
+async def get_item_by_barcode(barcode: str, response: Response):
     """Get item by barcode"""
-    if is_sql_connected():
-        items = get_items_from_sql()
-    else:
-        items = MOCK_ITEMS
-
-    for item in items:
-        if item.get("barcode") == barcode:
-            return item
+    item = get_catalog(response).get_by_barcode(barcode)
+    if item:
+        return item
 
     raise HTTPException(status_code=404, detail="Item not found")
 
 
 @app.get("/api/erp/items/{item_id}", response_model=Item)
-async def get_item_by_id(item_id: str):
+async def get_item_by_id(item_id: str, response: Response):
     """Get item by ID"""
-    if is_sql_connected():
-        items = get_items_from_sql()
-    else:
-        items = MOCK_ITEMS
-
-    for item in items:
-        if str(item.get("id")) == item_id:
-            return item
+    item = get_catalog(response).get_by_id(item_id)
+    if item:
+        return item
 
     raise HTTPException(status_code=404, detail="Item not found")
 
 
 @app.get("/api/erp/stock")
-async def get_stock_levels():
+async def get_stock_levels(response: Response):
     """Get all stock levels"""
-    if is_sql_connected():
-        return get_stock_from_sql()
-    else:
-        return {item["id"]: item["system_stock"] for item in MOCK_ITEMS}
+    return get_catalog(response).get_stock()
 
 
 @app.post("/api/erp/stock")
-async def get_stock_levels_for_items(data: dict):
+async def get_stock_levels_for_items(data: dict, response: Response):
     """Get stock levels for specific items"""
     item_ids = data.get("item_ids", [])
-    if is_sql_connected():
-        return get_stock_from_sql(item_ids)
-    else:
-        return {item["id"]: item["system_stock"] for item in MOCK_ITEMS if item["id"] in item_ids}
+    return get_catalog(response).get_stock(item_ids)
 
 
-# ------------ SESSIONS (MongoDB) ------------
+# ------------ SESSIONS ------------
 
 @app.get("/api/sessions", response_model=List[Session])
 async def get_sessions(
@@ -335,122 +508,140 @@ async def get_sessions(
     user_id: Optional[str] = None,
 ):
     """Get sessions"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         return []
 
-    query = {}
-    if status:
-        query["status"] = status
-    if user_id:
-        query["user_id"] = user_id
-
-    sessions = await db.sessions.find(query).sort("created_at", -1).to_list(100)
-
-    # Convert MongoDB _id to id
-    for s in sessions:
-        s["id"] = str(s.pop("_id"))
-
-    return sessions
+    return await store.list_sessions(status, user_id)
 
 
 @app.post("/api/sessions", response_model=Session)
 async def create_session(session_data: SessionCreate):
     """Create a new session"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         raise HTTPException(status_code=503, detail="Database not available")
 
-    session_dict = session_data.model_dump()
-    session_dict["created_at"] = datetime.utcnow()
-    session_dict["status"] = SessionStatus.ACTIVE
-    session_dict["total_scanned"] = 0
-    session_dict["total_verified"] = 0
-    session_dict["total_rejected"] = 0
-
-    result = await db.sessions.insert_one(session_dict)
-    session_dict["id"] = str(result.inserted_id)
-
+    session_dict = new_session_doc(session_data.model_dump(), datetime.utcnow())
+    session_dict["id"] = await store.create_session(session_dict)
+    db = get_mongodb()
+    if db:
+        await locations.record_session_status(db, session_dict, new_status=session_dict["status"], created=True)
+
+    activity_log.record(
+        "session_created", "session",
+        user_id=session_dict["user_id"], user_name=session_dict["user_name"],
+        details=f"{session_dict['location_type']} - Rack {session_dict['rack_no']}",
+        entity_id=session_dict["id"],
+    )
     return session_dict
 
 
 @app.get("/api/sessions/{session_id}", response_model=Session)
 async def get_session(session_id: str):
     """Get session by ID"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         raise HTTPException(status_code=503, detail="Database not available")
 
-    from bson import ObjectId
-    session = await db.sessions.find_one({"_id": ObjectId(session_id)})
+    session = await store.get_session(session_id)
 
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    session["id"] = str(session.pop("_id"))
     return session
 
 
 @app.patch("/api/sessions/{session_id}", response_model=Session)
 async def update_session(session_id: str, updates: SessionUpdate):
     """Update session"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         raise HTTPException(status_code=503, detail="Database not available")
 
-    from bson import ObjectId
     update_dict = {k: v for k, v in updates.model_dump().items() if v is not None}
 
-    result = await db.sessions.update_one(
-        {"_id": ObjectId(session_id)},
-        {"$set": update_dict}
-    )
+    before = await store.update_session(session_id, update_dict)
 
-    if result.matched_count == 0:
+    if before is None:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    session = await db.sessions.find_one({"_id": ObjectId(session_id)})
-    session["id"] = str(session.pop("_id"))
+    # Materialize totals once the session is finished; drop them if it is reopened
+    if "status" in update_dict:
+        db = get_mongodb()
+        if db:
+            await locations.record_session_status(db, before, old_status=before.get("status"), new_status=update_dict["status"])
+        if is_summary_status(update_dict["status"]):
+            await store.build_session_summary(session_id, update_dict["status"])
+        else:
+            await store.invalidate_session_summary(session_id)
+
+    session = {**before, **update_dict}
+    if "status" in update_dict:
+        status = getattr(update_dict["status"], "value", update_dict["status"])
+        activity_log.record(
+            f"session_{status}", "session",
+            user_id=updates.verified_by or session.get("user_id"),
+            user_name=None if updates.verified_by else session.get("user_name"),
+            details=updates.rejection_reason or updates.supervisor_remarks,
+            entity_id=session_id,
+        )
     return session
 
 
-# ------------ ENTRIES (MongoDB) ------------
+@app.get("/api/sessions/{session_id}/summary", response_model=SessionSummary)
+async def get_session_summary_report(session_id: str):
+    """Get the materialized summary of a finished session"""
+    store = get_storage()
+    if not store:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    summary = await store.get_session_summary(session_id)
+    if not summary:
+        raise HTTPException(status_code=404, detail="No summary: session not found or not finished")
+
+    return summary
+
+
+# ------------ ENTRIES ------------
 
 @app.get("/api/sessions/{session_id}/entries", response_model=List[Entry])
 async def get_entries(session_id: str):
     """Get entries for a session"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         return []
 
-    entries = await db.entries.find({"session_id": session_id}).sort("created_at", -1).to_list(1000)
-
-    for e in entries:
-        e["id"] = str(e.pop("_id"))
-
-    return entries
+    return await store.list_entries(session_id)
 
 
 @app.post("/api/entries", response_model=Entry)
 async def create_entry(entry_data: EntryCreate):
     """Create a new entry"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         raise HTTPException(status_code=503, detail="Database not available")
 
     entry_dict = entry_data.model_dump()
-    entry_dict["created_at"] = datetime.utcnow()
-    entry_dict["status"] = EntryStatus.PENDING
-    entry_dict["is_synced"] = True
+    await asyncio.to_thread(photo_store.externalize_photos, [entry_dict])
+    apply_server_variances([entry_dict])
+    now = datetime.utcnow()
+
+    sessions = await store.get_sessions([entry_data.session_id])
+    if is_aggregate_session(sessions, entry_data.session_id):
+        # Fold repeat scans into one entry per item and rack location
+        entry_dict = await store.merge_entry(entry_dict, now)
+    else:
+        entry_dict = new_entry_doc(entry_dict, now)
+        entry_dict["id"] = await store.insert_entry(entry_dict)
 
-    result = await db.entries.insert_one(entry_dict)
-    entry_dict["id"] = str(result.inserted_id)
+    await invalidate_finished_summaries(store, [entry_data.session_id], sessions)
+    conflicts = await record_ingested_scans([(entry_dict, entry_data.counted_qty, now)], sessions)
+    if conflicts:
+        entry_dict["serial_conflicts"] = (entry_dict.get("serial_conflicts") or []) + conflicts[entry_dict["id"]]
 
     # Update session counts
-    await db.sessions.update_one(
-        {"_id": entry_data.session_id},
-        {"$inc": {"total_scanned": 1}}
-    )
+    await store.increment_scanned(entry_data.session_id)
 
     return entry_dict
 
@@ -458,88 +649,268 @@ async def create_entry(entry_data: EntryCreate):
 @app.patch("/api/entries/{entry_id}", response_model=Entry)
 async def update_entry(entry_id: str, updates: EntryUpdate):
     """Update entry"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         raise HTTPException(status_code=503, detail="Database not available")
 
-    from bson import ObjectId
     update_dict = {k: v for k, v in updates.model_dump().items() if v is not None}
+    changed = sorted(update_dict)
     update_dict["updated_at"] = datetime.utcnow()
 
-    result = await db.entries.update_one(
-        {"_id": ObjectId(entry_id)},
-        {"$set": update_dict}
-    )
+    before = await store.update_entry(entry_id, update_dict)
 
-    if result.matched_count == 0:
+    if before is None:
         raise HTTPException(status_code=404, detail="Entry not found")
 
-    entry = await db.entries.find_one({"_id": ObjectId(entry_id)})
-    entry["id"] = str(entry.pop("_id"))
+    if "counted_qty" in update_dict:
+        # The variance follows the new count, against current ERP stock and price
+        recomputed = apply_server_variances([{**before, **update_dict}])[0]
+        variance_fields = {k: recomputed[k] for k in VARIANCE_FIELDS}
+        await store.update_entry(entry_id, variance_fields)
+        update_dict.update(variance_fields)
+
+    entry = {**before, **update_dict}
+    await store.invalidate_session_summary(entry["session_id"])
+    db = get_mongodb()
+    if db:
+        sessions = await store.get_sessions([entry["session_id"]])
+        session = sessions.get(str(entry["session_id"]))
+        await rollups.record_edit(db, before, entry, session, erp_cache.snapshot)
+        await locations.record_edit(db, before, entry, session)
+        # A rejected entry gives up its serials; reinstating it claims them again
+        was_rejected = before.get("status") == EntryStatus.REJECTED
+        if entry.get("status") == EntryStatus.REJECTED and not was_rejected:
+            await release_serials(db, entry_id)
+        elif was_rejected and entry.get("status") != EntryStatus.REJECTED:
+            await register_serials(db, [{**entry, "id": entry_id}], sessions)
+
+    status = getattr(updates.status, "value", None)
+    activity_log.record(
+        f"entry_{status}" if status else "entry_updated", "entry",
+        user_id=updates.verified_by,
+        details=f"{entry.get('item_name')} - {', '.join(changed)}",
+        entity_id=entry_id,
+        session_id=entry["session_id"],
+    )
     return entry
 
 
-# ------------ SYNC ------------
+# ------------ PHOTOS ------------
 
-@app.post("/api/sync/batch", response_model=BatchSyncResponse)
-async def batch_sync(request: BatchSyncRequest):
-    """Batch sync offline data"""
+photo_store = LocalBlobStore(settings.PHOTO_STORAGE_DIR)
+
+
+@app.post("/api/photos", status_code=201)
+async def upload_photo(request: Request):
+    """
+    Upload one photo as the raw request body.
+
+    The body is streamed to disk while it is hashed; identical photos are
+    stored once. Returns the reference to put in an entry's photos list.
+    """
+    try:
+        sha256, size, deduplicated = await photo_store.save_stream(request.stream(), settings.PHOTO_MAX_BYTES)
+    except BlobTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if size == 0:
+        raise HTTPException(status_code=400, detail="Empty photo")
+    return {"ref": photo_ref(sha256), "sha256": sha256, "size": size, "deduplicated": deduplicated}
+
+
+@app.get("/api/photos/{photo_id}")
+async def download_photo(photo_id: str, request: Request):
+    """Stream a stored photo by reference ("photo:<sha256>") or hash"""
+    sha256 = parse_photo_ref(photo_id)
+    if sha256 is None:
+        raise HTTPException(status_code=400, detail="Invalid photo reference")
+    etag = f'"{sha256}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    # The type is sniffed from the first bytes; keep the file read off the event loop
+    head = await asyncio.to_thread(photo_store.read_head, sha256)
+    if head is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    # Content never changes for a given hash
+    return FileResponse(
+        photo_store.path_for(sha256),
+        media_type=sniff_content_type(head),
+        headers={"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
+# ------------ SERIALS ------------
+
+@app.get("/api/serials/{serial}", response_model=List[SerialRecord])
+async def lookup_serial(
+    serial: str,
+    stock_take_id: Optional[str] = None,
+    item_id: Optional[str] = None,
+):
+    """Where a serial was counted, including duplicate counts on other entries"""
     db = get_mongodb()
     if not db:
         raise HTTPException(status_code=503, detail="Database not available")
 
-    results = []
-    successful = 0
-    failed = 0
+    return await find_serial(db, serial, stock_take_id=stock_take_id, item_id=item_id)
 
-    for op in request.operations:
-        try:
-            if op.type == "session":
-                # Create session
-                session_data = op.data
-                session_data["created_at"] = datetime.fromisoformat(op.timestamp.replace("Z", "+00:00"))
-                result = await db.sessions.insert_one(session_data)
-                results.append(SyncResult(
-                    offline_id=op.offline_id,
-                    server_id=str(result.inserted_id),
-                    success=True,
-                ))
-                successful += 1
-            elif op.type == "count_line":
-                # Create entry
-                entry_data = op.data
-                entry_data["created_at"] = datetime.fromisoformat(op.timestamp.replace("Z", "+00:00"))
-                entry_data["is_synced"] = True
-                result = await db.entries.insert_one(entry_data)
-                results.append(SyncResult(
-                    offline_id=op.offline_id,
-                    server_id=str(result.inserted_id),
-                    success=True,
-                ))
-                successful += 1
-            else:
-                results.append(SyncResult(
-                    offline_id=op.offline_id,
-                    success=False,
-                    message=f"Unknown operation type: {op.type}",
-                ))
-                failed += 1
-        except Exception as e:
+
+# ------------ SYNC ------------
+
+async def process_sync_operations(store, operations: List[SyncOperation], sessions: Optional[dict] = None) -> List[SyncResult]:
+    """
+    Apply a list of offline operations and return one result per operation.
+
+    sessions caches session id -> session and may be shared between
+    calls so that later chunks of a streamed sync see sessions created by
+    earlier ones.
+    """
+    results = []
+    result_index = {}  # server entry id -> index in results
+    scans = []  # (stored entry, scanned qty, scan time)
+
+    # Recompute variances for all count lines in one batched ERP lookup
+    count_lines = [op.data for op in operations if op.type == "count_line" and isinstance(op.data, dict)]
+    await asyncio.to_thread(photo_store.externalize_photos, count_lines)
+    apply_server_variances(count_lines)
+    if sessions is None:
+        sessions = {}
+    missing = [e.get("session_id") for e in count_lines if str(e.get("session_id")) not in sessions]
+    sessions.update(await store.get_sessions(missing))
+
+    # Known operations are written in one storage call (one transaction on SQLite)
+    writes, write_index = [], {}
+    for op in operations:
+        if op.type not in ("session", "count_line"):
             results.append(SyncResult(
                 offline_id=op.offline_id,
                 success=False,
-                message=str(e),
+                message=f"Unknown operation type: {op.type}",
             ))
-            failed += 1
+            continue
+        try:
+            scanned_at = datetime.fromisoformat(op.timestamp.replace("Z", "+00:00"))
+        except ValueError as e:
+            results.append(SyncResult(offline_id=op.offline_id, success=False, message=str(e)))
+            continue
+        write_index[len(writes)] = len(results)
+        writes.append({"type": op.type, "offline_id": op.offline_id, "data": op.data, "at": scanned_at})
+        results.append(None)
+
+    for i, written in enumerate(await store.ingest(writes, sessions)):
+        write, index = writes[i], write_index[i]
+        if "error" in written:
+            results[index] = SyncResult(offline_id=write["offline_id"], success=False, message=written["error"])
+            continue
+        results[index] = SyncResult(offline_id=write["offline_id"], server_id=written["id"], success=True)
+        if write["type"] == "count_line":
+            scans.append((written["stored"], write["data"].get("counted_qty") or 0, write["at"]))
+            result_index[written["id"]] = index
+        else:
+            db = get_mongodb()
+            if db:
+                session = written["stored"]
+                await locations.record_session_status(db, session, new_status=session["status"], created=True)
+
+    await invalidate_finished_summaries(store, [entry["session_id"] for entry, _, _ in scans], sessions)
+    # Progress, rollups and serial claims for the whole batch at once
+    conflicts = await record_ingested_scans(scans, sessions)
+    for entry_id, found in conflicts.items():
+        serials = ", ".join(c["serial"] for c in found)
+        results[result_index[entry_id]].message = f"Serial already counted elsewhere: {serials}"
+
+    return results
+
+
+@app.post("/api/sync/batch", response_model=BatchSyncResponse)
+async def batch_sync(request: BatchSyncRequest):
+    """Batch sync offline data"""
+    store = get_storage()
+    if not store:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    results = await process_sync_operations(store, request.operations)
+    successful = sum(1 for r in results if r.success)
+    activity_log.record(
+        "sync", "sync",
+        details=f"Batch sync: {successful}/{len(results)} operations applied",
+        total=len(results), successful=successful,
+    )
 
     return BatchSyncResponse(
         results=results,
         total=len(request.operations),
         successful=successful,
-        failed=failed,
+        failed=len(results) - successful,
     )
 
 
+sync_limiter = InflightLimiter(
+    max_streams=settings.SYNC_STREAM_MAX_CONCURRENT,
+    max_inflight_chunks=settings.SYNC_STREAM_MAX_INFLIGHT_CHUNKS,
+)
+
+
+@app.post("/api/sync/stream")
+async def stream_sync(request: Request):
+    """
+    Streaming sync for large offline backlogs.
+
+    The request body is NDJSON, one SyncOperation per line. The response is
+    NDJSON with one line per processed chunk ({"chunk", "results",
+    "successful", "failed"}) followed by a final {"done": true, ...} line.
+    """
+    store = get_storage()
+    if not store:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    async def results():
+        total = successful = 0
+        sessions: dict = {}
+        try:
+            chunks = iter_operation_chunks(
+                request.stream(),
+                chunk_size=settings.SYNC_STREAM_CHUNK_SIZE,
+                max_line_bytes=settings.SYNC_STREAM_MAX_LINE_BYTES,
+            )
+            chunk_no = 0
+            async for operations, failures in chunks:
+                async with sync_limiter.chunks:
+                    chunk_results = failures + await process_sync_operations(store, operations, sessions)
+                ok = sum(1 for r in chunk_results if r.success)
+                total += len(chunk_results)
+                successful += ok
+                yield json.dumps({
+                    "chunk": chunk_no,
+                    "results": [r.model_dump() for r in chunk_results],
+                    "successful": ok,
+                    "failed": len(chunk_results) - ok,
+                }) + "\n"
+                chunk_no += 1
+            yield json.dumps({"done": True, "total": total, "successful": successful, "failed": total - successful}) + "\n"
+        except LineTooLong as e:
+            yield json.dumps({"done": False, "error": str(e), "total": total, "successful": successful}) + "\n"
+        except RequestTooLarge as e:
+            yield json.dumps({"done": False, "error": e.detail, "total": total, "successful": successful}) + "\n"
+        except Exception:
+            # End the stream with a terminal record instead of cutting the response off
+            logger.exception("Streamed sync failed")
+            yield json.dumps({
+                "done": False,
+                "error": "Sync failed on the server; operations after the last reported chunk were not confirmed",
+                "total": total,
+                "successful": successful,
+            }) + "\n"
+        finally:
+            activity_log.record(
+                "sync", "sync",
+                details=f"Streamed sync: {successful}/{total} operations applied",
+                total=total, successful=successful,
+            )
+
+    # The upload slot is taken and released by the response itself, so it cannot leak
+    return RequestBodyStreamingResponse(results(), media_type="application/x-ndjson", limiter=sync_limiter)
+
+
 @app.get("/api/sync/status", response_model=SyncStatus)
 async def get_sync_status():
     """Get sync and connection status"""
@@ -548,6 +919,9 @@ async def get_sync_status():
         pending_count=0,
         erp_connected=is_sql_connected(),
         mongodb_connected=is_mongo_connected(),
+        erp_source=erp_cache.source(),
+        erp_snapshot_age_seconds=round(erp_cache.snapshot.age_seconds(), 1),
+        erp_circuit_state=sql_breaker.state,
     )
 
 
@@ -556,40 +930,31 @@ async def get_sync_status():
 @app.get("/api/users", response_model=List[User])
 async def get_users():
     """Get all users"""
-    users = []
-    for u in MOCK_USERS:
-        users.append(User(
-            id=u["id"],
-            username=u["username"],
-            name=u["name"],
-            role=u["role"],
-            is_active=u["is_active"],
-            created_at=datetime.utcnow(),
-        ))
-    return users
+    return [User(**u) for u in await user_store.list()]
 
 
 @app.post("/api/users", response_model=User)
 async def create_user(user_data: UserCreate):
     """Create a new user"""
-    new_user = {
-        "id": str(len(MOCK_USERS) + 1),
-        "username": user_data.username,
-        "name": user_data.name,
-        "role": user_data.role,
-        "is_active": user_data.is_active,
-        "password_hash": pwd_context.hash(user_data.password),
-    }
-    MOCK_USERS.append(new_user)
-
-    return User(
-        id=new_user["id"],
-        username=new_user["username"],
-        name=new_user["name"],
-        role=new_user["role"],
-        is_active=new_user["is_active"],
-        created_at=datetime.utcnow(),
-    )
+    new_user = user_data.model_dump(exclude={"password"})
+    new_user["password_hash"] = await asyncio.to_thread(_hash_password, user_data.password)
+    try:
+        user = await user_store.create(new_user)
+    except UsernameTaken:
+        raise HTTPException(status_code=409, detail="Username already exists")
+    return User(**user)
+
+
+@app.patch("/api/users/{user_id}", response_model=User)
+async def update_user(user_id: str, updates: UserUpdate):
+    """Update a user; the cached record is invalidated"""
+    update_dict = updates.model_dump(exclude={"password"}, exclude_none=True)
+    if updates.password:
+        update_dict["password_hash"] = await asyncio.to_thread(_hash_password, updates.password)
+    user = await user_store.update(user_id, update_dict)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return User(**user)
 
 
 # ------------ VARIANCE REPORTS ------------
@@ -597,8 +962,8 @@ async def create_user(user_data: UserCreate):
 @app.get("/api/variance/report", response_model=VarianceReport)
 async def get_variance_report(session_id: Optional[str] = None):
     """Get variance report"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         return VarianceReport(
             total_items=0,
             short_items=0,
@@ -607,25 +972,272 @@ async def get_variance_report(session_id: Optional[str] = None):
             total_variance_value=0,
         )
 
-    query = {}
     if session_id:
-        query["session_id"] = session_id
-
-    entries = await db.entries.find(query).to_list(10000)
-
-    total = len(entries)
-    short = len([e for e in entries if e.get("variance", 0) < 0])
-    over = len([e for e in entries if e.get("variance", 0) > 0])
-    matched = len([e for e in entries if e.get("variance", 0) == 0])
-    variance_value = sum(e.get("variance_value", 0) or 0 for e in entries)
-
-    return VarianceReport(
-        total_items=total,
-        short_items=short,
-        over_items=over,
-        matched_items=matched,
-        total_variance_value=variance_value,
+        # Finished sessions are served from their materialized summary
+        summary = await store.get_session_summary(session_id)
+        if summary:
+            return VarianceReport(
+                total_items=summary["total_items"],
+                short_items=summary["short_items"],
+                over_items=summary["over_items"],
+                matched_items=summary["matched_items"],
+                total_variance_value=summary["total_variance_value"],
+            )
+
+    return VarianceReport(**await store.variance_totals(session_id, limit=10000))
+
+
+# ------------ RECONCILIATION ------------
+
+reconciliation_results = ReconciliationStore(max_results=settings.RECONCILIATION_MAX_RESULTS)
+
+
+@app.post("/api/reconciliation/run", response_model=ReconciliationSummary)
+async def run_store_reconciliation(
+    stock_take_id: Optional[str] = None,
+    price_basis: PriceBasis = PriceBasis.MRP,
+):
+    """Reconcile all counted entries of a stock-take against ERP stock"""
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    result = await run_reconciliation(
+        db, erp_cache.snapshot, stock_take_id, price_basis, settings.RECONCILIATION_MAX_UNCOUNTED_LINES,
+    )
+    await reconciliation_results.add(db, result)
+    logger.info(f"Reconciliation {result.id}: {result.entries} entries in {result.duration_ms:.0f}ms")
+    return result.summary()
+
+
+@app.get("/api/reconciliation", response_model=List[ReconciliationSummary])
+async def list_reconciliations():
+    """List recent reconciliation results"""
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+    return await reconciliation_results.list(db)
+
+
+async def _get_reconciliation(db, result_id: str) -> ReconciliationSummary:
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+    summary = await reconciliation_results.get(db, result_id)
+    if not summary:
+        raise HTTPException(status_code=404, detail="Reconciliation result not found")
+    return summary
+
+
+@app.get("/api/reconciliation/{result_id}", response_model=ReconciliationSummary)
+async def get_reconciliation(result_id: str):
+    """Get a reconciliation summary"""
+    return await _get_reconciliation(get_mongodb(), result_id)
+
+
+@app.get("/api/reconciliation/{result_id}/lines", response_model=List[ReconciliationLine])
+async def get_reconciliation_lines(
+    result_id: str,
+    kind: ReconciliationKind = ReconciliationKind.SHORT,
+    category: Optional[str] = None,
+    limit: int = Query(default=100, le=1000),
+    offset: int = 0,
+):
+    """Get reconciliation lines of one kind, largest value impact first"""
+    db = get_mongodb()
+    await _get_reconciliation(db, result_id)
+    return await reconciliation_results.lines(db, result_id, kind, limit=limit, offset=offset, category=category)
+
+
+@app.get("/api/reconciliation/{result_id}/items/{item_id}", response_model=ReconciliationLine)
+async def get_reconciliation_item(result_id: str, item_id: str):
+    """Get the reconciliation line for one item (uncounted items only if their line was stored)"""
+    db = get_mongodb()
+    await _get_reconciliation(db, result_id)
+    line = await reconciliation_results.line_for(db, result_id, item_id)
+    if not line:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return line
+
+
+# ------------ BACKGROUND JOBS ------------
+
+job_manager = JobManager(
+    get_db=get_mongodb,
+    max_concurrency=settings.JOB_MAX_CONCURRENCY,
+    result_ttl=settings.JOB_RESULT_TTL_SECONDS,
+    lease_seconds=settings.JOB_LEASE_SECONDS,
+)
+
+EXPORT_FIELDS = [
+    "session_id", "item_id", "item_code", "item_name", "item_barcode", "location_in_rack",
+    "system_stock", "counted_qty", "variance", "variance_value", "status", "created_at",
+]
+
+
+async def variance_report_job(ctx, session_id: Optional[str] = None) -> dict:
+    report = VarianceReport(**await storage.variance_totals(session_id, ctx=ctx))
+    return report.model_dump()
+
+
+async def reconciliation_job(ctx, stock_take_id: Optional[str] = None, price_basis: str = PriceBasis.MRP.value) -> dict:
+    await ctx.report(0, message="loading entries", force=True)
+    db = get_mongodb()
+    result = await run_reconciliation(
+        db, erp_cache.snapshot, stock_take_id, PriceBasis(price_basis), settings.RECONCILIATION_MAX_UNCOUNTED_LINES,
     )
+    await ctx.report(0, message="saving lines", force=True)
+    await reconciliation_results.add(db, result)
+    return result.summary().model_dump(mode="json")
+
+
+def _remove_expired_exports():
+    cutoff = datetime.utcnow().timestamp() - settings.JOB_RESULT_TTL_SECONDS
+    for name in os.listdir(settings.EXPORT_DIR):
+        path = os.path.join(settings.EXPORT_DIR, name)
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+
+
+def _write_rows(path: str, rows: List[dict], header: bool):
+    with open(path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+        if header:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+async def entries_export_job(ctx, session_id: Optional[str] = None) -> dict:
+    db = get_mongodb()
+    os.makedirs(settings.EXPORT_DIR, exist_ok=True)
+    await asyncio.to_thread(_remove_expired_exports)
+
+    query = {"session_id": session_id} if session_id else {}
+    total = await db.entries.count_documents(query)
+    path = os.path.join(settings.EXPORT_DIR, f"{ctx.job_id}.csv")
+    projection = {field: 1 for field in EXPORT_FIELDS}
+    projection["_id"] = 0
+
+    written = 0
+    batch: List[dict] = []
+    async for e in db.entries.find(query, projection).batch_size(1000):
+        batch.append(e)
+        if len(batch) >= 1000:
+            await asyncio.to_thread(_write_rows, path, batch, written == 0)
+            written += len(batch)
+            batch = []
+            await ctx.report(written, total)
+    await asyncio.to_thread(_write_rows, path, batch, written == 0)
+    written += len(batch)
+    return {"rows": written, "file": os.path.basename(path)}
+
+
+async def adjustment_posting_job(ctx, stock_take_id: str) -> dict:
+    # Two postings submitted at the same moment both get past the endpoint check;
+    # the later one to start stops here
+    other = await job_manager.active("adjustment_posting", exclude=ctx.job_id, running_only=True)
+    if other:
+        raise RuntimeError(f"Adjustment posting {other['_id']} is already running")
+    return await post_adjustments(get_mongodb(), ctx.job_id, stock_take_id, ctx=ctx)
+
+
+job_manager.register("variance_report", variance_report_job)
+job_manager.register("adjustment_posting", adjustment_posting_job)
+job_manager.register("reconciliation", reconciliation_job)
+job_manager.register("entries_export", entries_export_job)
+
+
+def _job_response(job: dict) -> dict:
+    job["id"] = job.pop("_id")
+    return job
+
+
+async def _submit_job(job_type: str, params: dict) -> dict:
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+    return _job_response(await job_manager.submit(job_type, params))
+
+
+@app.post("/api/jobs/variance-report", response_model=Job, status_code=202)
+async def submit_variance_report_job(session_id: Optional[str] = None):
+    """Submit a variance report job; poll /api/jobs/{id} for the result"""
+    return await _submit_job("variance_report", {"session_id": session_id})
+
+
+@app.post("/api/jobs/reconciliation", response_model=Job, status_code=202)
+async def submit_reconciliation_job(
+    stock_take_id: Optional[str] = None,
+    price_basis: PriceBasis = PriceBasis.MRP,
+):
+    """Submit a store-wide reconciliation job"""
+    return await _submit_job("reconciliation", {"stock_take_id": stock_take_id, "price_basis": price_basis.value})
+
+
+@app.post("/api/jobs/entries-export", response_model=Job, status_code=202)
+async def submit_entries_export_job(session_id: Optional[str] = None):
+    """Submit a CSV export of entries; download from /api/jobs/{id}/download"""
+    return await _submit_job("entries_export", {"session_id": session_id})
+
+
+@app.post("/api/jobs/adjustment-posting", response_model=Job, status_code=202)
+async def submit_adjustment_posting_job(stock_take_id: str):
+    """Post a stock-take's per-item adjustments to the ERP; items already posted are skipped"""
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+    running = await job_manager.active("adjustment_posting")
+    if running:
+        raise HTTPException(status_code=409, detail=f"Adjustment posting {running['_id']} is still {running['status']}")
+    return await _submit_job("adjustment_posting", {"stock_take_id": stock_take_id})
+
+
+@app.get("/api/jobs", response_model=List[Job])
+async def list_jobs(
+    type: Optional[str] = None,
+    status: Optional[JobStatus] = None,
+    limit: int = Query(default=50, le=500),
+):
+    """List recent jobs (without results)"""
+    db = get_mongodb()
+    if not db:
+        return []
+    jobs = await job_manager.list(type, status.value if status else None, limit)
+    return [_job_response(j) for j in jobs]
+
+
+async def _get_job(job_id: str) -> dict:
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+    job = await job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/api/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: str):
+    """Poll a job's status, progress and result"""
+    return _job_response(await _get_job(job_id))
+
+
+@app.delete("/api/jobs/{job_id}", response_model=Job)
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job"""
+    await _get_job(job_id)
+    return _job_response(await job_manager.cancel(job_id))
+
+
+@app.get("/api/jobs/{job_id}/download")
+async def download_job_file(job_id: str):
+    """Download the file produced by an export job"""
+    job = await _get_job(job_id)
+    if job["status"] != JobStatus.SUCCEEDED or not (job.get("result") or {}).get("file"):
+        raise HTTPException(status_code=409, detail="Job has no file to download")
+    path = os.path.join(settings.EXPORT_DIR, job["result"]["file"])
+    if not os.path.exists(path):
+        raise HTTPException(status_code=410, detail="Export file has expired")
+    return FileResponse(path, media_type="text/csv", filename=f"entries-{job_id}.csv")
 
 
 # ------------ METRICS ------------
@@ -633,8 +1245,8 @@ async def get_variance_report(session_id: Optional[str] = None):
 @app.get("/api/metrics", response_model=Metrics)
 async def get_metrics():
     """Get system metrics"""
-    db = get_mongodb()
-    if not db:
+    store = get_storage()
+    if not store:
         return Metrics(
             total_sessions=0,
             active_sessions=0,
@@ -642,47 +1254,161 @@ async def get_metrics():
             accuracy_rate=0,
         )
 
-    total_sessions = await db.sessions.count_documents({})
-    active_sessions = await db.sessions.count_documents({"status": "active"})
-    total_entries = await db.entries.count_documents({})
-    matched_entries = await db.entries.count_documents({"variance": 0})
-
-    accuracy = (matched_entries / total_entries * 100) if total_entries > 0 else 0
+    counts = await store.metrics()
+    total_entries = counts["total_entries"]
+    accuracy = (counts["matched_entries"] / total_entries * 100) if total_entries > 0 else 0
 
     return Metrics(
-        total_sessions=total_sessions,
-        active_sessions=active_sessions,
+        total_sessions=counts["total_sessions"],
+        active_sessions=counts["active_sessions"],
         total_items_counted=total_entries,
         accuracy_rate=round(accuracy, 2),
     )
 
 
+@app.get("/api/metrics/rollups", response_model=List[RollupPoint])
+async def get_metric_rollups(
+    granularity: str = Query("hour", description="hour or day"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    group_by: Optional[str] = Query(None, description="user_id, location_type or category"),
+    user_id: Optional[str] = None,
+    location_type: Optional[str] = None,
+    category: Optional[str] = None,
+):
+    """Scan and accuracy series from the pre-aggregated hourly/daily rollups"""
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+    if granularity not in rollups.GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(rollups.GRANULARITIES)}")
+    if group_by is not None and group_by not in rollups.DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(rollups.DIMENSIONS)}")
+
+    until = until or datetime.utcnow()
+    since = since or until - timedelta(days=1 if granularity == "hour" else 30)
+    filters = {"user_id": user_id, "location_type": location_type, "category": category}
+    return await rollups.query_rollups(db, granularity, since, until, group_by, filters)
+
+
+@app.get("/api/debug/slow-requests")
+async def get_slow_requests(
+    limit: int = Query(20, ge=1, le=200),
+    path: Optional[str] = Query(None, description="Only requests whose path starts with this"),
+    x_debug_token: Optional[str] = Header(None),
+):
+    """
+    Slowest recent requests with their span breakdown.
+
+    Disabled unless DEBUG_ENDPOINTS_TOKEN is set, and then only served to
+    requests carrying it in X-Debug-Token. The peer address is not trusted:
+    behind ngrok every request arrives from localhost.
+    """
+    if not settings.DEBUG_ENDPOINTS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_debug_token or not hmac.compare_digest(x_debug_token, settings.DEBUG_ENDPOINTS_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+    return {
+        "slow_op_threshold_ms": settings.SLOW_OP_THRESHOLD_MS,
+        "requests": slowest_requests(limit, path),
+    }
+
+
+@app.get("/api/metrics/transport")
+async def get_transport_metrics():
+    """Get response/request compression counters (bytes saved)"""
+    return transport_stats.snapshot()
+
+
 # ------------ ACTIVITY LOGS ------------
 
-@app.get("/api/logs/activity")
+@app.get("/api/logs/activity", response_model=List[ActivityLog])
 async def get_activity_logs(
+    response: Response,
     user_id: Optional[str] = None,
     action: Optional[str] = None,
-    limit: int = 50,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    before: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
+    limit: int = Query(50, ge=1, le=500),
 ):
-    """Get activity logs"""
-    # Return mock logs for now
-    return []
+    """
+    Get activity logs, newest first.
+
+    When more logs match, the cursor for the next page is returned in the
+    X-Next-Cursor header; pass it back as `before`.
+    """
+    if not get_storage():
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    try:
+        logs, next_cursor = await activity_log.query(
+            user_id=user_id, action=action, since=since, until=until, before=before, limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return logs
 
 
 # ------------ RACKS ------------
 
+def _location_node(node: dict) -> dict:
+    node["id"] = node.pop("_id")
+    return node
+
+
 @app.get("/api/racks")
 async def get_racks(location: Optional[str] = None):
-    """Get racks"""
-    racks = [
-        {"id": "1", "name": "R001", "location": "showroom"},
-        {"id": "2", "name": "R002", "location": "showroom"},
-        {"id": "3", "name": "R003", "location": "godown"},
+    """Get racks, with counting progress"""
+    db = get_mongodb()
+    if db:
+        racks = await locations.get_racks(db, location)
+    else:
+        # No location hierarchy (e.g. SQLite storage): racks named by sessions
+        store = get_storage()
+        if not store:
+            raise HTTPException(status_code=503, detail="Database not available")
+        racks = locations.racks_from_sessions(await store.session_rack_counts(location))
+    return [
+        {**_location_node(r), "name": r["rack_no"], "location": r["location_type"]}
+        for r in racks
     ]
-    if location:
-        racks = [r for r in racks if r["location"] == location]
-    return racks
+
+
+@app.post("/api/locations/racks")
+async def register_racks(racks: List[RackRegistration]):
+    """Register racks ahead of counting so they show up as left to count"""
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    created = await locations.register_racks(db, [r.model_dump() for r in racks])
+    return {"registered": created, "existing": len(racks) - created}
+
+
+@app.get("/api/locations", response_model=List[LocationNode])
+async def get_location_children(parent_id: Optional[str] = None):
+    """Children of a location node with their rollups (top-level locations by default)"""
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    return [_location_node(n) for n in await locations.get_children(db, parent_id)]
+
+
+@app.get("/api/locations/remaining", response_model=List[LocationNode])
+async def get_remaining_racks(
+    node_id: Optional[str] = Query(None, description="Location node path, e.g. showroom/floor=1"),
+    limit: int = Query(500, ge=1, le=5000),
+):
+    """Racks under a node that have not been counted yet"""
+    db = get_mongodb()
+    if not db:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    return [_location_node(n) for n in await locations.get_remaining_racks(db, node_id, limit)]
 
 
 # ============== MAIN ==============
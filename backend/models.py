@@ -29,6 +29,19 @@ class EntryStatus(str, Enum):
     RECOUNT_REQUIRED = "recount_required"
 
 
+class CountMode(str, Enum):
+    INDIVIDUAL = "individual"  # one entry per scan
+    AGGREGATE = "aggregate"    # one entry per item and rack location, incremented per scan
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
 class LocationType(str, Enum):
     SHOWROOM = "showroom"
     GODOWN = "godown"
@@ -62,6 +75,13 @@ class User(UserBase):
         from_attributes = True
 
 
+class UserUpdate(BaseModel):
+    name: Optional[str] = None
+    role: Optional[UserRole] = None
+    is_active: Optional[bool] = None
+    password: Optional[str] = None
+
+
 class UserLogin(BaseModel):
     username: str
     password: str
@@ -107,6 +127,8 @@ class SessionCreate(BaseModel):
     floor: Optional[str] = None
     area: Optional[str] = None
     rack_no: str
+    stock_take_id: Optional[str] = None
+    count_mode: CountMode = CountMode.INDIVIDUAL
 
 
 class Session(BaseModel):
@@ -117,6 +139,8 @@ class Session(BaseModel):
     floor: Optional[str] = None
     area: Optional[str] = None
     rack_no: str
+    stock_take_id: Optional[str] = None
+    count_mode: CountMode = CountMode.INDIVIDUAL
     created_at: datetime
     status: SessionStatus = SessionStatus.ACTIVE
     total_scanned: int = 0
@@ -146,6 +170,13 @@ class BatchInfo(BaseModel):
     damage_qty: int = 0
 
 
+class ScanRecord(BaseModel):
+    qty: int
+    at: datetime
+    serial_numbers: Optional[List[str]] = None
+    damage_qty: int = 0
+
+
 class DamageEntry(BaseModel):
     quantity: int
     category: DamageCategory
@@ -181,9 +212,44 @@ class EntryCreate(BaseModel):
     is_multi_location: bool = False
 
 
+class SerialClaim(BaseModel):
+    entry_id: str
+    session_id: str
+    location_in_rack: Optional[str] = None
+    counted_at: Optional[datetime] = None
+
+
+class SerialConflict(SerialClaim):
+    serial: str
+
+
+class SerialRecord(BaseModel):
+    serial: str
+    stock_take_id: Optional[str] = None
+    item_id: str
+    entry_id: str
+    session_id: str
+    location_in_rack: Optional[str] = None
+    counted_at: datetime
+    duplicates: List[SerialClaim] = []
+
+
 class Entry(EntryCreate):
     id: str
     created_at: datetime
+    # Values as computed on the device, kept for audit; the top-level
+    # system_stock/variance/variance_value are recomputed by the server
+    device_system_stock: Optional[int] = None
+    device_variance: Optional[int] = None
+    device_variance_value: Optional[float] = None
+    variance_source: Optional[str] = None  # 'erp' or 'device'
+    variance_price: Optional[float] = None
+    # Aggregate counting mode
+    aggregate: bool = False
+    scan_count: Optional[int] = None
+    scan_log: Optional[List[ScanRecord]] = None
+    # Serials already counted on another entry in the same stock take
+    serial_conflicts: Optional[List[SerialConflict]] = None
     updated_at: Optional[datetime] = None
     status: EntryStatus = EntryStatus.PENDING
     verified_by: Optional[str] = None
@@ -193,8 +259,8 @@ class Entry(EntryCreate):
 
 
 class EntryUpdate(BaseModel):
+    # variance is recomputed by the server when counted_qty changes
     counted_qty: Optional[int] = None
-    variance: Optional[int] = None
     status: Optional[EntryStatus] = None
     verified_by: Optional[str] = None
     verified_at: Optional[datetime] = None
@@ -202,6 +268,47 @@ class EntryUpdate(BaseModel):
     recount_assigned_to: Optional[str] = None
 
 
+# Location Models
+class RackRegistration(BaseModel):
+    location_type: LocationType
+    floor: Optional[str] = None
+    area: Optional[str] = None
+    rack_no: str
+
+
+class LocationNode(BaseModel):
+    id: str  # path, e.g. "showroom/floor=1/area=A/rack=R001"
+    level: str  # 'location', 'floor', 'area' or 'rack'
+    name: str
+    parent_id: Optional[str] = None
+    location_type: str
+    floor: Optional[str] = None
+    area: Optional[str] = None
+    rack_no: Optional[str] = None
+    sessions_open: int = 0
+    sessions_total: int = 0
+    sessions_done: int = 0
+    racks_total: int = 0
+    racks_counted: int = 0
+    items_scanned: int = 0
+    counted_qty: int = 0
+    variance_value: float = 0
+    updated_at: Optional[datetime] = None
+
+
+# Activity Log Models
+class ActivityLog(BaseModel):
+    id: str
+    timestamp: datetime
+    action: str
+    type: str  # 'auth', 'session', 'entry' or 'sync'
+    user_id: Optional[str] = None
+    user_name: Optional[str] = None
+    details: Optional[str] = None
+    entity_id: Optional[str] = None
+    meta: Optional[Dict[str, Any]] = None
+
+
 # Sync Models
 class SyncOperation(BaseModel):
     type: str  # 'session' or 'count_line'
@@ -233,6 +340,9 @@ class SyncStatus(BaseModel):
     pending_count: int = 0
     erp_connected: bool
     mongodb_connected: bool
+    erp_source: Optional[str] = None  # 'erp', 'stale' or 'mock'
+    erp_snapshot_age_seconds: Optional[float] = None
+    erp_circuit_state: Optional[str] = None
 
 
 # Variance Report
@@ -244,9 +354,124 @@ class VarianceReport(BaseModel):
     total_variance_value: float
 
 
+# Session Summary (materialized for finished sessions)
+class TopVarianceItem(BaseModel):
+    entry_id: str
+    item_id: str
+    item_name: Optional[str] = None
+    counted_qty: Optional[int] = None
+    system_stock: Optional[int] = None
+    variance: int
+    variance_value: Optional[float] = None
+
+
+class SessionSummary(BaseModel):
+    session_id: str
+    session_status: SessionStatus
+    built_at: datetime
+    total_items: int
+    short_items: int
+    over_items: int
+    matched_items: int
+    total_counted_qty: int
+    short_value: float
+    over_value: float
+    total_variance_value: float
+    top_variance_items: List[TopVarianceItem]
+
+
+# Reconciliation
+class PriceBasis(str, Enum):
+    MRP = "mrp"
+    SALE_PRICE = "sale_price"
+
+
+class ReconciliationKind(str, Enum):
+    SHORT = "short"
+    EXCESS = "excess"
+    MATCHED = "matched"
+    UNCOUNTED = "uncounted"
+    UNKNOWN = "unknown"  # counted but not in the ERP catalog
+
+
+class ReconciliationSummary(BaseModel):
+    id: str
+    stock_take_id: Optional[str] = None
+    price_basis: PriceBasis
+    created_at: datetime
+    duration_ms: float
+    catalog_items: int
+    entries: int
+    counted_items: int
+    short_items: int
+    excess_items: int
+    matched_items: int
+    uncounted_items: int
+    uncounted_lines: int = 0  # uncounted items stored as lines (largest value first)
+    unknown_items: int
+    short_qty: int
+    excess_qty: int
+    short_value: float
+    excess_value: float
+    net_variance_value: float
+    uncounted_value: float
+
+
+class ReconciliationLine(BaseModel):
+    item_id: str
+    item_code: Optional[str] = None
+    name: Optional[str] = None
+    category: Optional[str] = None
+    system_stock: int
+    counted_qty: int
+    variance: int
+    price: float
+    variance_value: float
+    locations: int
+
+
+# Background Jobs
+class JobProgress(BaseModel):
+    done: int = 0
+    total: Optional[int] = None
+    message: Optional[str] = None
+    updated_at: Optional[datetime] = None
+
+
+class Job(BaseModel):
+    id: str
+    type: str
+    status: JobStatus
+    params: Dict[str, Any] = {}
+    submitted_by: Optional[str] = None
+    progress: JobProgress = JobProgress()
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    cancel_requested: bool = False
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+
+
 # Metrics
 class Metrics(BaseModel):
     total_sessions: int
     active_sessions: int
     total_items_counted: int
     accuracy_rate: float
+
+
+class RollupPoint(BaseModel):
+    bucket: datetime
+    group: Optional[str] = None  # value of the group_by dimension
+    scans: int = 0
+    entries: int = 0
+    matched: int = 0
+    short: int = 0
+    over: int = 0
+    counted_qty: int = 0
+    variance_value: float = 0
+    verified: int = 0
+    rejected: int = 0
+    accuracy_rate: Optional[float] = None
@@ -0,0 +1,278 @@
+"""
+Store-wide stock reconciliation
+
+Loads every counted entry of a stock-take and the full ERP catalog into
+NumPy arrays, then works out per-item counted quantity, shortage, excess,
+uncounted items and value impact in a handful of vectorized passes. Unlike
+the variance report this does not trust device-computed variances and also
+sees items nobody counted.
+
+Results are persisted so any worker can serve them: the summary in
+`reconciliations` and one document per line in `reconciliation_lines`,
+ranked by value impact within its kind. Lines are written before the
+summary, so a result is listed only once it is complete. The newest
+RECONCILIATION_MAX_RESULTS results are kept. Uncounted items are always in
+the summary totals, but mid-count they are most of the catalog, so only the
+RECONCILIATION_MAX_UNCOUNTED_LINES with the largest value at stake are
+stored as lines.
+"""
+import asyncio
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from catalog_store import ColumnarCatalog
+from models import (
+    EntryStatus, PriceBasis, ReconciliationKind, ReconciliationLine, ReconciliationSummary,
+)
+
+ENTRY_PROJECTION = {"_id": 0, "item_id": 1, "counted_qty": 1, "session_id": 1}
+ENTRY_BATCH_SIZE = 10000
+LINE_BATCH_SIZE = 10000
+LINE_PROJECTION = {"_id": 0, "result_id": 0, "kind": 0, "rank": 0, "category_key": 0}
+
+
+def _factorize(values: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Map values to dense integer codes; returns (uniques, codes)"""
+    lookup: Dict[str, int] = {}
+    codes = np.fromiter((lookup.setdefault(v, len(lookup)) for v in values), dtype=np.int64, count=len(values))
+    return list(lookup), codes
+
+
+async def load_entries(db, stock_take_id: Optional[str] = None) -> Tuple[List[str], np.ndarray, List[str]]:
+    """Fetch (item_id, counted_qty, session_id) columns for all non-rejected entries of a stock-take"""
+    query = {"status": {"$ne": EntryStatus.REJECTED}}
+    if stock_take_id:
+        sessions = await db.sessions.find({"stock_take_id": stock_take_id}, {"_id": 1}).to_list(None)
+        query["session_id"] = {"$in": [str(s["_id"]) for s in sessions]}
+
+    item_ids: List[str] = []
+    quantities: List[int] = []
+    session_ids: List[str] = []
+    cursor = db.entries.find(query, ENTRY_PROJECTION).batch_size(ENTRY_BATCH_SIZE)
+    async for e in cursor:
+        item_ids.append(str(e.get("item_id")))
+        quantities.append(e.get("counted_qty") or 0)
+        session_ids.append(str(e.get("session_id")))
+    return item_ids, np.asarray(quantities, dtype=np.int64), session_ids
+
+
+class ReconciliationResult:
+    """Per-item reconciliation arrays for one run, aligned to catalog rows"""
+
+    def __init__(
+        self,
+        catalog: ColumnarCatalog,
+        item_ids: List[str],
+        counted_qty: np.ndarray,
+        session_ids: List[str],
+        price_basis: PriceBasis = PriceBasis.MRP,
+        stock_take_id: Optional[str] = None,
+        max_uncounted_lines: Optional[int] = None,
+    ):
+        started = time.perf_counter()
+        self.id = uuid.uuid4().hex
+        self.stock_take_id = stock_take_id
+        self.max_uncounted_lines = max_uncounted_lines
+        self.price_basis = price_basis
+        self.created_at = datetime.utcnow()
+        self.catalog = catalog
+        self.entries = len(item_ids)
+        n = len(catalog)
+
+        unique_ids, id_codes = _factorize(item_ids)
+        unique_rows = catalog.rows_of(unique_ids)
+        entry_rows = unique_rows[id_codes] if len(id_codes) else np.empty(0, dtype=np.int64)
+        known = entry_rows >= 0
+
+        # Aggregate counts across sessions, racks and locations
+        self.counted = np.bincount(entry_rows[known], weights=counted_qty[known], minlength=n).astype(np.int64)
+        self.counted_mask = np.zeros(n, dtype=np.bool_)
+        self.counted_mask[entry_rows[known]] = True
+
+        # Number of distinct sessions (rack/location visits) each item was counted in
+        _, session_codes = _factorize(session_ids)
+        n_sessions = max(int(session_codes.max()) + 1, 1) if len(session_codes) else 1
+        pairs = np.unique(entry_rows[known] * n_sessions + session_codes[known])
+        self.locations = np.bincount(pairs // n_sessions, minlength=n).astype(np.int64)
+
+        self.system = catalog.stock_levels()
+        self.price = catalog.numeric[price_basis.value]
+        self.variance = np.where(self.counted_mask, self.counted - self.system, -self.system)
+        self.value = self.variance * self.price
+
+        self.short_mask = self.counted_mask & (self.variance < 0)
+        self.excess_mask = self.counted_mask & (self.variance > 0)
+        self.matched_mask = self.counted_mask & (self.variance == 0)
+
+        # Counted items the ERP does not know about
+        unknown_qty = np.bincount(id_codes[~known], weights=counted_qty[~known], minlength=len(unique_ids))
+        unknown_codes = np.flatnonzero(unique_rows < 0)
+        self.unknown_ids = [unique_ids[c] for c in unknown_codes]
+        self.unknown_qty = unknown_qty[unknown_codes].astype(np.int64)
+
+        self.duration_ms = (time.perf_counter() - started) * 1000
+
+    def summary(self) -> ReconciliationSummary:
+        uncounted = ~self.counted_mask
+        return ReconciliationSummary(
+            id=self.id,
+            stock_take_id=self.stock_take_id,
+            price_basis=self.price_basis,
+            created_at=self.created_at,
+            duration_ms=round(self.duration_ms, 2),
+            catalog_items=len(self.catalog),
+            entries=self.entries,
+            counted_items=int(self.counted_mask.sum()),
+            short_items=int(self.short_mask.sum()),
+            excess_items=int(self.excess_mask.sum()),
+            matched_items=int(self.matched_mask.sum()),
+            uncounted_items=int(uncounted.sum()),
+            uncounted_lines=self._uncounted_lines(int(uncounted.sum())),
+            unknown_items=len(self.unknown_ids),
+            short_qty=int(-self.variance[self.short_mask].sum()),
+            excess_qty=int(self.variance[self.excess_mask].sum()),
+            short_value=float(self.value[self.short_mask].sum()),
+            excess_value=float(self.value[self.excess_mask].sum()),
+            net_variance_value=float(self.value[self.counted_mask].sum()),
+            uncounted_value=float((self.system[uncounted] * self.price[uncounted]).sum()),
+        )
+
+    def _uncounted_lines(self, uncounted: int) -> int:
+        return uncounted if self.max_uncounted_lines is None else min(uncounted, self.max_uncounted_lines)
+
+    def line_docs(self) -> Iterator[dict]:
+        """
+        Lines as documents for reconciliation_lines, ranked within their kind
+        by value impact (uncounted lines capped at max_uncounted_lines)
+        """
+        text = self.catalog.text
+        categories = self.catalog.coded["category"]
+        masks = {
+            ReconciliationKind.SHORT: self.short_mask,
+            ReconciliationKind.EXCESS: self.excess_mask,
+            ReconciliationKind.MATCHED: self.matched_mask,
+            ReconciliationKind.UNCOUNTED: ~self.counted_mask,
+        }
+        for kind, mask in masks.items():
+            rows = np.flatnonzero(mask)
+            rows = rows[np.argsort(-np.abs(self.value[rows]), kind="stable")]
+            if kind == ReconciliationKind.UNCOUNTED:
+                rows = rows[:self._uncounted_lines(len(rows))]
+            columns = zip(
+                rows.tolist(), self.system[rows].tolist(), self.counted[rows].tolist(),
+                self.variance[rows].tolist(), self.price[rows].tolist(), self.value[rows].tolist(),
+                self.locations[rows].tolist(),
+            )
+            for rank, (row, system, counted, variance, price, value, locations) in enumerate(columns):
+                category = categories[row]
+                yield {
+                    "result_id": self.id,
+                    "kind": kind.value,
+                    "rank": rank,
+                    "category_key": category.lower() if category else None,
+                    "item_id": text["id"][row],
+                    "item_code": text["item_code"][row] or None,
+                    "name": text["name"][row] or None,
+                    "category": category,
+                    "system_stock": system,
+                    "counted_qty": counted,
+                    "variance": variance,
+                    "price": price,
+                    "variance_value": value,
+                    "locations": locations,
+                }
+
+        order = np.argsort(-self.unknown_qty, kind="stable")
+        for rank, i in enumerate(order.tolist()):
+            qty = int(self.unknown_qty[i])
+            yield {
+                "result_id": self.id,
+                "kind": ReconciliationKind.UNKNOWN.value,
+                "rank": rank,
+                "category_key": None,
+                "item_id": self.unknown_ids[i],
+                "system_stock": 0,
+                "counted_qty": qty,
+                "variance": qty,
+                "price": 0.0,
+                "variance_value": 0.0,
+                "locations": 0,
+            }
+
+
+class ReconciliationStore:
+    """Reconciliation results persisted in MongoDB, shared by all workers"""
+
+    def __init__(self, max_results: int):
+        self.max_results = max_results
+
+    async def add(self, db, result: ReconciliationResult):
+        docs = await asyncio.to_thread(lambda: list(result.line_docs()))
+        for start in range(0, len(docs), LINE_BATCH_SIZE):
+            await db.reconciliation_lines.insert_many(docs[start:start + LINE_BATCH_SIZE], ordered=False)
+        summary = result.summary().model_dump()
+        summary["_id"] = summary.pop("id")
+        summary["price_basis"] = result.price_basis.value
+        await db.reconciliations.insert_one(summary)
+        await self._prune(db)
+
+    async def _prune(self, db):
+        old = await db.reconciliations.find({}, {"_id": 1}).sort("created_at", -1).skip(self.max_results).to_list(None)
+        if old:
+            ids = [r["_id"] for r in old]
+            await db.reconciliations.delete_many({"_id": {"$in": ids}})
+            await db.reconciliation_lines.delete_many({"result_id": {"$in": ids}})
+
+    async def get(self, db, result_id: str) -> Optional[ReconciliationSummary]:
+        doc = await db.reconciliations.find_one({"_id": result_id})
+        if not doc:
+            return None
+        doc["id"] = doc.pop("_id")
+        return ReconciliationSummary(**doc)
+
+    async def list(self, db) -> List[ReconciliationSummary]:
+        docs = await db.reconciliations.find().sort("created_at", -1).to_list(self.max_results)
+        return [ReconciliationSummary(id=d.pop("_id"), **d) for d in docs]
+
+    async def lines(
+        self,
+        db,
+        result_id: str,
+        kind: ReconciliationKind,
+        limit: int = 100,
+        offset: int = 0,
+        category: Optional[str] = None,
+    ) -> List[ReconciliationLine]:
+        """Lines of one kind, largest value impact first"""
+        query = {"result_id": result_id, "kind": kind.value}
+        if category:
+            query["category_key"] = category.lower()
+        cursor = db.reconciliation_lines.find(query, LINE_PROJECTION).sort("rank", 1).skip(offset).limit(limit)
+        return [ReconciliationLine(**d) for d in await cursor.to_list(limit)]
+
+    async def line_for(self, db, result_id: str, item_id: str) -> Optional[ReconciliationLine]:
+        doc = await db.reconciliation_lines.find_one(
+            {"result_id": result_id, "item_id": item_id, "kind": {"$ne": ReconciliationKind.UNKNOWN.value}},
+            LINE_PROJECTION,
+        )
+        return ReconciliationLine(**doc) if doc else None
+
+
+async def run_reconciliation(
+    db,
+    catalog,
+    stock_take_id: Optional[str] = None,
+    price_basis: PriceBasis = PriceBasis.MRP,
+    max_uncounted_lines: Optional[int] = None,
+) -> ReconciliationResult:
+    """Load entries for a stock-take and reconcile them against the catalog"""
+    columnar = await asyncio.to_thread(catalog.to_columnar)
+    item_ids, counted_qty, session_ids = await load_entries(db, stock_take_id)
+    return await asyncio.to_thread(
+        ReconciliationResult, columnar, item_ids, counted_qty, session_ids, price_basis, stock_take_id,
+        max_uncounted_lines,
+    )
@@ -0,0 +1,177 @@
+"""
+Time-bucketed analytics rollups
+
+Every scan and entry edit increments one hourly and one daily document in
+`entry_rollups`, per (user_id, location_type, category). Counters:
+
+- scans: scans ingested; entries: new entries created
+- matched / short / over: entries by variance sign. A rescan in aggregate
+  mode or an edit that changes the variance moves the entry between these
+  (-1 old, +1 new), so the counters are exact when summed over a range
+- counted_qty, variance_value: net changes
+- verified / rejected: entry review outcomes
+
+Scans are bucketed by scan time; edits go to the bucket of the edited
+entry's creation, so corrections show up where the count happened. A
+dashboard query reads only the bucket documents in its time range.
+"""
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from entry_merge import scan_variance_delta
+from models import EntryStatus
+
+GRANULARITIES = ("hour", "day")
+DIMENSIONS = ("user_id", "location_type", "category")
+COUNTERS = (
+    "scans", "entries", "matched", "short", "over",
+    "counted_qty", "variance_value", "verified", "rejected",
+)
+
+
+def bucket_start(at: datetime, granularity: str) -> datetime:
+    at = at.replace(tzinfo=None, minute=0, second=0, microsecond=0)
+    return at.replace(hour=0) if granularity == "day" else at
+
+
+def variance_class(variance) -> str:
+    variance = variance or 0
+    if variance < 0:
+        return "short"
+    return "over" if variance > 0 else "matched"
+
+
+def _reclassify(inc: Dict[str, float], old_variance, new_variance):
+    old, new = variance_class(old_variance), variance_class(new_variance)
+    if old != new:
+        inc[old] -= 1
+        inc[new] += 1
+
+
+def scan_increments(entry: dict, qty: int) -> Dict[str, float]:
+    """Counter changes for one scan stored as `entry` (an individual or merged aggregate entry)"""
+    inc: Dict[str, float] = defaultdict(float)
+    inc["scans"] = 1
+    inc["counted_qty"] = qty or 0
+    inc["variance_value"] = scan_variance_delta(entry, qty or 0)
+    if (entry.get("scan_count") or 1) <= 1:
+        inc["entries"] = 1
+        inc[variance_class(entry.get("variance"))] += 1
+    else:
+        variance = entry.get("variance") or 0
+        _reclassify(inc, variance - (qty or 0), variance)
+    return inc
+
+
+def edit_increments(before: dict, after: dict) -> Dict[str, float]:
+    """Counter changes for an entry edit"""
+    inc: Dict[str, float] = defaultdict(float)
+    inc["counted_qty"] = (after.get("counted_qty") or 0) - (before.get("counted_qty") or 0)
+    inc["variance_value"] = (after.get("variance_value") or 0) - (before.get("variance_value") or 0)
+    _reclassify(inc, before.get("variance"), after.get("variance"))
+    for status in (EntryStatus.VERIFIED.value, EntryStatus.REJECTED.value):
+        was = getattr(before.get("status"), "value", before.get("status")) == status
+        now = getattr(after.get("status"), "value", after.get("status")) == status
+        inc[status] += int(now) - int(was)
+    return inc
+
+
+class RollupBatch:
+    """Collects increments and writes them as one bulk upsert"""
+
+    def __init__(self):
+        self._inc: Dict[Tuple, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def add(self, at: datetime, dims: Dict[str, Optional[str]], inc: Dict[str, float]):
+        dim_values = tuple(None if dims.get(d) is None else str(getattr(dims.get(d), "value", dims.get(d))) for d in DIMENSIONS)
+        for granularity in GRANULARITIES:
+            totals = self._inc[(granularity, bucket_start(at, granularity)) + dim_values]
+            for counter, value in inc.items():
+                totals[counter] += value
+
+    def __len__(self):
+        return len(self._inc)
+
+    def operations(self) -> List[UpdateOne]:
+        ops = []
+        for key, totals in self._inc.items():
+            granularity, bucket, *dim_values = key
+            inc = {k: v for k, v in totals.items() if v}
+            if not inc:
+                continue
+            doc_id = ":".join([granularity, bucket.strftime("%Y-%m-%dT%H")] + [v or "-" for v in dim_values])
+            on_insert = {"granularity": granularity, "bucket": bucket, **dict(zip(DIMENSIONS, dim_values))}
+            ops.append(UpdateOne({"_id": doc_id}, {"$setOnInsert": on_insert, "$inc": inc}, upsert=True))
+        return ops
+
+    async def write(self, db):
+        ops = self.operations()
+        if ops:
+            await db.entry_rollups.bulk_write(ops, ordered=False)
+
+
+def entry_dimensions(entry: dict, session: Optional[dict], catalog) -> Dict[str, Optional[str]]:
+    item = catalog.get_by_id(entry.get("item_id")) if entry.get("item_id") else None
+    session = session or {}
+    return {
+        "user_id": session.get("user_id"),
+        "location_type": session.get("location_type"),
+        "category": (item or {}).get("category"),
+    }
+
+
+async def record_scans(db, scans: Iterable[Tuple[dict, int, datetime]], sessions: Dict[str, dict], catalog):
+    """Roll up (stored entry, scanned qty, scan time) triples in one bulk write"""
+    batch = RollupBatch()
+    for entry, qty, at in scans:
+        dims = entry_dimensions(entry, sessions.get(str(entry.get("session_id"))), catalog)
+        batch.add(at, dims, scan_increments(entry, qty))
+    await batch.write(db)
+
+
+async def record_edit(db, before: dict, after: dict, session: Optional[dict], catalog):
+    batch = RollupBatch()
+    batch.add(before.get("created_at") or datetime.utcnow(), entry_dimensions(before, session, catalog), edit_increments(before, after))
+    await batch.write(db)
+
+
+async def query_rollups(
+    db,
+    granularity: str,
+    since: datetime,
+    until: datetime,
+    group_by: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+) -> List[dict]:
+    """
+    Bucket series for [since, until), summed over the dimensions not in
+    group_by. Reads only rollup documents inside the range.
+    """
+    query = {"granularity": granularity, "bucket": {"$gte": bucket_start(since, granularity), "$lt": until}}
+    for dim, value in (filters or {}).items():
+        if value is not None:
+            query[dim] = value
+    projection = {"_id": 0, "bucket": 1, **{c: 1 for c in COUNTERS}}
+    if group_by:
+        projection[group_by] = 1
+
+    series: Dict[Tuple, Dict[str, float]] = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    async for doc in db.entry_rollups.find(query, projection).sort("bucket", 1):
+        totals = series[(doc["bucket"], doc.get(group_by) if group_by else None)]
+        for counter in COUNTERS:
+            totals[counter] += doc.get(counter, 0)
+
+    points = []
+    for (bucket, group), totals in sorted(series.items(), key=lambda kv: (kv[0][0], str(kv[0][1]))):
+        classified = totals["matched"] + totals["short"] + totals["over"]
+        points.append({
+            "bucket": bucket,
+            "group": group,
+            **totals,
+            "accuracy_rate": round(totals["matched"] / classified * 100, 2) if classified else None,
+        })
+    return points
+
@@ -0,0 +1,163 @@
+"""
+Global serial-number index
+
+Every serial counted on an entry is claimed in the `serials` collection,
+unique on (serial, scope, item_id). The scope is the session's stock take,
+or "session:<id>" for a session outside any stock take, so a unit counted
+again in a later count is not a duplicate. The first entry to count a
+serial holds it; any other entry that counts the same serial in the same
+scope gets a `serial_conflicts` flag, and is recorded under the holder's
+`duplicates`, so "where was serial X counted?" is one indexed read.
+
+Claims are inserted after the entries are written, in one unordered
+insert_many per request or sync batch. Letting the unique index reject the
+duplicates keeps the check race-free across workers. Rejecting an entry
+releases its claims (release_serials): a held serial passes to its first
+duplicate.
+"""
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import as_object_id
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+def _key(record: dict) -> tuple:
+    return record["serial"], record["scope"], record["item_id"]
+
+
+def claim_scope(session: Optional[dict], session_id: str) -> str:
+    """The stock take the serial is unique in, or the session when there is none"""
+    return (session or {}).get("stock_take_id") or f"session:{session_id}"
+
+
+def _claim(record: dict) -> dict:
+    return {
+        "entry_id": record["entry_id"],
+        "session_id": record["session_id"],
+        "location_in_rack": record["location_in_rack"],
+        "counted_at": record["counted_at"],
+    }
+
+
+async def register_serials(db, entries: List[dict], sessions: Dict[str, dict]) -> Dict[str, List[dict]]:
+    """
+    Claim the serials of freshly written entries.
+
+    `entries` are entry dicts carrying their server `id`; `sessions` maps
+    session id -> session document (for its stock_take_id). Returns
+    entry id -> list of conflicts (the entries already holding the serial);
+    the conflicts are also stored on the entries as `serial_conflicts`.
+    """
+    entries = [e for e in entries if e.get("serial_numbers")]
+    if not entries:
+        return {}
+
+    now = datetime.utcnow()
+    records = []
+    for entry in entries:
+        session_id = str(entry.get("session_id"))
+        session = sessions.get(session_id)
+        for serial in dict.fromkeys(str(s).strip() for s in entry["serial_numbers"]):
+            if not serial:
+                continue
+            records.append({
+                "serial": serial,
+                "stock_take_id": (session or {}).get("stock_take_id"),
+                "scope": claim_scope(session, session_id),
+                "item_id": entry.get("item_id"),
+                "entry_id": entry["id"],
+                "session_id": session_id,
+                "location_in_rack": entry.get("location_in_rack"),
+                "counted_at": now,
+                "duplicates": [],
+            })
+    if not records:
+        return {}
+
+    try:
+        await db.serials.insert_many(records, ordered=False)
+        return {}
+    except BulkWriteError as e:
+        rejected = [records[err["index"]] for err in e.details["writeErrors"] if err["code"] == DUPLICATE_KEY]
+        other = [err for err in e.details["writeErrors"] if err["code"] != DUPLICATE_KEY]
+        if other:
+            raise
+    for record in rejected:
+        record.pop("_id", None)
+
+    holders = await db.serials.find(
+        {"serial": {"$in": list({r["serial"] for r in rejected})}},
+        {"duplicates": 0},
+    ).to_list(None)
+    holders = {_key(h): h for h in holders}
+
+    conflicts: Dict[str, List[dict]] = {}
+    serial_updates = []
+    for record in rejected:
+        holder = holders.get(_key(record))
+        if holder is None or holder["entry_id"] == record["entry_id"]:
+            # Same serial scanned again into the same (aggregate) entry
+            continue
+        conflicts.setdefault(record["entry_id"], []).append({"serial": record["serial"], **_claim(holder)})
+        serial_updates.append(UpdateOne({"_id": holder["_id"]}, {"$addToSet": {"duplicates": _claim(record)}}))
+
+    if conflicts:
+        await db.serials.bulk_write(serial_updates, ordered=False)
+        await db.entries.bulk_write([
+            UpdateOne({"_id": as_object_id(entry_id)}, {"$push": {"serial_conflicts": {"$each": found}}})
+            for entry_id, found in conflicts.items()
+        ], ordered=False)
+        logger.warning(f"Serial conflicts on {len(conflicts)} entries")
+    return conflicts
+
+
+async def release_serials(db, entry_id: str):
+    """
+    Drop the claims of an entry (e.g. when it is rejected). A serial it held
+    passes to its first duplicate, and the conflict flags of the remaining
+    duplicates are pointed at the new holder.
+    """
+    await db.serials.update_many({"duplicates.entry_id": entry_id}, {"$pull": {"duplicates": {"entry_id": entry_id}}})
+    held = await db.serials.find({"entry_id": entry_id}).to_list(None)
+    serial_updates, unflag, reflag = [], [], []
+    for holder in held:
+        duplicates = holder.get("duplicates") or []
+        if not duplicates:
+            serial_updates.append(DeleteOne({"_id": holder["_id"]}))
+            continue
+        new_holder, rest = duplicates[0], duplicates[1:]
+        serial_updates.append(UpdateOne({"_id": holder["_id"]}, {"$set": {**new_holder, "duplicates": rest}}))
+        for claim in duplicates:
+            unflag.append(UpdateOne(
+                {"_id": as_object_id(claim["entry_id"])},
+                {"$pull": {"serial_conflicts": {"serial": holder["serial"], "entry_id": entry_id}}},
+            ))
+        for claim in rest:
+            reflag.append(UpdateOne(
+                {"_id": as_object_id(claim["entry_id"])},
+                {"$push": {"serial_conflicts": {"serial": holder["serial"], **new_holder}}},
+            ))
+    if serial_updates:
+        await db.serials.bulk_write(serial_updates, ordered=False)
+    for updates in (unflag, reflag):
+        if updates:
+            await db.entries.bulk_write(updates, ordered=False)
+    await db.entries.update_one({"_id": as_object_id(entry_id)}, {"$unset": {"serial_conflicts": ""}})
+
+
+async def find_serial(db, serial: str, stock_take_id: Optional[str] = None, item_id: Optional[str] = None) -> List[dict]:
+    """Where a serial was counted: its holder per stock take/item, with duplicates"""
+    query = {"serial": serial.strip()}
+    if stock_take_id is not None:
+        query["stock_take_id"] = stock_take_id
+    if item_id is not None:
+        query["item_id"] = item_id
+    return await db.serials.find(query, {"_id": 0}).to_list(None)
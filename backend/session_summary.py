@@ -0,0 +1,111 @@
+"""
+Materialized summaries for finished sessions
+
+When a session reaches completed, verified or rejected, its totals are
+computed once from the raw entries and stored in `session_summaries`
+(keyed by session id). Reports on finished sessions then read that one
+document. Editing an entry of the session, or adding one to it after it
+finished (late offline syncs), drops the summary; it is rebuilt the next
+time it is asked for.
+"""
+import logging
+from datetime import datetime
+from typing import Optional
+
+from database import as_object_id
+from models import SessionStatus
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_STATUSES = {SessionStatus.COMPLETED, SessionStatus.VERIFIED, SessionStatus.REJECTED}
+TOP_VARIANCE_ITEMS = 20
+
+
+def is_summary_status(status) -> bool:
+    return getattr(status, "value", status) in {s.value for s in SUMMARY_STATUSES}
+
+
+def _summary_pipeline(session_id: str) -> list:
+    value = {"$ifNull": ["$variance_value", 0]}
+    variance = {"$ifNull": ["$variance", 0]}
+    return [
+        {"$match": {"session_id": session_id}},
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": None,
+                    "total_items": {"$sum": 1},
+                    "short_items": {"$sum": {"$cond": [{"$lt": [variance, 0]}, 1, 0]}},
+                    "over_items": {"$sum": {"$cond": [{"$gt": [variance, 0]}, 1, 0]}},
+                    "matched_items": {"$sum": {"$cond": [{"$eq": [variance, 0]}, 1, 0]}},
+                    "total_counted_qty": {"$sum": {"$ifNull": ["$counted_qty", 0]}},
+                    "short_value": {"$sum": {"$cond": [{"$lt": [value, 0]}, value, 0]}},
+                    "over_value": {"$sum": {"$cond": [{"$gt": [value, 0]}, value, 0]}},
+                    "total_variance_value": {"$sum": value},
+                }},
+            ],
+            "top_variance_items": [
+                {"$match": {"variance": {"$nin": [0, None]}}},
+                {"$addFields": {"abs_value": {"$abs": value}}},
+                {"$sort": {"abs_value": -1}},
+                {"$limit": TOP_VARIANCE_ITEMS},
+                {"$project": {
+                    "_id": 0,
+                    "entry_id": {"$toString": "$_id"},
+                    "item_id": 1,
+                    "item_name": 1,
+                    "counted_qty": 1,
+                    "system_stock": 1,
+                    "variance": 1,
+                    "variance_value": 1,
+                }},
+            ],
+        }},
+    ]
+
+
+async def build_session_summary(db, session_id: str, status: str) -> dict:
+    """Compute and store the summary document for a session"""
+    result = await db.entries.aggregate(_summary_pipeline(session_id)).to_list(1)
+    facets = result[0] if result else {"totals": [], "top_variance_items": []}
+    totals = facets["totals"][0] if facets["totals"] else {}
+    totals.pop("_id", None)
+
+    summary = {
+        "_id": session_id,
+        "session_status": status,
+        "built_at": datetime.utcnow(),
+        "total_items": totals.get("total_items", 0),
+        "short_items": totals.get("short_items", 0),
+        "over_items": totals.get("over_items", 0),
+        "matched_items": totals.get("matched_items", 0),
+        "total_counted_qty": totals.get("total_counted_qty", 0),
+        "short_value": totals.get("short_value", 0),
+        "over_value": totals.get("over_value", 0),
+        "total_variance_value": totals.get("total_variance_value", 0),
+        "top_variance_items": facets["top_variance_items"],
+    }
+    await db.session_summaries.replace_one({"_id": session_id}, summary, upsert=True)
+    logger.info(f"Built summary for session {session_id} ({summary['total_items']} entries)")
+    return summary
+
+
+async def get_session_summary(db, session_id: str, session: Optional[dict] = None) -> Optional[dict]:
+    """
+    Return the stored summary, rebuilding it if it was invalidated.
+
+    Returns None for sessions that are still open (their totals keep changing).
+    """
+    summary = await db.session_summaries.find_one({"_id": session_id})
+    if summary:
+        return summary
+    if session is None:
+        session = await db.sessions.find_one({"_id": as_object_id(session_id)}, {"status": 1})
+    if not session or not is_summary_status(session.get("status")):
+        return None
+    return await build_session_summary(db, session_id, session["status"])
+
+
+async def invalidate_session_summary(db, session_id: str):
+    """Drop a session's summary after one of its entries changed"""
+    await db.session_summaries.delete_one({"_id": session_id})
@@ -0,0 +1,226 @@
+"""
+Storage interface for sessions, entries, sync writes and reports
+
+The session, entry, sync and report handlers go through a Storage
+instead of talking to MongoDB directly. Two backends exist:
+
+- mongo  (storage_mongo.py): the Motor collections used so far
+- sqlite (storage_sqlite.py): an embedded database file in WAL mode for
+  single-store deployments that do not run MongoDB
+
+Selected with STORAGE_BACKEND. Documents cross the interface as plain
+dicts carrying their id under "id". The activity log is written through
+the storage as well. Subsystems built directly on MongoDB (location
+progress, rollups, serial index, jobs, reconciliation) are only active
+when MongoDB is connected.
+"""
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from models import CountMode, EntryStatus, SessionStatus
+
+MONGO = "mongo"
+SQLITE = "sqlite"
+BACKENDS = (MONGO, SQLITE)
+
+# Entries returned per session listing (as before)
+ENTRY_LIST_LIMIT = 1000
+
+
+def is_aggregate_session(sessions: Dict[str, dict], session_id) -> bool:
+    return (sessions.get(str(session_id)) or {}).get("count_mode") == CountMode.AGGREGATE
+
+
+def new_session_doc(data: dict, created_at: datetime) -> dict:
+    """Session document for a session created through the API"""
+    return {
+        **data,
+        "created_at": created_at,
+        "status": SessionStatus.ACTIVE,
+        "total_scanned": 0,
+        "total_verified": 0,
+        "total_rejected": 0,
+    }
+
+
+def new_entry_doc(data: dict, created_at: datetime) -> dict:
+    """Individual entry document for a scan made through the API"""
+    return {**data, "created_at": created_at, "status": EntryStatus.PENDING, "is_synced": True}
+
+
+def sync_session_doc(data: dict, created_at: datetime) -> dict:
+    data["created_at"] = created_at
+    data.setdefault("status", SessionStatus.ACTIVE.value)
+    return data
+
+
+def sync_entry_doc(data: dict, created_at: datetime) -> dict:
+    data["created_at"] = created_at
+    data["is_synced"] = True
+    return data
+
+
+def variance_totals_from(total: int, short: int, over: int, variance_value: float) -> dict:
+    return {
+        "total_items": total,
+        "short_items": short,
+        "over_items": over,
+        "matched_items": total - short - over,
+        "total_variance_value": variance_value,
+    }
+
+
+class Storage(ABC):
+    """Persistence used by the session, entry, sync and report handlers"""
+
+    name: str
+
+    @property
+    @abstractmethod
+    def available(self) -> bool:
+        """False while the backend cannot serve requests (e.g. MongoDB not connected)"""
+
+    async def close(self):
+        pass
+
+    # ---- sessions ----
+
+    @abstractmethod
+    async def list_sessions(self, status: Optional[str] = None, user_id: Optional[str] = None, limit: int = 100) -> List[dict]:
+        """Newest first"""
+
+    @abstractmethod
+    async def create_session(self, session: dict) -> str:
+        """Insert a session document; returns its id"""
+
+    @abstractmethod
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def get_sessions(self, session_ids: List[str]) -> Dict[str, dict]:
+        """Several sessions in one lookup, by id (unknown ids are left out)"""
+
+    @abstractmethod
+    async def update_session(self, session_id: str, fields: dict) -> Optional[dict]:
+        """Set fields; returns the session as it was before, or None if not found"""
+
+    @abstractmethod
+    async def increment_scanned(self, session_id: str, count: int = 1):
+        ...
+
+    # ---- entries ----
+
+    @abstractmethod
+    async def list_entries(self, session_id: str, limit: int = ENTRY_LIST_LIMIT) -> List[dict]:
+        """Newest first"""
+
+    @abstractmethod
+    async def insert_entry(self, entry: dict) -> str:
+        """Insert an individual entry; returns its id"""
+
+    @abstractmethod
+    async def merge_entry(self, entry: dict, scanned_at: datetime) -> dict:
+        """Fold one scan into its aggregate entry (see entry_merge.py); returns the merged entry"""
+
+    @abstractmethod
+    async def update_entry(self, entry_id: str, fields: dict) -> Optional[dict]:
+        """Set fields; returns the entry as it was before, or None if not found"""
+
+    # ---- sync ----
+
+    async def ingest(self, writes: List[dict], sessions: Dict[str, dict]) -> List[dict]:
+        """
+        Apply offline writes in order; each is {"type", "offline_id", "data", "at"}
+        with type 'session' or 'count_line'.
+
+        Returns one dict per write: {"id", "stored"} or {"error"}. Sessions
+        created here are added to `sessions` under both their server and
+        offline id, so later count lines (and later calls) see them.
+        """
+        results = []
+        for write in writes:
+            try:
+                if write["type"] == "session":
+                    session = sync_session_doc(write["data"], write["at"])
+                    session_id = await self.create_session(session)
+                    sessions[session_id] = sessions[write["offline_id"]] = session
+                    results.append({"id": session_id, "stored": session})
+                elif is_aggregate_session(sessions, write["data"].get("session_id")):
+                    merged = await self.merge_entry(write["data"], write["at"])
+                    results.append({"id": merged["id"], "stored": merged})
+                else:
+                    entry = sync_entry_doc(write["data"], write["at"])
+                    entry["id"] = await self.insert_entry(entry)
+                    results.append({"id": entry["id"], "stored": entry})
+            except Exception as e:
+                results.append({"error": str(e)})
+        return results
+
+    # ---- reports ----
+
+    @abstractmethod
+    async def variance_totals(self, session_id: Optional[str] = None, limit: Optional[int] = None, ctx=None) -> dict:
+        """Entry counts by variance sign and the summed variance value (see variance_totals_from)"""
+
+    @abstractmethod
+    async def get_session_summary(self, session_id: str) -> Optional[dict]:
+        """Materialized summary of a finished session (see session_summary.py), keyed by session_id"""
+
+    @abstractmethod
+    async def build_session_summary(self, session_id: str, status) -> dict:
+        ...
+
+    @abstractmethod
+    async def invalidate_session_summary(self, session_id: str):
+        ...
+
+    @abstractmethod
+    async def metrics(self) -> dict:
+        """total_sessions, active_sessions, total_entries and matched_entries"""
+
+    @abstractmethod
+    async def session_rack_counts(self, location_type: Optional[str] = None) -> List[dict]:
+        """
+        Sessions per rack and status: {"location_type", "floor", "area",
+        "rack_no", "status", "sessions"} for sessions that name a rack
+        """
+
+    # ---- activity logs ----
+
+    @abstractmethod
+    async def insert_activity(self, records: List[dict]) -> List[dict]:
+        """
+        Append activity records (see activity_log.py); returns the records
+        that could not be written. A record already stored (same id) counts
+        as written.
+        """
+
+    @abstractmethod
+    async def query_activity(
+        self,
+        user_id: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        before: Optional[Tuple[datetime, str]] = None,
+        limit: int = 50,
+    ) -> List[dict]:
+        """Newest first by (timestamp, id); `before` is the (timestamp, id) the page starts after"""
+
+
+def open_storage(
+    backend: str,
+    get_db=None,
+    path: Optional[str] = None,
+    activity_retention_days: Optional[int] = None,
+) -> Storage:
+    """Create the configured backend (the SQLite file is opened by SQLiteStorage.open())"""
+    if backend == MONGO:
+        from storage_mongo import MongoStorage
+        return MongoStorage(get_db)
+    if backend == SQLITE:
+        from storage_sqlite import SQLiteStorage
+        return SQLiteStorage(path, activity_retention_days=activity_retention_days)
+    raise ValueError(f"Unknown storage backend: {backend} (expected one of {', '.join(BACKENDS)})")
@@ -0,0 +1,190 @@
+"""
+MongoDB (Motor) storage backend
+
+Sessions and entries in the `sessions` and `entries` collections, finished
+session summaries in `session_summaries` (see session_summary.py), activity
+logs in `activity_logs` (expired by a TTL index).
+"""
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+import entry_merge
+import session_summary
+from database import as_object_id
+from models import SessionStatus
+from storage import ENTRY_LIST_LIMIT, MONGO, Storage, variance_totals_from
+
+DUPLICATE_KEY = 11000
+
+
+def _with_id(doc: Optional[dict]) -> Optional[dict]:
+    if doc is not None:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
+
+class MongoStorage(Storage):
+    name = MONGO
+
+    def __init__(self, get_db: Callable[[], Any]):
+        self._get_db = get_db
+
+    @property
+    def db(self):
+        return self._get_db()
+
+    @property
+    def available(self) -> bool:
+        return self._get_db() is not None
+
+    # ---- sessions ----
+
+    async def list_sessions(self, status: Optional[str] = None, user_id: Optional[str] = None, limit: int = 100) -> List[dict]:
+        query = {}
+        if status:
+            query["status"] = status
+        if user_id:
+            query["user_id"] = user_id
+        sessions = await self.db.sessions.find(query).sort("created_at", -1).to_list(limit)
+        return [_with_id(s) for s in sessions]
+
+    async def create_session(self, session: dict) -> str:
+        result = await self.db.sessions.insert_one(session)
+        session.pop("_id", None)
+        return str(result.inserted_id)
+
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        return _with_id(await self.db.sessions.find_one({"_id": as_object_id(session_id)}))
+
+    async def get_sessions(self, session_ids: List[str]) -> Dict[str, dict]:
+        ids = {str(s) for s in session_ids if s}
+        if not ids:
+            return {}
+        sessions = await self.db.sessions.find({"_id": {"$in": [as_object_id(s) for s in ids]}}).to_list(None)
+        return {s["id"]: s for s in map(_with_id, sessions)}
+
+    async def update_session(self, session_id: str, fields: dict) -> Optional[dict]:
+        return _with_id(await self.db.sessions.find_one_and_update(
+            {"_id": as_object_id(session_id)}, {"$set": fields},
+        ))
+
+    async def increment_scanned(self, session_id: str, count: int = 1):
+        await self.db.sessions.update_one({"_id": as_object_id(session_id)}, {"$inc": {"total_scanned": count}})
+
+    # ---- entries ----
+
+    async def list_entries(self, session_id: str, limit: int = ENTRY_LIST_LIMIT) -> List[dict]:
+        entries = await self.db.entries.find({"session_id": session_id}).sort("created_at", -1).to_list(limit)
+        return [_with_id(e) for e in entries]
+
+    async def insert_entry(self, entry: dict) -> str:
+        result = await self.db.entries.insert_one(entry)
+        entry.pop("_id", None)
+        return str(result.inserted_id)
+
+    async def merge_entry(self, entry: dict, scanned_at: datetime) -> dict:
+        return _with_id(await entry_merge.merge_entry(self.db, entry, scanned_at))
+
+    async def update_entry(self, entry_id: str, fields: dict) -> Optional[dict]:
+        return _with_id(await self.db.entries.find_one_and_update(
+            {"_id": as_object_id(entry_id)}, {"$set": fields},
+        ))
+
+    # ---- reports ----
+
+    async def variance_totals(self, session_id: Optional[str] = None, limit: Optional[int] = None, ctx=None) -> dict:
+        """Scans the entries; progress is reported when run as a job"""
+        query = {}
+        if session_id:
+            query["session_id"] = session_id
+
+        total_entries = await self.db.entries.count_documents(query) if ctx else None
+        cursor = self.db.entries.find(query, {"_id": 0, "variance": 1, "variance_value": 1})
+        if limit:
+            cursor = cursor.limit(limit)
+
+        total = short = over = 0
+        variance_value = 0.0
+        async for e in cursor:
+            variance = e.get("variance", 0) or 0
+            total += 1
+            if variance < 0:
+                short += 1
+            elif variance > 0:
+                over += 1
+            variance_value += e.get("variance_value", 0) or 0
+            if ctx and total % 1000 == 0:
+                await ctx.report(total, total_entries)
+        return variance_totals_from(total, short, over, variance_value)
+
+    async def get_session_summary(self, session_id: str) -> Optional[dict]:
+        summary = await session_summary.get_session_summary(self.db, session_id)
+        if summary:
+            summary["session_id"] = summary.pop("_id")
+        return summary
+
+    async def build_session_summary(self, session_id: str, status) -> dict:
+        return await session_summary.build_session_summary(self.db, session_id, status)
+
+    async def invalidate_session_summary(self, session_id: str):
+        await session_summary.invalidate_session_summary(self.db, session_id)
+
+    async def metrics(self) -> dict:
+        return {
+            "total_sessions": await self.db.sessions.count_documents({}),
+            "active_sessions": await self.db.sessions.count_documents({"status": SessionStatus.ACTIVE.value}),
+            "total_entries": await self.db.entries.count_documents({}),
+            "matched_entries": await self.db.entries.count_documents({"variance": 0}),
+        }
+
+    async def session_rack_counts(self, location_type: Optional[str] = None) -> List[dict]:
+        match: dict = {"rack_no": {"$nin": [None, ""]}}
+        if location_type:
+            match["location_type"] = location_type
+        fields = ("location_type", "floor", "area", "rack_no", "status")
+        groups = await self.db.sessions.aggregate([
+            {"$match": match},
+            {"$group": {"_id": {f: f"${f}" for f in fields}, "sessions": {"$sum": 1}}},
+        ]).to_list(None)
+        return [{**g["_id"], "sessions": g["sessions"]} for g in groups]
+
+    # ---- activity logs ----
+
+    async def insert_activity(self, records: List[dict]) -> List[dict]:
+        docs = [{"_id": ObjectId(r["id"]), **{k: v for k, v in r.items() if k != "id"}} for r in records]
+        try:
+            await self.db.activity_logs.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Records written by an earlier, partly failed attempt are duplicates now
+            return [records[err["index"]] for err in e.details["writeErrors"] if err["code"] != DUPLICATE_KEY]
+        return []
+
+    async def query_activity(
+        self,
+        user_id: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        before: Optional[Tuple[datetime, str]] = None,
+        limit: int = 50,
+    ) -> List[dict]:
+        """Keyset page on the per-filter (timestamp, _id) indexes from database.ensure_indexes()"""
+        query: dict = {}
+        if user_id:
+            query["user_id"] = user_id
+        if action:
+            query["action"] = action
+        if since or until:
+            query["timestamp"] = {}
+            if since:
+                query["timestamp"]["$gte"] = since
+            if until:
+                query["timestamp"]["$lt"] = until
+        if before:
+            ts, oid = before[0], ObjectId(before[1])
+            query["$or"] = [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "_id": {"$lt": oid}}]
+        logs = await self.db.activity_logs.find(query).sort([("timestamp", -1), ("_id", -1)]).to_list(limit)
+        return [_with_id(log) for log in logs]
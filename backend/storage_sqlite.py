@@ -0,0 +1,575 @@
+"""
+Embedded SQLite storage backend for single-store deployments
+
+One database file (SQLITE_PATH) in WAL mode, so report reads do not block
+sync writes. Each row keeps the columns used for lookups, ordering and
+aggregation next to the full document as JSON (datetimes are stored as
+{"$date": iso} and restored on read):
+
+- sessions: by status/user and creation time, and by stock take
+- entries: by session and creation time; aggregate entries unique on
+  (session_id, item_id, location_in_rack) like the Mongo partial index
+- session_summaries: materialized summaries of finished sessions
+- activity_logs: by time, user and action (newest first, keyset paged);
+  rows older than the retention period are deleted as new ones arrive
+
+All access runs on one dedicated thread that owns the connection, so
+writes are serialized without locks and never block the event loop. A
+sync batch is applied in a single transaction with a savepoint per
+operation: a failing operation is rolled back on its own and reported,
+the rest of the batch commits together. Report totals and summaries are
+computed with SQL aggregates instead of loading the entries.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from entry_merge import merge_scan
+from models import SessionStatus
+from session_summary import TOP_VARIANCE_ITEMS, is_summary_status
+from storage import (
+    ENTRY_LIST_LIMIT, SQLITE, Storage, is_aggregate_session, sync_entry_doc, sync_session_doc,
+    variance_totals_from,
+)
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    status TEXT,
+    user_id TEXT,
+    stock_take_id TEXT,
+    created_at TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_by_status ON sessions (status, created_at);
+CREATE INDEX IF NOT EXISTS sessions_by_user ON sessions (user_id, created_at);
+CREATE INDEX IF NOT EXISTS sessions_by_created ON sessions (created_at);
+CREATE INDEX IF NOT EXISTS sessions_by_stock_take ON sessions (stock_take_id);
+
+CREATE TABLE IF NOT EXISTS entries (
+    id TEXT PRIMARY KEY,
+    session_id TEXT,
+    item_id TEXT,
+    location_in_rack TEXT,
+    aggregate INTEGER NOT NULL DEFAULT 0,
+    status TEXT,
+    counted_qty REAL,
+    variance REAL,
+    variance_value REAL,
+    created_at TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_session ON entries (session_id, created_at);
+CREATE INDEX IF NOT EXISTS entries_by_variance ON entries (variance);
+CREATE UNIQUE INDEX IF NOT EXISTS aggregate_entry_key
+    ON entries (session_id, item_id, COALESCE(location_in_rack, ''))
+    WHERE aggregate = 1;
+
+CREATE TABLE IF NOT EXISTS session_summaries (
+    session_id TEXT PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS activity_logs (
+    id TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    user_id TEXT,
+    action TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activity_by_time ON activity_logs (timestamp, id);
+CREATE INDEX IF NOT EXISTS activity_by_user ON activity_logs (user_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS activity_by_action ON activity_logs (action, timestamp, id);
+"""
+
+SESSION_COLUMNS = ("status", "user_id", "stock_take_id", "created_at")
+ENTRY_COLUMNS = (
+    "session_id", "item_id", "location_in_rack", "aggregate", "status",
+    "counted_qty", "variance", "variance_value", "created_at",
+)
+ACTIVITY_COLUMNS = ("timestamp", "user_id", "action")
+
+
+# ---- documents ----
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+
+def _json_hook(obj: dict):
+    if len(obj) == 1 and "$date" in obj:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+def _dumps(doc: dict) -> str:
+    return json.dumps({k: v for k, v in doc.items() if k not in ("id", "_id")}, default=_json_default)
+
+
+def _loads(row_id: str, doc: str) -> dict:
+    return {**json.loads(doc, object_hook=_json_hook), "id": row_id}
+
+
+def _column(value):
+    """Column value for a document field (datetimes as sortable naive-UTC ISO text)"""
+    value = getattr(value, "value", value)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat()
+    if isinstance(value, bool):
+        return int(value)
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return str(value)
+
+
+def _columns(doc: dict, names) -> list:
+    return [_column(doc.get(name)) for name in names]
+
+
+def _new_id() -> str:
+    return str(ObjectId())
+
+
+class SQLiteStorage(Storage):
+    name = SQLITE
+
+    def __init__(self, path: str, activity_retention_days: Optional[int] = None):
+        self.path = path
+        self.activity_retention_days = activity_retention_days
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def available(self) -> bool:
+        return self._conn is not None
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        """Run fn(conn, *args) on the storage thread"""
+        loop = asyncio.get_running_loop()
+        with span("sqlite", fn.__name__.lstrip("_")):
+            return await loop.run_in_executor(self._executor, fn, self._conn, *args)
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = await asyncio.get_running_loop().run_in_executor(self._executor, self._connect)
+        logger.info(f"SQLite storage opened at {self.path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Autocommit mode; multi-statement writes use explicit transactions
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(SCHEMA)
+        return conn
+
+    async def close(self):
+        if self._conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    # ---- sessions ----
+
+    @staticmethod
+    def _list_sessions(conn, status, user_id, limit):
+        where, params = [], []
+        if status:
+            where.append("status = ?")
+            params.append(status)
+        if user_id:
+            where.append("user_id = ?")
+            params.append(user_id)
+        sql = "SELECT id, doc FROM sessions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = conn.execute(sql + " ORDER BY created_at DESC LIMIT ?", params + [limit]).fetchall()
+        return [_loads(r["id"], r["doc"]) for r in rows]
+
+    async def list_sessions(self, status: Optional[str] = None, user_id: Optional[str] = None, limit: int = 100) -> List[dict]:
+        return await self._run(self._list_sessions, status, user_id, limit)
+
+    @staticmethod
+    def _insert_session(conn, session: dict) -> str:
+        session_id = _new_id()
+        conn.execute(
+            "INSERT INTO sessions (id, status, user_id, stock_take_id, created_at, doc) VALUES (?, ?, ?, ?, ?, ?)",
+            [session_id, *_columns(session, SESSION_COLUMNS), _dumps(session)],
+        )
+        return session_id
+
+    async def create_session(self, session: dict) -> str:
+        return await self._run(self._insert_session, session)
+
+    @staticmethod
+    def _get_sessions(conn, session_ids: List[str]) -> Dict[str, dict]:
+        ids = list({str(s) for s in session_ids if s})
+        if not ids:
+            return {}
+        rows = conn.execute(
+            f"SELECT id, doc FROM sessions WHERE id IN ({', '.join('?' * len(ids))})", ids,
+        ).fetchall()
+        return {r["id"]: _loads(r["id"], r["doc"]) for r in rows}
+
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        return (await self._run(self._get_sessions, [session_id])).get(session_id)
+
+    async def get_sessions(self, session_ids: List[str]) -> Dict[str, dict]:
+        return await self._run(self._get_sessions, session_ids)
+
+    @staticmethod
+    def _update_session(conn, session_id: str, fields: dict, increments: dict) -> Optional[dict]:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT doc FROM sessions WHERE id = ?", [session_id]).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+            before = _loads(session_id, row["doc"])
+            session = {**before, **fields}
+            for field, count in increments.items():
+                session[field] = (session.get(field) or 0) + count
+            conn.execute(
+                "UPDATE sessions SET status = ?, user_id = ?, stock_take_id = ?, created_at = ?, doc = ? WHERE id = ?",
+                [*_columns(session, SESSION_COLUMNS), _dumps(session), session_id],
+            )
+            conn.execute("COMMIT")
+            return before
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def update_session(self, session_id: str, fields: dict) -> Optional[dict]:
+        return await self._run(self._update_session, session_id, fields, {})
+
+    async def increment_scanned(self, session_id: str, count: int = 1):
+        await self._run(self._update_session, session_id, {}, {"total_scanned": count})
+
+    # ---- entries ----
+
+    @staticmethod
+    def _list_entries(conn, session_id: str, limit: int) -> List[dict]:
+        rows = conn.execute(
+            "SELECT id, doc FROM entries WHERE session_id = ? ORDER BY created_at DESC LIMIT ?", [session_id, limit],
+        ).fetchall()
+        return [_loads(r["id"], r["doc"]) for r in rows]
+
+    async def list_entries(self, session_id: str, limit: int = ENTRY_LIST_LIMIT) -> List[dict]:
+        return await self._run(self._list_entries, session_id, limit)
+
+    @staticmethod
+    def _write_entry(conn, entry_id: str, entry: dict):
+        conn.execute(
+            f"INSERT OR REPLACE INTO entries (id, {', '.join(ENTRY_COLUMNS)}, doc) "
+            f"VALUES ({', '.join('?' * (len(ENTRY_COLUMNS) + 2))})",
+            [entry_id, *_columns(entry, ENTRY_COLUMNS), _dumps(entry)],
+        )
+
+    @classmethod
+    def _insert_entry(cls, conn, entry: dict) -> str:
+        entry_id = _new_id()
+        cls._write_entry(conn, entry_id, entry)
+        return entry_id
+
+    async def insert_entry(self, entry: dict) -> str:
+        return await self._run(self._insert_entry, entry)
+
+    @classmethod
+    def _merge_scan(cls, conn, entry: dict, scanned_at: datetime) -> dict:
+        """Read-modify-write of the aggregate entry; the caller holds a write transaction"""
+        row = conn.execute(
+            "SELECT id, doc FROM entries WHERE aggregate = 1 AND session_id = ? AND item_id = ? "
+            "AND COALESCE(location_in_rack, '') = COALESCE(?, '')",
+            [_column(entry.get("session_id")), _column(entry.get("item_id")), _column(entry.get("location_in_rack"))],
+        ).fetchone()
+        existing = _loads(row["id"], row["doc"]) if row else None
+        merged = merge_scan(existing, entry, scanned_at)
+        merged["id"] = existing["id"] if existing else _new_id()
+        cls._write_entry(conn, merged["id"], merged)
+        return merged
+
+    @classmethod
+    def _merge_entry(cls, conn, entry: dict, scanned_at: datetime) -> dict:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            merged = cls._merge_scan(conn, entry, scanned_at)
+            conn.execute("COMMIT")
+            return merged
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def merge_entry(self, entry: dict, scanned_at: datetime) -> dict:
+        return await self._run(self._merge_entry, entry, scanned_at)
+
+    @classmethod
+    def _update_entry(cls, conn, entry_id: str, fields: dict) -> Optional[dict]:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT doc FROM entries WHERE id = ?", [entry_id]).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+            before = _loads(entry_id, row["doc"])
+            cls._write_entry(conn, entry_id, {**before, **fields})
+            conn.execute("COMMIT")
+            return before
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def update_entry(self, entry_id: str, fields: dict) -> Optional[dict]:
+        return await self._run(self._update_entry, entry_id, fields)
+
+    # ---- sync ----
+
+    @classmethod
+    def _ingest(cls, conn, writes: List[dict], sessions: Dict[str, dict]) -> List[dict]:
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for write in writes:
+                conn.execute("SAVEPOINT write")
+                try:
+                    if write["type"] == "session":
+                        session = sync_session_doc(write["data"], write["at"])
+                        session_id = cls._insert_session(conn, session)
+                        sessions[session_id] = sessions[write["offline_id"]] = session
+                        result = {"id": session_id, "stored": session}
+                    elif is_aggregate_session(sessions, write["data"].get("session_id")):
+                        merged = cls._merge_scan(conn, write["data"], write["at"])
+                        result = {"id": merged["id"], "stored": merged}
+                    else:
+                        entry = sync_entry_doc(write["data"], write["at"])
+                        entry["id"] = cls._insert_entry(conn, entry)
+                        result = {"id": entry["id"], "stored": entry}
+                    conn.execute("RELEASE write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    result = {"error": str(e)}
+                results.append(result)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return results
+
+    async def ingest(self, writes: List[dict], sessions: Dict[str, dict]) -> List[dict]:
+        """The whole batch in one transaction (one fsync) instead of one per operation"""
+        if not writes:
+            return []
+        return await self._run(self._ingest, writes, sessions)
+
+    # ---- reports ----
+
+    @staticmethod
+    def _variance_totals(conn, session_id: Optional[str], limit: Optional[int]) -> dict:
+        sql = "SELECT COALESCE(variance, 0) AS variance, COALESCE(variance_value, 0) AS variance_value FROM entries"
+        params: list = []
+        if session_id:
+            sql += " WHERE session_id = ?"
+            params.append(session_id)
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        row = conn.execute(
+            "SELECT COUNT(*) AS total, COALESCE(SUM(variance < 0), 0) AS short, COALESCE(SUM(variance > 0), 0) AS over, "
+            f"COALESCE(SUM(variance_value), 0) AS variance_value FROM ({sql})",
+            params,
+        ).fetchone()
+        return variance_totals_from(row["total"], row["short"], row["over"], row["variance_value"])
+
+    async def variance_totals(self, session_id: Optional[str] = None, limit: Optional[int] = None, ctx=None) -> dict:
+        return await self._run(self._variance_totals, session_id, limit)
+
+    @staticmethod
+    def _build_summary(conn, session_id: str, status) -> dict:
+        totals = conn.execute(
+            """
+            SELECT COUNT(*) AS total_items,
+                   COALESCE(SUM(variance < 0), 0) AS short_items,
+                   COALESCE(SUM(variance > 0), 0) AS over_items,
+                   COALESCE(SUM(variance = 0), 0) AS matched_items,
+                   COALESCE(SUM(counted_qty), 0) AS total_counted_qty,
+                   COALESCE(SUM(MIN(value, 0)), 0) AS short_value,
+                   COALESCE(SUM(MAX(value, 0)), 0) AS over_value,
+                   COALESCE(SUM(value), 0) AS total_variance_value
+            FROM (
+                SELECT COALESCE(variance, 0) AS variance, COALESCE(variance_value, 0) AS value,
+                       COALESCE(counted_qty, 0) AS counted_qty
+                FROM entries WHERE session_id = ?
+            )
+            """,
+            [session_id],
+        ).fetchone()
+        top = conn.execute(
+            """
+            SELECT id AS entry_id, item_id, json_extract(doc, '$.item_name') AS item_name,
+                   counted_qty, json_extract(doc, '$.system_stock') AS system_stock, variance, variance_value
+            FROM entries
+            WHERE session_id = ? AND variance IS NOT NULL AND variance != 0
+            ORDER BY ABS(COALESCE(variance_value, 0)) DESC
+            LIMIT ?
+            """,
+            [session_id, TOP_VARIANCE_ITEMS],
+        ).fetchall()
+        summary = {
+            "session_id": session_id,
+            "session_status": getattr(status, "value", status),
+            "built_at": datetime.utcnow(),
+            **dict(totals),
+            "top_variance_items": [dict(r) for r in top],
+        }
+        conn.execute(
+            "INSERT OR REPLACE INTO session_summaries (session_id, doc) VALUES (?, ?)",
+            [session_id, _dumps(summary)],
+        )
+        return summary
+
+    async def build_session_summary(self, session_id: str, status) -> dict:
+        summary = await self._run(self._build_summary, session_id, status)
+        logger.info(f"Built summary for session {session_id} ({summary['total_items']} entries)")
+        return summary
+
+    @staticmethod
+    def _get_summary(conn, session_id: str) -> Optional[dict]:
+        row = conn.execute("SELECT doc FROM session_summaries WHERE session_id = ?", [session_id]).fetchone()
+        return json.loads(row["doc"], object_hook=_json_hook) if row else None
+
+    async def get_session_summary(self, session_id: str) -> Optional[dict]:
+        """Stored summary, rebuilt if it was invalidated; None for sessions still open"""
+        summary = await self._run(self._get_summary, session_id)
+        if summary:
+            return summary
+        session = await self.get_session(session_id)
+        if not session or not is_summary_status(session.get("status")):
+            return None
+        return await self.build_session_summary(session_id, session["status"])
+
+    @staticmethod
+    def _delete_summary(conn, session_id: str):
+        conn.execute("DELETE FROM session_summaries WHERE session_id = ?", [session_id])
+
+    async def invalidate_session_summary(self, session_id: str):
+        await self._run(self._delete_summary, session_id)
+
+    @staticmethod
+    def _metrics(conn) -> dict:
+        sessions = conn.execute(
+            "SELECT COUNT(*) AS total, COALESCE(SUM(status = ?), 0) AS active FROM sessions",
+            [SessionStatus.ACTIVE.value],
+        ).fetchone()
+        entries = conn.execute(
+            "SELECT COUNT(*) AS total, COALESCE(SUM(variance = 0), 0) AS matched FROM entries",
+        ).fetchone()
+        return {
+            "total_sessions": sessions["total"],
+            "active_sessions": sessions["active"],
+            "total_entries": entries["total"],
+            "matched_entries": entries["matched"],
+        }
+
+    async def metrics(self) -> dict:
+        return await self._run(self._metrics)
+
+    @staticmethod
+    def _session_rack_counts(conn, location_type: Optional[str]) -> List[dict]:
+        sql = """
+            SELECT json_extract(doc, '$.location_type') AS location_type, json_extract(doc, '$.floor') AS floor,
+                   json_extract(doc, '$.area') AS area, json_extract(doc, '$.rack_no') AS rack_no,
+                   status, COUNT(*) AS sessions
+            FROM sessions
+            WHERE COALESCE(json_extract(doc, '$.rack_no'), '') != ''
+        """
+        params: list = []
+        if location_type:
+            sql += " AND json_extract(doc, '$.location_type') = ?"
+            params.append(location_type)
+        rows = conn.execute(sql + " GROUP BY 1, 2, 3, 4, 5", params).fetchall()
+        return [dict(r) for r in rows]
+
+    async def session_rack_counts(self, location_type: Optional[str] = None) -> List[dict]:
+        return await self._run(self._session_rack_counts, location_type)
+
+    # ---- activity logs ----
+
+    @staticmethod
+    def _insert_activity(conn, records: List[dict], cutoff: Optional[datetime]):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Already stored ids come from a retried batch; keep the first copy
+            conn.executemany(
+                "INSERT OR IGNORE INTO activity_logs (id, timestamp, user_id, action, doc) VALUES (?, ?, ?, ?, ?)",
+                [[r["id"], *_columns(r, ACTIVITY_COLUMNS), _dumps(r)] for r in records],
+            )
+            if cutoff is not None:
+                conn.execute("DELETE FROM activity_logs WHERE timestamp < ?", [_column(cutoff)])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def insert_activity(self, records: List[dict]) -> List[dict]:
+        cutoff = None
+        if self.activity_retention_days:
+            cutoff = datetime.utcnow() - timedelta(days=self.activity_retention_days)
+        await self._run(self._insert_activity, records, cutoff)
+        return []
+
+    @staticmethod
+    def _query_activity(conn, user_id, action, since, until, before, limit) -> List[dict]:
+        where, params = [], []
+        if user_id:
+            where.append("user_id = ?")
+            params.append(user_id)
+        if action:
+            where.append("action = ?")
+            params.append(action)
+        if since:
+            where.append("timestamp >= ?")
+            params.append(_column(since))
+        if until:
+            where.append("timestamp < ?")
+            params.append(_column(until))
+        if before:
+            where.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params += [_column(before[0]), _column(before[0]), before[1]]
+        sql = "SELECT id, doc FROM activity_logs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = conn.execute(sql + " ORDER BY timestamp DESC, id DESC LIMIT ?", params + [limit]).fetchall()
+        return [_loads(r["id"], r["doc"]) for r in rows]
+
+    async def query_activity(
+        self,
+        user_id: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        before: Optional[Tuple[datetime, str]] = None,
+        limit: int = 50,
+    ) -> List[dict]:
+        return await self._run(self._query_activity, user_id, action, since, until, before, limit)
@@ -0,0 +1,141 @@
+"""
+Streaming NDJSON sync ingestion
+
+A device that was offline all day can hold tens of thousands of queued
+operations. Instead of one JSON document that must be parsed whole, the
+device posts one SyncOperation per line. The server parses the body as it
+arrives, processes it in bounded chunks and streams one result line back
+per chunk, so memory stays flat regardless of upload size.
+
+Chunks from all uploads share a global in-flight limit; while a chunk waits
+for a slot the server stops reading that request body, which pushes back on
+the client through TCP flow control.
+"""
+import asyncio
+import json
+from typing import AsyncIterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+from starlette.responses import JSONResponse, StreamingResponse
+
+from models import SyncOperation, SyncResult
+
+
+class LineTooLong(Exception):
+    """A single NDJSON line exceeded the configured maximum size"""
+
+
+async def iter_lines(body: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[bytes]:
+    """Split a streamed request body into lines without buffering the whole body"""
+    buffer = bytearray()
+    async for piece in body:
+        buffer += piece
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            yield bytes(buffer[start:end])
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > max_line_bytes:
+            raise LineTooLong(f"Line exceeds {max_line_bytes} bytes")
+    if buffer.strip():
+        yield bytes(buffer)
+
+
+def parse_operation(line: bytes, line_no: int) -> Tuple[Optional[SyncOperation], Optional[SyncResult]]:
+    """Parse one NDJSON line; returns (operation, None) or (None, failed result)"""
+    try:
+        data = json.loads(line)
+    except ValueError as e:
+        return None, SyncResult(offline_id=f"line:{line_no}", success=False, message=f"Invalid JSON: {e}")
+    try:
+        return SyncOperation.model_validate(data), None
+    except ValidationError as e:
+        offline_id = data.get("offline_id") if isinstance(data, dict) else None
+        return None, SyncResult(
+            offline_id=str(offline_id or f"line:{line_no}"),
+            success=False,
+            message=f"Invalid operation: {e.errors()[0]['msg']}",
+        )
+
+
+async def iter_operation_chunks(
+    body: AsyncIterator[bytes],
+    chunk_size: int,
+    max_line_bytes: int,
+) -> AsyncIterator[Tuple[List[SyncOperation], List[SyncResult]]]:
+    """Yield (operations, parse failures) in chunks of at most chunk_size lines"""
+    operations: List[SyncOperation] = []
+    failures: List[SyncResult] = []
+    line_no = 0
+    async for line in iter_lines(body, max_line_bytes):
+        line_no += 1
+        if not line.strip():
+            continue
+        op, failure = parse_operation(line, line_no)
+        if op is not None:
+            operations.append(op)
+        else:
+            failures.append(failure)
+        if len(operations) + len(failures) >= chunk_size:
+            yield operations, failures
+            operations, failures = [], []
+    if operations or failures:
+        yield operations, failures
+
+
+class InflightLimiter:
+    """Global limit on concurrent sync uploads and on chunks being processed"""
+
+    def __init__(self, max_streams: int, max_inflight_chunks: int):
+        self.max_streams = max_streams
+        self.active_streams = 0
+        self.chunks = asyncio.Semaphore(max_inflight_chunks)
+
+    def try_open_stream(self) -> bool:
+        if self.active_streams >= self.max_streams:
+            return False
+        self.active_streams += 1
+        return True
+
+    def close_stream(self):
+        self.active_streams -= 1
+
+
+class RequestBodyStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that may keep reading the request body while it streams.
+
+    Starlette's StreamingResponse listens for client disconnect by calling
+    receive() alongside the generator, which would steal the request body
+    messages the generator still needs to read.
+
+    With a limiter, the upload slot is taken when the response starts and
+    released when it ends however it ends (finished, failed, client gone);
+    without a free slot the client gets a 503 instead.
+    """
+
+    def __init__(self, *args, limiter: Optional[InflightLimiter] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if self.limiter is not None and not self.limiter.try_open_stream():
+            busy = JSONResponse(
+                {"detail": "Too many concurrent sync uploads"}, status_code=503, headers={"Retry-After": "5"},
+            )
+            await busy(scope, receive, send)
+            return
+        try:
+            await self.stream_response(send)
+        finally:
+            if self.limiter is not None:
+                self.limiter.close_stream()
+            # Run the generator's cleanup now even if it was never (fully) iterated
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,326 @@
+"""
+Per-request tracing and slow-operation log
+
+Every HTTP request gets a request id (taken from X-Request-ID or generated),
+held in a contextvar, echoed in the response header and added to every log
+line. SQL queries, Motor operations and password hashing are timed as spans
+of the current request's trace. Any span slower than SLOW_OP_THRESHOLD_MS is
+logged with its query shape (values replaced by "?"). The last
+TRACE_RECENT_REQUESTS traces are kept in memory for the debug endpoint.
+
+Spans recorded outside a request (background refresh, jobs) are only
+checked against the slow threshold.
+"""
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Callable, List, Optional, Union
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+MAX_SPANS_PER_TRACE = 200
+MAX_SHAPE_LENGTH = 500
+
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds `request_id` to log records so formats can include %(request_id)s"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class Trace:
+    def __init__(self, request_id: str, method: str, path: str):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow()
+        self._start = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+        self.status_code: Optional[int] = None
+        self.spans: List[dict] = []
+        self.dropped_spans = 0
+
+    def add_span(self, kind: str, name: str, start: float, duration_ms: float, shape: Optional[str], error: Optional[str]):
+        if self.duration_ms is not None:
+            # Background work started by a request that has already finished
+            return
+        if len(self.spans) >= MAX_SPANS_PER_TRACE:
+            self.dropped_spans += 1
+            return
+        span = {
+            "kind": kind,
+            "name": name,
+            "offset_ms": round((start - self._start) * 1000, 2),
+            "duration_ms": round(duration_ms, 2),
+        }
+        if shape is not None:
+            span["shape"] = shape
+        if error is not None:
+            span["error"] = error
+        self.spans.append(span)
+
+    def finish(self, status_code: Optional[int]):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        self.status_code = status_code
+
+    def to_dict(self) -> dict:
+        by_kind: dict = {}
+        for span in self.spans:
+            totals = by_kind.setdefault(span["kind"], {"count": 0, "duration_ms": 0.0})
+            totals["count"] += 1
+            totals["duration_ms"] = round(totals["duration_ms"] + span["duration_ms"], 2)
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration_ms or 0, 2),
+            "status_code": self.status_code,
+            "by_kind": by_kind,
+            "spans": self.spans,
+            "dropped_spans": self.dropped_spans,
+        }
+
+
+recent_traces: deque = deque(maxlen=settings.TRACE_RECENT_REQUESTS)
+
+
+def slowest_requests(limit: int = 20, path_prefix: Optional[str] = None) -> List[dict]:
+    traces = [t for t in list(recent_traces) if not path_prefix or t.path.startswith(path_prefix)]
+    traces.sort(key=lambda t: t.duration_ms or 0, reverse=True)
+    return [t.to_dict() for t in traces[:limit]]
+
+
+# ---- shapes ----
+
+def query_shape(value: Any, depth: int = 0) -> Any:
+    """Structure of a Mongo filter/update/pipeline with all values replaced by "?" """
+    if isinstance(value, dict):
+        if depth > 5:
+            return "{...}"
+        return {str(k): query_shape(v, depth + 1) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(v, dict) for v in value):
+            return [query_shape(v, depth + 1) for v in value[:20]]
+        return "[?]"
+    return "?"
+
+
+def sql_shape(query: str) -> str:
+    return " ".join(query.split())[:MAX_SHAPE_LENGTH]
+
+
+def _render(shape: Union[None, str, Callable[[], Any]]) -> Optional[str]:
+    if callable(shape):
+        shape = shape()
+    if shape is None or isinstance(shape, str):
+        return shape
+    return json.dumps(shape, default=str)[:MAX_SHAPE_LENGTH]
+
+
+# ---- spans ----
+
+def record_span(kind: str, name: str, start: float, shape=None, error: Optional[str] = None):
+    """Record a finished operation that started at perf_counter() value `start`"""
+    duration_ms = (time.perf_counter() - start) * 1000
+    slow = duration_ms >= settings.SLOW_OP_THRESHOLD_MS
+    rendered = _render(shape) if slow else None
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(kind, name, start, duration_ms, rendered, error)
+    if slow:
+        logger.warning(f"Slow {kind} operation {name} took {duration_ms:.0f}ms: {rendered}")
+
+
+@contextmanager
+def span(kind: str, name: str, shape=None):
+    """
+    Time a block as a span of the current trace.
+
+    `shape` may be a string or a callable returning the query shape; it is
+    only evaluated when the operation turns out to be slow.
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record_span(kind, name, start, shape, error)
+
+
+# ---- ASGI middleware ----
+
+class TracingMiddleware:
+    """Pure ASGI middleware that opens a trace per HTTP request"""
+
+    def __init__(self, app, header: str = "x-request-id"):
+        self.app = app
+        self.header = header.encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope.get("headers", []):
+            if key.lower() == self.header:
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+
+        trace = Trace(request_id, scope.get("method", ""), scope.get("path", ""))
+        id_token = request_id_var.set(request_id)
+        trace_token = _current_trace.set(trace)
+        status_code = None
+
+        async def send_with_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((self.header, request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            trace.finish(status_code or 500)
+            recent_traces.append(trace)
+            if trace.duration_ms >= settings.SLOW_REQUEST_THRESHOLD_MS:
+                logger.warning(
+                    f"Slow request {trace.method} {trace.path} took {trace.duration_ms:.0f}ms "
+                    f"({len(trace.spans)} spans: {trace.to_dict()['by_kind']})"
+                )
+            _current_trace.reset(trace_token)
+            request_id_var.reset(id_token)
+
+
+# ---- Motor proxies ----
+
+_MOTOR_OPERATIONS = {
+    "insert_one", "insert_many", "find_one", "find_one_and_update", "find_one_and_replace",
+    "find_one_and_delete", "update_one", "update_many", "replace_one", "delete_one", "delete_many",
+    "count_documents", "estimated_document_count", "distinct", "bulk_write",
+    "create_index", "create_indexes", "drop_index",
+}
+_MOTOR_CURSORS = {"find", "aggregate"}
+_BULK_OPERATIONS = {"insert_many", "bulk_write"}
+
+
+def _operation_shape(method: str, args: tuple, kwargs: dict):
+    if method in _BULK_OPERATIONS:
+        return lambda: f"{len(args[0]) if args else 0} documents"
+    if method == "insert_one":
+        return None
+    first = args[0] if args else kwargs.get("filter", kwargs.get("pipeline"))
+    return lambda: query_shape(first)
+
+
+class TracedCursor:
+    """Wraps a Motor cursor; to_list() and async iteration are timed"""
+
+    def __init__(self, cursor, name: str, shape):
+        self._cursor = cursor
+        self._name = name
+        self._shape = shape
+        self._iter_start: Optional[float] = None
+
+    def __getattr__(self, attr):
+        value = getattr(self._cursor, attr)
+        if not callable(value):
+            return value
+
+        def chained(*args, **kwargs):
+            result = value(*args, **kwargs)
+            # sort(), limit(), skip() ... return the cursor itself; keep the wrapper
+            return self if result is self._cursor else result
+
+        return chained
+
+    async def to_list(self, length=None):
+        with span("mongo", self._name, self._shape):
+            return await self._cursor.to_list(length)
+
+    def __aiter__(self):
+        self._iter = self._cursor.__aiter__()
+        self._iter_start = time.perf_counter()
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._iter.__anext__()
+        except StopAsyncIteration:
+            record_span("mongo", self._name, self._iter_start, self._shape)
+            raise
+
+
+class TracedCollection:
+    """Wraps a Motor collection so each operation is recorded as a span"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._name = collection.name
+
+    def __getattr__(self, attr):
+        value = getattr(self._collection, attr)
+        if attr in _MOTOR_OPERATIONS:
+            name = f"{self._name}.{attr}"
+
+            async def timed(*args, **kwargs):
+                with span("mongo", name, _operation_shape(attr, args, kwargs)):
+                    return await value(*args, **kwargs)
+
+            return timed
+        if attr in _MOTOR_CURSORS:
+            name = f"{self._name}.{attr}"
+
+            def cursor(*args, **kwargs):
+                return TracedCursor(value(*args, **kwargs), name, _operation_shape(attr, args, kwargs))
+
+            return cursor
+        return value
+
+
+class TracedDatabase:
+    """Wraps a Motor database; collections are returned as TracedCollection"""
+
+    def __init__(self, database):
+        self._database = database
+
+    @property
+    def unwrapped(self):
+        return self._database
+
+    def __getattr__(self, attr):
+        value = getattr(self._database, attr)
+        if attr == "command":
+            async def timed(*args, **kwargs):
+                with span("mongo", f"command.{args[0] if args else ''}"):
+                    return await value(*args, **kwargs)
+            return timed
+        if hasattr(value, "find_one") and hasattr(value, "insert_one"):
+            return TracedCollection(value)
+        return value
+
+    def __getitem__(self, name: str):
+        return TracedCollection(self._database[name])
+
+    def get_collection(self, name: str, **kwargs):
+        return TracedCollection(self._database.get_collection(name, **kwargs))
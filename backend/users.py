@@ -0,0 +1,200 @@
+"""
+Persistent user store with a per-worker read-through cache
+
+Users live in the `users` collection (unique index on username), seeded
+from MOCK_USERS on startup. Lookups by username or id go through an
+in-process cache with a TTL, so login and token-to-user resolution usually
+cost no database round-trip. Writes through this store invalidate the
+cached record and bump a version stamp in the `user_cache` collection.
+Every worker reads the stamp at most once per USER_CACHE_CHECK_SECONDS and
+drops its whole cache when it changed, so a deactivation or password
+change made on one worker takes effect on the others within that interval
+(not after the full USER_CACHE_TTL_SECONDS).
+
+The seed users are also kept in memory, so logins keep working when
+MongoDB is not available.
+"""
+import logging
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class UsernameTaken(Exception):
+    """A user with this username already exists"""
+
+
+def _from_doc(doc: dict) -> dict:
+    user = dict(doc)
+    user["id"] = str(user.pop("_id"))
+    return user
+
+
+VERSION_ID = "version"
+
+
+class UserStore:
+    def __init__(self, get_db: Callable[[], Any], ttl: float, check_interval: float):
+        self._get_db = get_db
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._version: Optional[int] = None
+        self._version_checked_at = float("-inf")
+        self._by_username: Dict[str, Tuple[float, dict]] = {}
+        self._id_to_username: Dict[str, str] = {}
+        # Fallback when MongoDB is not available
+        self._memory: Dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+
+    # ---- cache ----
+
+    def _cached(self, username: str) -> Optional[dict]:
+        entry = self._by_username.get(username)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        return None
+
+    def _remember(self, user: dict) -> dict:
+        self._by_username[user["username"]] = (time.monotonic() + self.ttl, user)
+        self._id_to_username[user["id"]] = user["username"]
+        return user
+
+    def invalidate(self, username: Optional[str] = None):
+        """Drop one cached user, or the whole cache"""
+        if username is None:
+            self._by_username.clear()
+            self._id_to_username.clear()
+        else:
+            self._by_username.pop(username, None)
+
+    async def _check_version(self):
+        """Drop the cache when another worker changed a user since the last check"""
+        now = time.monotonic()
+        if now - self._version_checked_at < self.check_interval:
+            return
+        db = self._get_db()
+        if db is None:
+            return
+        try:
+            doc = await db.user_cache.find_one({"_id": VERSION_ID})
+        except PyMongoError as e:
+            logger.warning(f"User cache version check failed: {e}")
+            return
+        self._version_checked_at = now
+        version = doc["version"] if doc else 0
+        if version != self._version:
+            self.invalidate()
+            self._version = version
+
+    async def _bump_version(self, db):
+        await db.user_cache.update_one({"_id": VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+
+    # ---- reads ----
+
+    async def get_by_username(self, username: str) -> Optional[dict]:
+        await self._check_version()
+        user = self._cached(username)
+        if user is not None:
+            return user
+        self.misses += 1
+        doc = await self._find_one({"username": username})
+        if doc is False:
+            return self._memory.get(username)
+        return self._remember(_from_doc(doc)) if doc else None
+
+    async def get_by_id(self, user_id: str) -> Optional[dict]:
+        await self._check_version()
+        username = self._id_to_username.get(user_id)
+        if username is not None:
+            user = self._cached(username)
+            if user is not None and user["id"] == user_id:
+                return user
+        self.misses += 1
+        doc = await self._find_one({"_id": user_id})
+        if doc is False:
+            return next((u for u in self._memory.values() if u["id"] == user_id), None)
+        return self._remember(_from_doc(doc)) if doc else None
+
+    async def _find_one(self, query: dict):
+        """Find a user document; returns False when MongoDB cannot be used"""
+        db = self._get_db()
+        if db is None:
+            return False
+        try:
+            return await db.users.find_one(query)
+        except PyMongoError as e:
+            logger.warning(f"User lookup failed, using in-memory users: {e}")
+            return False
+
+    async def list(self) -> List[dict]:
+        db = self._get_db()
+        if db is None:
+            return list(self._memory.values())
+        return [_from_doc(d) for d in await db.users.find({}).sort("username", 1).to_list(None)]
+
+    # ---- writes ----
+
+    async def create(self, user: dict) -> dict:
+        """Insert a user (password already hashed); raises UsernameTaken"""
+        db = self._get_db()
+        user = {**user, "created_at": user.get("created_at") or datetime.utcnow()}
+        if db is None:
+            if user["username"] in self._memory:
+                raise UsernameTaken(user["username"])
+            user.setdefault("id", str(len(self._memory) + 1))
+            self._memory[user["username"]] = user
+            return user
+        doc = {k: v for k, v in user.items() if k != "id"}
+        doc["_id"] = user.get("id") or str(ObjectId())
+        try:
+            await db.users.insert_one(doc)
+        except DuplicateKeyError:
+            raise UsernameTaken(user["username"])
+        self.invalidate(user["username"])
+        await self._bump_version(db)
+        return _from_doc(doc)
+
+    async def update(self, user_id: str, fields: dict) -> Optional[dict]:
+        db = self._get_db()
+        if db is None:
+            user = await self.get_by_id(user_id)
+            if user:
+                user.update(fields)
+            return user
+        doc = await db.users.find_one_and_update(
+            {"_id": user_id}, {"$set": fields}, return_document=ReturnDocument.AFTER,
+        )
+        if doc is None:
+            return None
+        user = _from_doc(doc)
+        self.invalidate(user["username"])
+        await self._bump_version(db)
+        return user
+
+    async def seed(self, users: List[dict]):
+        """Create the given users if missing (existing users are left untouched)"""
+        now = datetime.utcnow()
+        for u in users:
+            self._memory.setdefault(u["username"], {**u, "created_at": now})
+        db = self._get_db()
+        if db is None:
+            return
+        for u in users:
+            doc = {k: v for k, v in u.items() if k != "id"}
+            doc["created_at"] = now
+            try:
+                await db.users.update_one({"_id": u["id"]}, {"$setOnInsert": doc}, upsert=True)
+            except DuplicateKeyError:
+                # Username already taken by a user with a different id
+                logger.warning(f"Not seeding user {u['username']}: username exists")
+            except PyMongoError as e:
+                logger.warning(f"Could not seed users: {e}")
+                return
@@ -0,0 +1,69 @@
+"""
+Server-side variance computation for count entries
+
+Devices compute system_stock, variance and variance_value from their cached
+item data, which can be hours old by the time an offline batch syncs. On
+ingest, and when a count is edited, the server recomputes these against
+the current ERP snapshot (one batched lookup per request) and keeps the
+device values for audit. Items the catalog cannot price keep the device's
+system stock and MRP, but the variance is still derived from the count.
+"""
+import logging
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+VARIANCE_SOURCE_ERP = "erp"
+VARIANCE_SOURCE_DEVICE = "device"
+
+# Fields recompute_variances sets on an entry
+VARIANCE_FIELDS = ("system_stock", "variance", "variance_value", "variance_source", "variance_price")
+
+
+def _as_int(value, default: int = 0) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _as_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def recompute_variances(catalog, entries: List[dict], trust_catalog: bool = True) -> List[dict]:
+    """
+    Recompute system_stock, variance and variance_value in place.
+
+    Device-supplied values are preserved as device_system_stock,
+    device_variance and device_variance_value (recomputing an edited entry
+    keeps the ones recorded at ingest). Items missing from the catalog (or
+    when trust_catalog is False, e.g. while serving mock data) are computed
+    from the device's system_stock and mrp and marked with
+    variance_source='device'.
+    """
+    if not entries:
+        return entries
+
+    current = catalog.stock_and_prices([e.get("item_id") for e in entries]) if trust_catalog else {}
+    for entry in entries:
+        entry.setdefault("device_system_stock", entry.get("system_stock"))
+        entry.setdefault("device_variance", entry.get("variance"))
+        entry.setdefault("device_variance_value", entry.get("variance_value"))
+
+        erp = current.get(str(entry.get("item_id")))
+        if erp is None:
+            system_stock, price, source = _as_int(entry.get("system_stock")), _as_float(entry.get("mrp")), VARIANCE_SOURCE_DEVICE
+        else:
+            system_stock, price, source = erp["system_stock"], erp["mrp"], VARIANCE_SOURCE_ERP
+
+        variance = _as_int(entry.get("counted_qty")) - system_stock
+        entry["system_stock"] = system_stock
+        entry["variance"] = variance
+        entry["variance_value"] = round(variance * price, 2) if price is not None else None
+        entry["variance_source"] = source
+        entry["variance_price"] = price
+    return entries